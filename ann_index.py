@@ -0,0 +1,218 @@
+import logging
+import os
+import pickle
+import threading
+
+import hnswlib
+import numpy as np
+
+from vector_index import normalize
+
+
+logger = logging.getLogger(__name__)
+
+ANN_M = int(os.getenv("ANN_M", 16))
+ANN_EF_CONSTRUCTION = int(os.getenv("ANN_EF_CONSTRUCTION", 200))
+ANN_EF = int(os.getenv("ANN_EF", 64))
+# Where the graph is persisted between restarts (disabled when unset)
+ANN_INDEX_PATH = os.getenv("ANN_INDEX_PATH")
+
+
+class HnswIndex:
+    """
+    Approximate nearest-neighbour index (HNSW) over normalized embeddings.
+
+    It is attached as a listener to an EmbeddingIndex, which forwards every
+    load, upsert and remove. The ANN graph therefore tracks exactly the same
+    documents as the exact index and the two modes can be compared directly.
+    hnswlib needs integer labels, so `_id`s are mapped to labels here.
+    """
+
+    def __init__(self, m=ANN_M, ef_construction=ANN_EF_CONSTRUCTION, ef=ANN_EF, path=ANN_INDEX_PATH):
+        self.m = m
+        self.ef_construction = ef_construction
+        self.ef = ef
+        self.path = path
+        self.lock = threading.Lock()
+        self.graph = None
+        self.labels = {}
+        self.ids = {}
+        self.next_label = 0
+        self.deleted = 0
+
+    def __len__(self):
+        return len(self.labels)
+
+    def _new_graph(self, dim, capacity):
+        graph = hnswlib.Index(space='ip', dim=dim)
+        graph.init_index(max_elements=max(capacity, 16), M=self.m, ef_construction=self.ef_construction, allow_replace_deleted=True)
+        graph.set_ef(self.ef)
+        return graph
+
+    def set_ef(self, ef):
+        with self.lock:
+            self.ef = ef
+            if self.graph is not None:
+                self.graph.set_ef(ef)
+
+    def build(self, ids, matrix):
+        """Rebuild the graph from scratch; searches keep using the old graph until it is ready."""
+        if len(ids) == 0:
+            with self.lock:
+                self.graph, self.labels, self.ids, self.next_label, self.deleted = None, {}, {}, 0, 0
+            return
+
+        graph = self._new_graph(matrix.shape[1], len(ids) * 2)
+        graph.add_items(matrix, np.arange(len(ids)))
+
+        with self.lock:
+            self.graph = graph
+            self.labels = {document_id: label for label, document_id in enumerate(ids)}
+            self.ids = {label: document_id for label, document_id in enumerate(ids)}
+            self.next_label = len(ids)
+            self.deleted = 0
+
+        self.save()
+
+    def on_load(self, ids, matrix):
+        # Reuse the graph saved by a previous process when there is one
+        if self.path and os.path.exists(self.path) and self.graph is None:
+            try:
+                self.load()
+                self.reconcile(ids, matrix)
+                self.save()
+                return
+            except Exception:
+                logger.exception("Error loading ANN index, rebuilding", extra={'path': self.path})
+        self.build(ids, matrix)
+
+    def reconcile(self, ids, matrix, chunk_size=10000):
+        """Bring a loaded graph up to date with the current ids and vectors."""
+        current = set(ids)
+        for document_id in list(self.labels):
+            if document_id not in current:
+                self.remove(document_id)
+
+        for start in range(0, len(ids), chunk_size):
+            chunk_ids = ids[start:start + chunk_size]
+            chunk = matrix[start:start + chunk_size]
+            known = [i for i, document_id in enumerate(chunk_ids) if document_id in self.labels]
+
+            # Vectors edited while this process was down are re-added
+            changed = set(range(len(chunk_ids))) - set(known)
+            if known:
+                with self.lock:
+                    stored = np.asarray(self.graph.get_items([self.labels[chunk_ids[i]] for i in known]), dtype=np.float32)
+                differs = ~np.all(np.isclose(stored, chunk[known], atol=1e-5), axis=1)
+                changed.update(np.asarray(known)[differs].tolist())
+
+            for i in changed:
+                self.upsert(chunk_ids[i], chunk[i])
+
+    def upsert(self, document_id, embedding):
+        vector = normalize(embedding)
+
+        with self.lock:
+            if self.graph is None:
+                self.graph = self._new_graph(len(vector), 16)
+
+            label = self.labels.get(document_id)
+            if label is not None:
+                # hnswlib updates an existing label in place
+                self.graph.add_items(vector[np.newaxis], [label])
+                return
+
+            if self.deleted == 0 and self.graph.element_count >= self.graph.get_max_elements():
+                self.graph.resize_index(self.graph.get_max_elements() * 2)
+
+            label = self.next_label
+            self.next_label += 1
+            self.graph.add_items(vector[np.newaxis], [label], replace_deleted=self.deleted > 0)
+            if self.deleted > 0:
+                self.deleted -= 1
+            self.labels[document_id] = label
+            self.ids[label] = document_id
+
+    def remove(self, document_id):
+        with self.lock:
+            label = self.labels.pop(document_id, None)
+            if label is None:
+                return False
+            del self.ids[label]
+            self.graph.mark_deleted(label)
+            self.deleted += 1
+            return True
+
+    def _query(self, queries, k, offset, allowed):
+        """Run knn_query for a 2-d array of queries; returns per-query `(id, score)` lists."""
+        with self.lock:
+            if self.graph is None or not self.labels:
+                return [[] for _ in queries]
+
+            query_filter = None
+            candidates = len(self.labels)
+            if allowed is not None:
+                # hnswlib skips labels rejected by the filter while walking the graph
+                allowed_labels = {self.labels[document_id] for document_id in allowed if document_id in self.labels}
+                if not allowed_labels:
+                    return [[] for _ in queries]
+                query_filter = allowed_labels.__contains__
+                candidates = len(allowed_labels)
+
+            k = min(offset + k, candidates)
+            # ef must be at least k for hnswlib to return k results
+            if self.ef < k:
+                self.graph.set_ef(k)
+            # The filter is a Python callback, so extra threads would only contend for the GIL
+            labels, distances = self.graph.knn_query(queries, k=k, num_threads=1 if query_filter else -1, filter=query_filter)
+            if self.ef < k:
+                self.graph.set_ef(self.ef)
+            ids = self.ids
+
+        # Inner product space: distance = 1 - similarity
+        return [
+            [(ids[int(label)], float(1 - distance)) for label, distance in zip(row_labels, row_distances) if int(label) in ids][offset:]
+            for row_labels, row_distances in zip(labels, distances)
+        ]
+
+    def search(self, query_embedding, k=5, offset=0, allowed=None):
+        """
+        Return up to `k` approximate `(id, score)` pairs ordered by descending cosine similarity,
+        skipping the first `offset`. `allowed` restricts the results to those ids.
+        """
+        return self._query(normalize(query_embedding)[np.newaxis], k, offset, allowed)[0]
+
+    def search_many(self, query_embeddings, k=5, offset=0, allowed=None):
+        """Approximate top-k for many queries in one hnswlib call."""
+        queries = np.asarray([normalize(query) for query in query_embeddings], dtype=np.float32)
+        return self._query(queries, k, offset, allowed)
+
+    def save(self):
+        if not self.path:
+            return
+        with self.lock:
+            if self.graph is None:
+                return
+            self.graph.save_index(self.path)
+            with open(f"{self.path}.ids", 'wb') as f:
+                pickle.dump({
+                    'dim': self.graph.dim,
+                    'labels': self.labels,
+                    'next_label': self.next_label,
+                    'deleted': self.deleted,
+                }, f)
+
+    def load(self):
+        with open(f"{self.path}.ids", 'rb') as f:
+            state = pickle.load(f)
+
+        graph = hnswlib.Index(space='ip', dim=state['dim'])
+        graph.load_index(self.path, allow_replace_deleted=True)
+        graph.set_ef(self.ef)
+
+        with self.lock:
+            self.graph = graph
+            self.labels = state['labels']
+            self.ids = {label: document_id for document_id, label in self.labels.items()}
+            self.next_label = state['next_label']
+            self.deleted = state['deleted']
@@ -0,0 +1,92 @@
+"""
+Measure recall@k of the HNSW index against exact search on the inventory catalog.
+
+    python ann_recall.py --k 5 --queries 500 --ef 16 32 64 128
+
+Each query is a catalog embedding; its own id is left out of both result
+lists so the measurement is about its neighbours, not about finding itself.
+"""
+import argparse
+import json
+import time
+
+import numpy as np
+
+import resources
+from ann_index import ANN_EF_CONSTRUCTION, ANN_M, HnswIndex
+from embedding_providers import configured_model
+from vector_index import EmbeddingIndex, recall_at_k
+
+
+def neighbours(results, query_id, k):
+    return [document_id for document_id, _ in results if document_id != query_id][:k]
+
+
+def measure(exact_index, ann_index, query_ids, queries, k, ef):
+    ann_index.set_ef(ef)
+    expected = []
+    found = []
+    exact_seconds = 0.0
+    ann_seconds = 0.0
+
+    for query_id, query in zip(query_ids, queries):
+        started = time.perf_counter()
+        exact = exact_index.search(query, k + 1)
+        exact_seconds += time.perf_counter() - started
+
+        started = time.perf_counter()
+        approximate = ann_index.search(query, k + 1)
+        ann_seconds += time.perf_counter() - started
+
+        expected.append(neighbours(exact, query_id, k))
+        found.append(neighbours(approximate, query_id, k))
+
+    return {
+        'ef': ef,
+        'recall_at_k': round(recall_at_k(expected, found), 4),
+        'exact_ms': round(1000 * exact_seconds / len(queries), 3),
+        'ann_ms': round(1000 * ann_seconds / len(queries), 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--k', type=int, default=5)
+    parser.add_argument('--queries', type=int, default=200, help="number of catalog items used as queries")
+    parser.add_argument('--ef', type=int, nargs='+', default=[16, 32, 64, 128])
+    parser.add_argument('--m', type=int, default=ANN_M)
+    parser.add_argument('--ef-construction', type=int, default=ANN_EF_CONSTRUCTION)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    collection = resources.collection('inventories')
+
+    exact_index = EmbeddingIndex(model=configured_model())
+    exact_index.load(collection)
+    ids, matrix = exact_index.snapshot()
+    if len(ids) == 0:
+        print("No embedded inventories found.")
+        return
+
+    started = time.perf_counter()
+    ann_index = HnswIndex(m=args.m, ef_construction=args.ef_construction, path=None)
+    ann_index.build(ids, matrix)
+    build_seconds = time.perf_counter() - started
+
+    rng = np.random.default_rng(args.seed)
+    sample = rng.choice(len(ids), size=min(args.queries, len(ids)), replace=False)
+
+    report = {
+        'catalog_size': len(ids),
+        'k': args.k,
+        'queries': len(sample),
+        'm': args.m,
+        'ef_construction': args.ef_construction,
+        'build_seconds': round(build_seconds, 3),
+        'results': [measure(exact_index, ann_index, ids[sample], matrix[sample], args.k, ef) for ef in args.ef],
+    }
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
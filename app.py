@@ -1,43 +1,80 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, g, request, jsonify
 from flask_swagger_ui import get_swaggerui_blueprint
 import numpy as np, ast
-from openai import OpenAI
-from sklearn.metrics.pairwise import cosine_similarity
 from dotenv import load_dotenv
 load_dotenv()
-from langchain_openai import ChatOpenAI
+import hashlib
+import logging
 import os
-from pymongo import MongoClient
-from supabase import create_client, Client
-from utils import extract_text_from_image,fetch_and_convert_image_to_base64,generate_embedding
+import time
+import resources
+import telemetry
+from resources import lazy_collection
+from utils import extract_text_from_image,fetch_and_convert_image_to_base64,generate_embedding,generate_query_embedding,embedding_model,build_inventory_text,inventory_fingerprint,embedding_is_current
+from utils import fetch_ranked_inventories,parse_fields,generate_query_embeddings,hydrate_ranked_results,parse_search_options,query_embedding_cache
+from utils import resolve_owner_profile_pictures,owner_profile_picture as owner_profile_picture_for,propagate_owner_profile_pictures
+from utils import VENDOR_QUERY,VENDOR_TEXT_FIELDS,build_vendor_text,fetch_ranked_vendors,embedding_dispatcher
 from bson import json_util
 from flask_cors import CORS
-from langchain_core.tools import tool
 from bson.objectid import ObjectId
 from docs import SWAGGER_TEMPLATE
+from vector_index import inventory_index, vendor_index
+from lexical_index import inventory_lexical_index, reciprocal_rank_fusion
+from sync import IndexWatcher, touch
+from router import IntentRouter
+from batch import EmbeddingPipeline
+from jobs import JobRunner
+from captions import CaptionPipeline
+from ann_index import HnswIndex
+from codec import encode_embedding
+from cache import DocumentCache, ResultCache
 
 
 
-url: str = os.environ.get("SUPABASE_URL")
-key: str = os.environ.get("SUPABASE_KEY")
-supabase: Client = create_client(url, key)
+telemetry.configure_logging()
+logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
 CORS(app)
 
-# Create a MongoDB client
-client = MongoClient(os.getenv("MONGODB_URL"))
-
-# Connect to the cream-card database
-db = client['cream-card']
-
-# Fetch everything from the inventories collection
-inventories_collection = db['inventories']
-users_collection = db['users']
-
-
-# Retrieve all documents in the inventories collection
-all_inventories = inventories_collection.find()
+# Collections of the shared MongoDB client (see resources.py); nothing connects until first use
+inventories_collection = lazy_collection('inventories')
+users_collection = lazy_collection('users')
+jobs_collection = lazy_collection('embedding_jobs')
+vendor_jobs_collection = lazy_collection('vendor_embedding_jobs')
+caption_jobs_collection = lazy_collection('caption_jobs')
+image_captions_collection = lazy_collection('image_captions')
+
+# Default scoring for /search: exact brute force, approximate (HNSW), or a truncated-vector scan with an exact rerank
+SEARCH_MODE = os.getenv("SEARCH_MODE", "exact")
+SEARCH_MODES = ['exact', 'ann', 'two_stage']
+# Largest number of queries accepted by /search/batch
+SEARCH_BATCH_MAX = int(os.getenv("SEARCH_BATCH_MAX", 100))
+# Fuse BM25 keyword results into every search, and answer exact title matches without embedding
+HYBRID_SEARCH = os.getenv("HYBRID_SEARCH", "true").lower() == "true"
+LEXICAL_FAST_PATH = os.getenv("LEXICAL_FAST_PATH", "true").lower() == "true"
+# How deep each ranking is read before fusion
+HYBRID_DEPTH = int(os.getenv("HYBRID_DEPTH", 50))
+# What /search looks for: decided per query by the intent router, or forced by the client
+SEARCH_TARGETS = ['auto', 'inventory', 'vendor']
+# The vendor index gets its own snapshot directory (disabled when unset)
+VENDOR_SNAPSHOT_PATH = os.getenv("VENDOR_SNAPSHOT_PATH")
+# Serve repeated /search requests from cached rankings and pre-serialized documents
+SEARCH_CACHE = os.getenv("SEARCH_CACHE", "true").lower() == "true"
+
+# The ANN graph and the truncated matrix follow the exact index; they are built up front only when they are the default
+ann_index = HnswIndex()
+if SEARCH_MODE == 'ann':
+    inventory_index.add_listener(ann_index)
+elif SEARCH_MODE == 'two_stage':
+    inventory_index.enable_two_stage()
+
+INDEX_SYNC_ENABLED = os.getenv("INDEX_SYNC_ENABLED", "true").lower() == "true"
+
+# Rankings by request, and the JSON of the documents they point to (see cache.py)
+search_result_cache = ResultCache()
+inventory_document_cache = DocumentCache()
+vendor_document_cache = DocumentCache()
 
 
 
@@ -57,28 +94,139 @@ def swagger_spec():
 
 
 
-@tool
-def is_inventory(query:str) -> str:
-    """
-    checks if the input string is trying to ask for a product or inventory
-    """
-    return "inventory"
+def intent_llm():
+    """Chat model bound to the routing tools, created once per process on first use."""
+    def create():
+        from langchain_core.tools import tool
+
+        @tool
+        def is_inventory(query:str) -> str:
+            """
+            checks if the input string is trying to ask for a product or inventory
+            """
+            return "inventory"
+
+        @tool
+        def is_vendor(query:str) -> str:
+            """
+            checks if the input string is trying to ask for a vendor
+            """
+            return "vendor"
 
+        tools = [is_inventory,is_vendor]
+        return resources.chat_model("gpt-3.5-turbo-0125").bind_tools(tools, tool_choice = 'any')
 
-@tool
-def is_vendor(query:str) -> str:
+    return resources.shared('intent-llm', create)
+
+
+# Routes queries locally from their embedding, only asking the LLM (in the background) when unsure
+intent_router = IntentRouter(
+    lambda texts: embedding_model.embed_documents(texts),
+    lambda query: intent_llm().invoke(query).tool_calls[0]['name']
+)
+
+
+def allowed_inventory_ids(filters):
+    """Indexed ids matching `filters` (a RowSet), for rankers that cannot read the attribute columns (None when unfiltered)."""
+    if not filters:
+        return None
+    inventory_index.ensure_loaded(inventories_collection)
+    return inventory_index.matching(filters)
+
+
+@telemetry.stage('lexical')
+def lexical_fast_path(query, k, offset=0, filters=None):
+    """
+    Ranked results for a query that exactly matches product titles, without embedding it:
+    the exact matches first, then the best other keyword matches. None when nothing matches
+    exactly or keywords alone cannot fill the page.
+    """
+    if not LEXICAL_FAST_PATH:
+        return None
+
+    inventory_lexical_index.ensure_loaded(inventories_collection)
+    exact = inventory_lexical_index.exact_matches(query)
+    if not exact:
+        return None
+    # Most queries match no title exactly, so the filter is only resolved once one does
+    allowed = allowed_inventory_ids(filters)
+    if allowed is not None:
+        exact = [inventory_id for inventory_id in exact if inventory_id in allowed]
+        if not exact:
+            return None
+
+    ranked = [(inventory_id, 1.0) for inventory_id in exact]
+    if len(ranked) < offset + k:
+        seen = set(exact)
+        keyword = inventory_lexical_index.search(query, offset + k, allowed=allowed)
+        ranked += [result for result in keyword if result[0] not in seen]
+        if len(ranked) < offset + k and len(ranked) < len(inventory_lexical_index):
+            return None
+    return ranked[offset:offset + k]
+
+
+@telemetry.stage('ranking')
+def rank_inventories(query_embeddings, mode, k, offset=0, filters=None, queries=None):
     """
-    checks if the input string is trying to ask for a vendor
+    Ranked `(id, score)` lists, one per query embedding, from the exact index, the ANN index
+    or the two-stage (truncated scan, exact rerank) search.
+    Filters are resolved against the index's attribute columns before ranking.
+    With `queries` and HYBRID_SEARCH, each list is fused with the BM25 ranking of its query.
     """
-    return "vendor"
+    inventory_index.ensure_loaded(inventories_collection)
+    hybrid = HYBRID_SEARCH and queries is not None
+    depth = max(offset + k, HYBRID_DEPTH) if hybrid else k
+    allowed = allowed_inventory_ids(filters) if mode == 'ann' or hybrid else None
 
+    if mode == 'ann':
+        inventory_index.add_listener(ann_index)
+        vector_lists = ann_index.search_many(query_embeddings, k=depth, offset=0 if hybrid else offset, allowed=allowed)
+    elif mode == 'two_stage':
+        inventory_index.enable_two_stage()
+        vector_lists = inventory_index.search_two_stage(query_embeddings, k=depth, offset=0 if hybrid else offset, filters=filters)
+    else:
+        vector_lists = inventory_index.search_many(query_embeddings, k=depth, offset=0 if hybrid else offset, filters=filters)
 
+    if not hybrid:
+        return vector_lists
 
-llm = ChatOpenAI(model="gpt-3.5-turbo-0125")
-tools = [is_inventory,is_vendor]
-llm_with_tools = llm.bind_tools(tools, tool_choice = 'any')
+    inventory_lexical_index.ensure_loaded(inventories_collection)
+    return [
+        reciprocal_rank_fusion([vector, inventory_lexical_index.search(query, depth, allowed=allowed)])[offset:offset + k]
+        for query, vector in zip(queries, vector_lists)
+    ]
 
 
+@telemetry.stage('ranking')
+def rank_vendors(query_embedding, k, offset=0):
+    """Ranked `(id, score)` vendor profiles for a query embedding; the inventory matrix is not touched."""
+    vendor_index.ensure_loaded(users_collection)
+    return vendor_index.search(query_embedding, k=k, offset=offset)
+
+
+def search_version():
+    """Versions of every index /search reads; a write to any of them retires the cached rankings."""
+    return (inventory_index.version, inventory_lexical_index.version, vendor_index.version)
+
+
+def search_cache_key(query, target, mode, fields, k, offset, filters):
+    if not SEARCH_CACHE:
+        return None
+    return search_result_cache.key(query, search_version(), target=target, mode=mode, fields=fields, k=k, offset=offset, filters=filters)
+
+
+def render_search_results(query_target, ranked_ids, fields):
+    """JSON array of the ranked documents, joined from their cached serializations."""
+    if query_target == 'is_vendor':
+        return vendor_document_cache.render(ranked_ids, lambda ids, fields: fetch_ranked_vendors(users_collection, ids, fields), fields)
+    return inventory_document_cache.render(ranked_ids, lambda ids, fields: fetch_ranked_inventories(inventories_collection, ids, fields), fields)
+
+
+def search_headers(body, query_target):
+    return {
+        'X-Search-Target': 'vendor' if query_target == 'is_vendor' else 'inventory',
+        'ETag': f'"{hashlib.blake2b(body, digest_size=16).hexdigest()}"',
+    }
 
 
 @app.route('/search', methods=['POST'])
@@ -87,57 +235,136 @@ def search():
         # Get the search query from the request
         data = request.form
         query = data.get('query')
+        fields = parse_fields(data.get('fields'))
+        mode = data.get('mode', SEARCH_MODE)
+        target = data.get('target', 'auto')
 
-        query_target = llm_with_tools.invoke(query).tool_calls[0]['name']
-        print(query_target)
-        
         if not query:
             return jsonify({'status': 'error', 'message': 'No query provided'}), 400
-        
-        # Generate an embedding for the query
-        query_embedding = generate_embedding(query)
-        
-        if query_embedding is None:
-            return jsonify({'status': 'error', 'message': 'Error generating embedding'}), 500
-        
-        # Fetch all documents with embeddings from the MongoDB collection
-        all_inventories = inventories_collection.find({'embedding': {'$exists': True}})
-        
-        # Prepare to store the similarity results
-        results = []
-        
-        for inventory in all_inventories:
-            inventory_embedding = inventory.get('embedding')
-            
-            if inventory_embedding:
-                # Calculate cosine similarity between query embedding and inventory embedding
-                similarity = cosine_similarity([query_embedding], [inventory_embedding])[0][0]
-                
-                # Create a copy of the inventory without the embedding
-                inventory_without_embedding = {k: v for k, v in inventory.items() if k != 'embedding'}
-                
-                # Add the cleaned inventory and similarity score to the results list (for sorting purposes)
-                results.append({
-                    'inventory': inventory_without_embedding,  # Store the document without the embedding
-                    'similarity_score': similarity  # Keep the score just for sorting
-                })
-        
-        # Sort results by similarity score in descending order
-        results = sorted(results, key=lambda x: x['similarity_score'], reverse=True)[:5]
-        
-        # Extract the sorted inventory documents (without similarity score)
-        sorted_inventories = [result['inventory'] for result in results]
-        
-        # Serialize the results using bson's json_util to handle ObjectId and other MongoDB types
-        return json_util.dumps(sorted_inventories), 200
+
+        if mode not in SEARCH_MODES:
+            return jsonify({'status': 'error', 'message': f"mode must be one of {', '.join(SEARCH_MODES)}"}), 400
+
+        if target not in SEARCH_TARGETS:
+            return jsonify({'status': 'error', 'message': f"target must be one of {', '.join(SEARCH_TARGETS)}"}), 400
+
+        try:
+            k, offset, filters = parse_search_options(data)
+        except ValueError as e:
+            return jsonify({'status': 'error', 'message': str(e)}), 400
+
+        if filters and target == 'vendor':
+            return jsonify({'status': 'error', 'message': 'Filters only apply to inventory searches'}), 400
+
+        # A repeated request against unchanged indexes skips embedding, routing and ranking
+        cache_key = search_cache_key(query, target, mode, fields, k, offset, filters)
+        cached = search_result_cache.get(cache_key) if cache_key else None
+
+        if cached is not None:
+            query_target, ranked_ids = cached
+        else:
+            # Exact title matches (brand names, product names) need no embedding
+            ranked = lexical_fast_path(query, k, offset, filters) if target != 'vendor' else None
+            query_target = 'is_inventory'
+            settled = True
+
+            if ranked is None:
+                # Generate an embedding for the query
+                query_embedding = generate_query_embedding(query)
+
+                if query_embedding is None:
+                    return jsonify({'status': 'error', 'message': 'Error generating embedding'}), 500
+
+                # Inventory filters imply an inventory search, so only unfiltered automatic searches are routed
+                if target == 'vendor':
+                    query_target = 'is_vendor'
+                elif target == 'auto' and not filters:
+                    with telemetry.stage('routing'):
+                        query_target = intent_router.route(query, query_embedding)
+                    settled = intent_router.settled(query)
+                logger.debug("Routed query", extra={'target': query_target})
+
+                # Score the query against the in-memory indexes, loading them on first use
+                if query_target == 'is_vendor':
+                    ranked = rank_vendors(query_embedding, k, offset)
+                else:
+                    ranked = rank_inventories([query_embedding], mode, k, offset, filters, [query])[0]
+            ranked_ids = [inventory_id for inventory_id, _ in ranked]
+
+            # A provisional route is not cached, so the LLM's decision is used once it arrives
+            if cache_key and settled:
+                search_result_cache.set(cache_key, (query_target, ranked_ids))
+
+        # Only documents missing from the cache are fetched (without their embeddings) and serialized
+        body = render_search_results(query_target, ranked_ids, fields)
+        headers = search_headers(body, query_target)
+        if request.if_none_match.contains_weak(headers['ETag'].strip('"')):
+            return '', 304, headers
+        return body, 200, headers
     
     except Exception as e:
-        print(f"Error: {str(e)}")
+        logger.exception("Error handling request", extra={'path': request.path})
         return jsonify({'status': 'error', 'message': str(e)}), 500
 
     
     except Exception as e:
-        print(f"Error: {str(e)}")
+        logger.exception("Error handling request", extra={'path': request.path})
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+
+
+@app.route('/search/batch', methods=['POST'])
+def search_batch():
+    """
+    Search for many queries at once: one embedding request, one matrix product
+    and one document fetch for the whole batch.
+    """
+    try:
+        # Accept a JSON body or repeated `queries` form fields
+        data = request.get_json(silent=True) or {}
+        queries = data.get('queries') or request.form.getlist('queries')
+        fields = parse_fields(data.get('fields') or request.form.get('fields'))
+        mode = data.get('mode') or request.form.get('mode') or SEARCH_MODE
+
+        if not queries or not isinstance(queries, list) or not all(isinstance(query, str) and query for query in queries):
+            return jsonify({'status': 'error', 'message': 'queries must be a non-empty list of strings'}), 400
+
+        if len(queries) > SEARCH_BATCH_MAX:
+            return jsonify({'status': 'error', 'message': f"At most {SEARCH_BATCH_MAX} queries per batch"}), 400
+
+        if mode not in SEARCH_MODES:
+            return jsonify({'status': 'error', 'message': f"mode must be one of {', '.join(SEARCH_MODES)}"}), 400
+
+        # The same page and filters apply to every query in the batch
+        try:
+            k, offset, filters = parse_search_options(data or request.form)
+        except ValueError as e:
+            return jsonify({'status': 'error', 'message': str(e)}), 400
+
+        # Queries answered by exact title matches are left out of the embedding request
+        ranked_lists = [lexical_fast_path(query, k, offset, filters) for query in queries]
+        pending = [query for query, ranked in zip(queries, ranked_lists) if ranked is None]
+
+        if pending:
+            # Generate embeddings for the remaining queries in one request
+            query_embeddings = generate_query_embeddings(pending)
+
+            if any(embedding is None for embedding in query_embeddings):
+                return jsonify({'status': 'error', 'message': 'Error generating embedding'}), 500
+
+            scored = iter(rank_inventories(query_embeddings, mode, k, offset, filters, pending))
+            ranked_lists = [ranked if ranked is not None else next(scored) for ranked in ranked_lists]
+
+        results = hydrate_ranked_results(inventories_collection, ranked_lists, fields)
+
+        with telemetry.stage('serialization'):
+            body = json_util.dumps([
+                {'query': query, 'results': inventories}
+                for query, inventories in zip(queries, results)
+            ])
+        return body, 200
+
+    except Exception as e:
+        logger.exception("Error handling request", extra={'path': request.path})
         return jsonify({'status': 'error', 'message': str(e)}), 500
 
 
@@ -166,94 +393,307 @@ def add_inventory_to_ai():
         if not inventory:
             return jsonify({'status': 'error', 'message': 'Inventory item not found'}), 404
 
-        # Combine relevant fields to create a text representation for embedding
-        inventory_text = ' '.join(str(value) for key, value in inventory.items() if key in ['title', 'description', 'price', 'currency'])
+        inventory_text = build_inventory_text(inventory)
+        fingerprint = inventory_fingerprint(inventory_text)
 
-        # Generate the embedding
-        embedding = generate_embedding(inventory_text)
+        # Only re-embed when the text (or model) changed since the last embedding
+        embedding = None
+        if not embedding_is_current(inventory, fingerprint):
+            embedding = generate_embedding(inventory_text)
 
-        if embedding is None:
-            return jsonify({'status': 'error', 'message': 'Error generating embedding'}), 500
+            if embedding is None:
+                return jsonify({'status': 'error', 'message': 'Error generating embedding'}), 500
 
         # Retrieve the owner's profile picture
         owner_id = inventory.get('owner')
-        owner_profile_picture = ""
-
-        if owner_id and ObjectId.is_valid(owner_id):
-            owner = users_collection.find_one({'_id': ObjectId(owner_id)})
-            if owner:
-                owner_profile_picture = owner.get('profilePicture', "")
+        owner_profile_picture = owner_profile_picture_for(owner_id, resolve_owner_profile_pictures([owner_id]))
 
         # Update the inventory document with the new embedding and owner_profilePicture
         update_data = {
             'owner_profilePicture': owner_profile_picture,
-            'embedding': embedding,
         }
-
-        inventories_collection.update_one(
-            {'_id': ObjectId(inventory_id)},
-            {'$set': update_data}
-        )
+        if embedding is not None:
+            update_data.update({
+                'embedding': encode_embedding(embedding),
+                'embedding_hash': fingerprint,
+                'embedding_model': embedding_model.model,
+            })
+
+        with telemetry.stage('database'):
+            inventories_collection.update_one(
+                {'_id': ObjectId(inventory_id)},
+                touch({'$set': update_data})
+            )
+        with telemetry.stage('indexing'):
+            if embedding is not None:
+                inventory_index.upsert(ObjectId(inventory_id), embedding, inventory, model=embedding_model.model)
+            inventory_lexical_index.upsert(ObjectId(inventory_id), inventory)
+            inventory_document_cache.invalidate(ObjectId(inventory_id))
 
         return jsonify({'status': 'success', 'message': 'Inventory embedding and owner profile picture updated successfully'}), 200
 
     except Exception as e:
-        print(f"Error: {str(e)}")
+        logger.exception("Error handling request", extra={'path': request.path})
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+
+
+
+@app.route('/add_vendor_to_ai', methods=['POST'])
+def add_vendor_to_ai():
+    """
+    Generate an embedding for a vendor's profile and add it to the vendor index.
+    """
+    try:
+        user_id = request.form.get('user_id')
+
+        if not user_id:
+            return jsonify({'status': 'error', 'message': 'Missing user_id in the request body'}), 400
+
+        if not ObjectId.is_valid(user_id):
+            return jsonify({'status': 'error', 'message': 'Invalid user ID'}), 400
+
+        user = users_collection.find_one({'_id': ObjectId(user_id)}, {field: 1 for field in VENDOR_TEXT_FIELDS + ['embedding_hash']})
+
+        if not user:
+            return jsonify({'status': 'error', 'message': 'User not found'}), 404
+
+        vendor_text = build_vendor_text(user)
+        if not vendor_text:
+            return jsonify({'status': 'error', 'message': 'Vendor profile has no text to embed'}), 400
+
+        fingerprint = inventory_fingerprint(vendor_text)
+        if embedding_is_current(user, fingerprint):
+            return jsonify({'status': 'success', 'message': 'Vendor embedding is already up to date'}), 200
+
+        embedding = generate_embedding(vendor_text)
+
+        if embedding is None:
+            return jsonify({'status': 'error', 'message': 'Error generating embedding'}), 500
+
+        users_collection.update_one({'_id': ObjectId(user_id)}, touch({'$set': {
+            'embedding': encode_embedding(embedding),
+            'embedding_hash': fingerprint,
+            'embedding_model': embedding_model.model,
+        }}))
+        vendor_index.upsert(ObjectId(user_id), embedding, model=embedding_model.model)
+        vendor_document_cache.invalidate(ObjectId(user_id))
+
+        return jsonify({'status': 'success', 'message': 'Vendor embedding updated successfully'}), 200
+
+    except Exception as e:
+        logger.exception("Error handling request", extra={'path': request.path})
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+
+
+
+@app.route('/sync_owner_profile_pictures', methods=['POST'])
+def sync_owner_profile_pictures():
+    """
+    Copy owners' current profile pictures onto their inventories.
+    Pass user_id to sync a single owner, or nothing to sync every owner.
+    """
+    try:
+        user_id = request.form.get('user_id')
+
+        if user_id is not None and not ObjectId.is_valid(user_id):
+            return jsonify({'status': 'error', 'message': 'Invalid user ID'}), 400
+
+        modified = propagate_owner_profile_pictures([user_id] if user_id else None)
+        if modified:
+            inventory_document_cache.clear()
+
+        return jsonify({'status': 'success', 'message': f"Updated {modified} inventories.", 'updated': modified}), 200
+
+    except Exception as e:
+        logger.exception("Error handling request", extra={'path': request.path})
         return jsonify({'status': 'error', 'message': str(e)}), 500
 
 
 
+# Full-catalog re-embedding runs as a resumable background job
+job_runner = JobRunner(
+    jobs_collection,
+    inventories_collection,
+    lambda: EmbeddingPipeline(inventories_collection, embedding_model.embed_documents, embedding_model.model, inventory_index)
+)
+vendor_job_runner = JobRunner(
+    vendor_jobs_collection,
+    users_collection,
+    lambda: EmbeddingPipeline(
+        users_collection, embedding_model.embed_documents, embedding_model.model, vendor_index,
+        text_fields=VENDOR_TEXT_FIELDS, build_text=build_vendor_text, base_query=VENDOR_QUERY,
+    )
+)
+job_runners = {'inventories': job_runner, 'vendors': vendor_job_runner}
+# Photo captioning runs the same way; its captions reach the index on the next inventory embedding job
+caption_job_runner = JobRunner(
+    caption_jobs_collection,
+    inventories_collection,
+    lambda: CaptionPipeline(inventories_collection, image_captions_collection)
+)
+
+
+def start_background_tasks():
+    """Start this process's index watchers and resume interrupted embedding jobs."""
+    # Keep the in-memory search indexes in sync with inventory and vendor profile writes
+    if INDEX_SYNC_ENABLED:
+        IndexWatcher(inventory_index, inventories_collection, lexical_index=inventory_lexical_index, document_cache=inventory_document_cache).start()
+        IndexWatcher(vendor_index, users_collection, snapshot_path=VENDOR_SNAPSHOT_PATH, document_cache=vendor_document_cache).start()
+    for runner in list(job_runners.values()) + [caption_job_runner]:
+        runner.executor.submit(runner.resume_interrupted)
+    return True
+
+
+def ensure_background_tasks():
+    """
+    Start the background tasks once per process. Threads do not survive a fork, so this runs in
+    each worker (gunicorn.conf.py, or the first request) rather than at import time.
+    """
+    return resources.shared('background-tasks', start_background_tasks)
+
+
+@app.before_request
+def before_request():
+    ensure_background_tasks()
+    g.request_started = time.perf_counter()
+    g.timings = telemetry.start_request()
+
+
+@app.after_request
+def after_request(response):
+    started = g.get('request_started')
+    if started is not None:
+        elapsed = time.perf_counter() - started
+        telemetry.observe_request(request.url_rule.rule if request.url_rule else 'unmatched', response.status_code, elapsed)
+        if telemetry.SERVER_TIMING:
+            response.headers['Server-Timing'] = telemetry.server_timing(g.timings, elapsed)
+    return response
+
+
+# Scrape-time values: index sizes and cache effectiveness
+telemetry.register('safelink_index_documents', "Documents held by each in-memory index", lambda: {
+    'inventory': len(inventory_index),
+    'vendor': len(vendor_index),
+    'lexical': len(inventory_lexical_index),
+    'ann': len(ann_index),
+}, label='index')
+telemetry.register('safelink_query_cache_requests', "Query embedding cache lookups, by result", lambda: {
+    'hit': query_embedding_cache.stats()['hits'],
+    'miss': query_embedding_cache.stats()['misses'],
+}, label='result', kind='counter')
+telemetry.register('safelink_query_cache_entries', "Query embeddings held in memory", lambda: query_embedding_cache.stats()['size'])
+telemetry.register('safelink_embedding_dispatch_events', "Embedding dispatcher batches sent, texts embedded, duplicate texts coalesced and rate-limit responses", lambda: {
+    event: embedding_dispatcher.stats()[event] for event in ['batches', 'texts', 'coalesced', 'rate_limited']
+}, label='event', kind='counter')
+telemetry.register('safelink_embedding_dispatch_state', "Texts queued for embedding, requests in flight and the current concurrency limit", lambda: {
+    state: embedding_dispatcher.stats()[state] for state in ['queued', 'active', 'limit']
+}, label='state')
+telemetry.register('safelink_result_cache_requests', "Search result cache lookups, by result", lambda: {
+    'hit': search_result_cache.stats()['hits'],
+    'miss': search_result_cache.stats()['misses'],
+}, label='result', kind='counter')
+telemetry.register('safelink_result_cache_entries', "Cached search rankings and serialized documents", lambda: {
+    'rankings': search_result_cache.stats()['size'],
+    'inventories': len(inventory_document_cache),
+    'vendors': len(vendor_document_cache),
+}, label='cache')
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """
+    Prometheus metrics: per-stage and per-endpoint latency histograms, index sizes,
+    cache hit counts and batch pipeline throughput.
+    """
+    body, content_type = telemetry.render()
+    return Response(body, content_type=content_type)
+
+
 @app.route('/full_batch_embedding', methods=['POST'])
 def add_embeddings_to_all_inventories():
     """
-    Generate embeddings for all inventory items and update their MongoDB documents.
+    Queue a background job that generates embeddings for all inventory items,
+    or for all vendor profiles with target=vendors.
     """
 
     try:
-        # Retrieve all inventory items from the database
-        inventories = inventories_collection.find()
-
-        updated_count = 0
-        error_count = 0
-
-        for inventory in inventories:
-            try:
-                # Combine relevant fields to create a text representation for embedding
-                inventory_text = ' '.join(
-                    str(value) for key, value in inventory.items() if key != '_id' and key != 'embedding'
-                )
-
-                # Generate the embedding
-                embedding = generate_embedding(inventory_text)
-
-                if embedding is not None:
-                    # Update the inventory document with the new embedding
-                    inventories_collection.update_one(
-                        {'_id': inventory['_id']},
-                        {'$set': {'embedding': embedding}}
-                    )
-                    updated_count += 1
-                else:
-                    error_count += 1
+        target = request.form.get('target', 'inventories')
 
-            except Exception as inner_exception:
-                print(f"Error processing inventory with ID {inventory['_id']}: {str(inner_exception)}")
-                error_count += 1
+        if target not in job_runners:
+            return jsonify({'status': 'error', 'message': f"target must be one of {', '.join(job_runners)}"}), 400
+
+        job_id, created = job_runners[target].submit()
 
         return jsonify({
             'status': 'success',
-            'message': f"Processed {updated_count + error_count} inventories.",
-            'updated': updated_count,
-            'errors': error_count
-        }), 200
+            'message': "Embedding job queued." if created else "An embedding job is already in progress.",
+            'job_id': str(job_id)
+        }), 202
 
     except Exception as e:
-        print(f"Error: {str(e)}")
+        logger.exception("Error handling request", extra={'path': request.path})
         return jsonify({'status': 'error', 'message': str(e)}), 500
 
 
+@app.route('/full_batch_embedding/<job_id>', methods=['GET'])
+def embedding_job_status(job_id):
+    """
+    Report progress, throughput and ETA of a full batch embedding job.
+    """
 
-if __name__ == '__main__':
-    app.run(port=os.getenv("PORT", default=5000),debug=True)
+    try:
+        job = job_runner.status(job_id) or vendor_job_runner.status(job_id)
 
+        if job is None:
+            return jsonify({'status': 'error', 'message': 'Job not found'}), 404
 
+        return jsonify({'status': 'success', 'job': job}), 200
+
+    except Exception as e:
+        logger.exception("Error handling request", extra={'path': request.path})
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+
+
+@app.route('/caption_images', methods=['POST'])
+def caption_images():
+    """
+    Queue a background job that captions the photos of every inventory item.
+    Run /full_batch_embedding afterwards to fold the new captions into the embeddings.
+    """
+
+    try:
+        job_id, created = caption_job_runner.submit()
+
+        return jsonify({
+            'status': 'success',
+            'message': "Captioning job queued." if created else "A captioning job is already in progress.",
+            'job_id': str(job_id)
+        }), 202
+
+    except Exception as e:
+        logger.exception("Error handling request", extra={'path': request.path})
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+
+
+@app.route('/caption_images/<job_id>', methods=['GET'])
+def caption_job_status(job_id):
+    """
+    Report progress, throughput and ETA of a captioning job.
+    """
+
+    try:
+        job = caption_job_runner.status(job_id)
+
+        if job is None:
+            return jsonify({'status': 'error', 'message': 'Job not found'}), 404
+
+        return jsonify({'status': 'success', 'job': job}), 200
+
+    except Exception as e:
+        logger.exception("Error handling request", extra={'path': request.path})
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+
+
+
+if __name__ == '__main__':
+    app.run(port=os.getenv("PORT", default=5000),debug=True)
@@ -0,0 +1,461 @@
+"""
+ASGI variant of the search and indexing endpoints.
+
+    uvicorn asgi:app --workers 2
+    gunicorn asgi:app -k uvicorn.workers.UvicornWorker
+
+Embeddings go through the shared dispatcher, which batches them with other
+requests (see embedding_dispatcher.py); with EMBEDDING_DISPATCH=false they
+are requested with the async OpenAI client over one pooled httpx connection
+pool, or computed on the thread pool by a local provider. PyMongo and
+CPU-bound scoring run on a bounded thread pool, and independent calls are
+awaited together, so a single worker keeps hundreds of searches in flight
+while they wait on the network. The index, watcher, router and job runner
+are the ones defined in app.py; the watcher and job resumption start in each
+worker's lifespan.
+"""
+import asyncio
+import contextvars
+import json
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from urllib.parse import parse_qs
+
+import httpx
+from bson import json_util
+from bson.objectid import ObjectId
+from fastapi import FastAPI, Request
+from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, Response
+from werkzeug.http import parse_etags
+
+import telemetry
+from app import (
+    SEARCH_BATCH_MAX, SEARCH_MODE, SEARCH_MODES, SEARCH_TARGETS, ensure_background_tasks, intent_router, inventories_collection,
+    inventory_document_cache, job_runners, lexical_fast_path, rank_inventories, rank_vendors, render_search_results, search_cache_key,
+    search_headers, search_result_cache, users_collection, vendor_document_cache,
+)
+from codec import encode_embedding
+from embedding_dispatcher import EMBEDDING_DISPATCH
+from embedding_providers import EMBEDDING_PROVIDER
+from lexical_index import inventory_lexical_index
+from sync import touch
+from utils import (
+    VENDOR_TEXT_FIELDS, build_inventory_text, build_vendor_text, embedding_dispatcher, embedding_is_current, embedding_model, hydrate_ranked_results,
+    inventory_fingerprint, owner_profile_picture, parse_fields, parse_search_options, query_embedding_cache,
+    resolve_owner_profile_pictures,
+)
+from vector_index import inventory_index, vendor_index
+
+
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", 100))
+HTTP_MAX_KEEPALIVE = int(os.getenv("HTTP_MAX_KEEPALIVE", 20))
+HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", 30))
+# Threads for PyMongo calls and scoring; bounds how much blocking work runs at once
+DB_THREADS = int(os.getenv("DB_THREADS", 32))
+
+db_executor = ThreadPoolExecutor(max_workers=DB_THREADS, thread_name_prefix="asgi-db")
+openai_client = None
+
+logger = logging.getLogger(__name__)
+
+
+@asynccontextmanager
+async def lifespan(app):
+    global openai_client
+    # Imported here so the OpenAI SDK loads in the worker rather than at import time
+    from openai import AsyncOpenAI
+
+    http_client = httpx.AsyncClient(
+        limits=httpx.Limits(max_connections=HTTP_MAX_CONNECTIONS, max_keepalive_connections=HTTP_MAX_KEEPALIVE),
+        timeout=HTTP_TIMEOUT,
+    )
+    if EMBEDDING_PROVIDER == 'openai':
+        openai_client = AsyncOpenAI(http_client=http_client)
+    ensure_background_tasks()
+    try:
+        yield
+    finally:
+        await http_client.aclose()
+
+
+app = FastAPI(title="Safelink Search API", lifespan=lifespan)
+app.add_middleware(CORSMiddleware, allow_origins=["*"], allow_methods=["*"], allow_headers=["*"])
+
+
+@app.middleware('http')
+async def record_timings(request: Request, call_next):
+    started = time.perf_counter()
+    timings = telemetry.start_request()
+    response = await call_next(request)
+    elapsed = time.perf_counter() - started
+
+    route = request.scope.get('route')
+    telemetry.observe_request(route.path if route else 'unmatched', response.status_code, elapsed)
+    if telemetry.SERVER_TIMING:
+        response.headers['Server-Timing'] = telemetry.server_timing(timings, elapsed)
+    return response
+
+
+def error(message, status_code):
+    return JSONResponse({'status': 'error', 'message': message}, status_code=status_code)
+
+
+async def run_blocking(function, *args):
+    # Run in a copy of the request's context so stage timings reach its Server-Timing header
+    context = contextvars.copy_context()
+    return await asyncio.get_running_loop().run_in_executor(db_executor, context.run, function, *args)
+
+
+async def read_params(request, lists=()):
+    """
+    Request parameters from a urlencoded form (what the Flask API accepts) or a JSON body.
+    Form fields named in `lists` keep every repeated value.
+    """
+    body = await request.body()
+    if request.headers.get('content-type', '').startswith('application/json'):
+        return json.loads(body or b'{}')
+    return {key: values if key in lists else values[0] for key, values in parse_qs(body.decode('utf-8')).items()}
+
+
+async def embed_texts_async(texts):
+    """
+    Embed `texts` through the shared dispatcher (batched with other requests), or without it
+    with one async API request, or the local model on the thread pool.
+    """
+    with telemetry.stage('embedding'):
+        if EMBEDDING_DISPATCH:
+            return await asyncio.gather(*(asyncio.wrap_future(future) for future in embedding_dispatcher.submit(texts)))
+        if EMBEDDING_PROVIDER != 'openai':
+            return await run_blocking(embedding_model.embed_documents, texts)
+        response = await openai_client.embeddings.create(model=embedding_model.model, input=texts)
+        return [item.embedding for item in response.data]
+
+
+async def generate_embedding_async(text):
+    try:
+        return (await embed_texts_async([text]))[0]
+    except Exception:
+        logger.exception("Error generating embedding")
+        return None
+
+
+async def generate_query_embedding_async(query):
+    embedding = query_embedding_cache.get(query, embedding_model.model)
+    if embedding is not None:
+        return embedding
+
+    embedding = await generate_embedding_async(query)
+    if embedding is not None:
+        query_embedding_cache.set(query, embedding_model.model, embedding)
+    return embedding
+
+
+@app.post('/search')
+async def search(request: Request):
+    try:
+        data = await read_params(request)
+        query = data.get('query')
+        fields = parse_fields(data.get('fields'))
+        mode = data.get('mode', SEARCH_MODE)
+        target = data.get('target', 'auto')
+
+        if not query:
+            return error('No query provided', 400)
+
+        if mode not in SEARCH_MODES:
+            return error(f"mode must be one of {', '.join(SEARCH_MODES)}", 400)
+
+        if target not in SEARCH_TARGETS:
+            return error(f"target must be one of {', '.join(SEARCH_TARGETS)}", 400)
+
+        try:
+            k, offset, filters = parse_search_options(data)
+        except ValueError as e:
+            return error(str(e), 400)
+
+        if filters and target == 'vendor':
+            return error('Filters only apply to inventory searches', 400)
+
+        # A repeated request against unchanged indexes skips embedding, routing and ranking
+        cache_key = search_cache_key(query, target, mode, fields, k, offset, filters)
+        cached = search_result_cache.get(cache_key) if cache_key else None
+
+        if cached is not None:
+            query_target, ranked_ids = cached
+        else:
+            # Exact title matches need no embedding
+            ranked = await run_blocking(lexical_fast_path, query, k, offset, filters) if target != 'vendor' else None
+            query_target = 'is_inventory'
+            settled = True
+
+            if ranked is None:
+                # Embed the query while the index loads (a no-op once it is warm)
+                query_embedding, _ = await asyncio.gather(
+                    generate_query_embedding_async(query),
+                    run_blocking(inventory_index.ensure_loaded, inventories_collection),
+                )
+
+                if query_embedding is None:
+                    return error('Error generating embedding', 500)
+
+                if target == 'vendor':
+                    query_target = 'is_vendor'
+                elif target == 'auto' and not filters:
+                    with telemetry.stage('routing'):
+                        query_target = intent_router.route(query, query_embedding)
+                    settled = intent_router.settled(query)
+                logger.debug("Routed query", extra={'target': query_target})
+
+                if query_target == 'is_vendor':
+                    ranked = await run_blocking(rank_vendors, query_embedding, k, offset)
+                else:
+                    ranked = (await run_blocking(rank_inventories, [query_embedding], mode, k, offset, filters, [query]))[0]
+
+            ranked_ids = [inventory_id for inventory_id, _ in ranked]
+            if cache_key and settled:
+                search_result_cache.set(cache_key, (query_target, ranked_ids))
+
+        body = await run_blocking(render_search_results, query_target, ranked_ids, fields)
+        headers = search_headers(body, query_target)
+        if parse_etags(request.headers.get('if-none-match')).contains_weak(headers['ETag'].strip('"')):
+            return Response(status_code=304, headers=headers)
+        return Response(body, media_type='application/json', headers=headers)
+
+    except Exception as e:
+        logger.exception("Error handling request", extra={'path': request.url.path})
+        return error(str(e), 500)
+
+
+async def generate_query_embeddings_async(queries):
+    """Embed the uncached queries with a single request; order follows `queries`."""
+    embeddings = [query_embedding_cache.get(query, embedding_model.model) for query in queries]
+    missing = list(dict.fromkeys(query for query, embedding in zip(queries, embeddings) if embedding is None))
+
+    if missing:
+        try:
+            generated = dict(zip(missing, await embed_texts_async(missing)))
+        except Exception:
+            logger.exception("Error generating embeddings", extra={'queries': len(missing)})
+            generated = {}
+
+        for query, embedding in generated.items():
+            query_embedding_cache.set(query, embedding_model.model, embedding)
+        embeddings = [embedding if embedding is not None else generated.get(query) for query, embedding in zip(queries, embeddings)]
+
+    return embeddings
+
+
+@app.post('/search/batch')
+async def search_batch(request: Request):
+    try:
+        # Accept a JSON body or repeated `queries` form fields, like the Flask API
+        try:
+            data = await read_params(request, lists=('queries',))
+        except ValueError:
+            return error('Request body must be JSON or form data', 400)
+        if not isinstance(data, dict):
+            return error('Request body must be a JSON object', 400)
+
+        queries = data.get('queries')
+        fields = parse_fields(data.get('fields'))
+        mode = data.get('mode', SEARCH_MODE)
+
+        if not queries or not isinstance(queries, list) or not all(isinstance(query, str) and query for query in queries):
+            return error('queries must be a non-empty list of strings', 400)
+
+        if len(queries) > SEARCH_BATCH_MAX:
+            return error(f"At most {SEARCH_BATCH_MAX} queries per batch", 400)
+
+        if mode not in SEARCH_MODES:
+            return error(f"mode must be one of {', '.join(SEARCH_MODES)}", 400)
+
+        try:
+            k, offset, filters = parse_search_options(data)
+        except ValueError as e:
+            return error(str(e), 400)
+
+        ranked_lists = await asyncio.gather(*(run_blocking(lexical_fast_path, query, k, offset, filters) for query in queries))
+        pending = [query for query, ranked in zip(queries, ranked_lists) if ranked is None]
+
+        if pending:
+            query_embeddings, _ = await asyncio.gather(
+                generate_query_embeddings_async(pending),
+                run_blocking(inventory_index.ensure_loaded, inventories_collection),
+            )
+
+            if any(embedding is None for embedding in query_embeddings):
+                return error('Error generating embedding', 500)
+
+            scored = iter(await run_blocking(rank_inventories, query_embeddings, mode, k, offset, filters, pending))
+            ranked_lists = [ranked if ranked is not None else next(scored) for ranked in ranked_lists]
+
+        results = await run_blocking(hydrate_ranked_results, inventories_collection, ranked_lists, fields)
+
+        with telemetry.stage('serialization'):
+            body = json_util.dumps([
+                {'query': query, 'results': inventories}
+                for query, inventories in zip(queries, results)
+            ])
+        return Response(body, media_type='application/json')
+
+    except Exception as e:
+        logger.exception("Error handling request", extra={'path': request.url.path})
+        return error(str(e), 500)
+
+
+@app.post('/add_inventory_to_ai')
+async def add_inventory_to_ai(request: Request):
+    try:
+        data = await read_params(request)
+
+        if not data or 'inventory_id' not in data:
+            return error('Missing inventory_id in the request body', 400)
+
+        inventory_id = data['inventory_id']
+
+        if not ObjectId.is_valid(inventory_id):
+            return error('Invalid inventory ID', 400)
+
+        inventory = await run_blocking(inventories_collection.find_one, {'_id': ObjectId(inventory_id)}, {'embedding': 0})
+
+        if not inventory:
+            return error('Inventory item not found', 404)
+
+        inventory_text = build_inventory_text(inventory)
+        fingerprint = inventory_fingerprint(inventory_text)
+        owner_id = inventory.get('owner')
+
+        async def embed_if_changed():
+            if embedding_is_current(inventory, fingerprint):
+                return None
+            return await generate_embedding_async(inventory_text)
+
+        # The embedding request and the owner lookup are independent
+        embedding, pictures = await asyncio.gather(
+            embed_if_changed(),
+            run_blocking(resolve_owner_profile_pictures, [owner_id]),
+        )
+
+        if embedding is None and not embedding_is_current(inventory, fingerprint):
+            return error('Error generating embedding', 500)
+
+        update_data = {'owner_profilePicture': owner_profile_picture(owner_id, pictures)}
+        if embedding is not None:
+            update_data.update({
+                'embedding': encode_embedding(embedding),
+                'embedding_hash': fingerprint,
+                'embedding_model': embedding_model.model,
+            })
+
+        with telemetry.stage('database'):
+            await run_blocking(inventories_collection.update_one, {'_id': ObjectId(inventory_id)}, touch({'$set': update_data}))
+        with telemetry.stage('indexing'):
+            if embedding is not None:
+                await run_blocking(inventory_index.upsert, ObjectId(inventory_id), embedding, inventory, embedding_model.model)
+            await run_blocking(inventory_lexical_index.upsert, ObjectId(inventory_id), inventory)
+            inventory_document_cache.invalidate(ObjectId(inventory_id))
+
+        return JSONResponse({'status': 'success', 'message': 'Inventory embedding and owner profile picture updated successfully'})
+
+    except Exception as e:
+        logger.exception("Error handling request", extra={'path': request.url.path})
+        return error(str(e), 500)
+
+
+@app.post('/add_vendor_to_ai')
+async def add_vendor_to_ai(request: Request):
+    try:
+        data = await read_params(request)
+
+        if not data or 'user_id' not in data:
+            return error('Missing user_id in the request body', 400)
+
+        user_id = data['user_id']
+
+        if not ObjectId.is_valid(user_id):
+            return error('Invalid user ID', 400)
+
+        user = await run_blocking(
+            users_collection.find_one, {'_id': ObjectId(user_id)}, {field: 1 for field in VENDOR_TEXT_FIELDS + ['embedding_hash']}
+        )
+
+        if not user:
+            return error('User not found', 404)
+
+        vendor_text = build_vendor_text(user)
+        if not vendor_text:
+            return error('Vendor profile has no text to embed', 400)
+
+        fingerprint = inventory_fingerprint(vendor_text)
+        if embedding_is_current(user, fingerprint):
+            return JSONResponse({'status': 'success', 'message': 'Vendor embedding is already up to date'})
+
+        embedding = await generate_embedding_async(vendor_text)
+
+        if embedding is None:
+            return error('Error generating embedding', 500)
+
+        with telemetry.stage('database'):
+            await run_blocking(users_collection.update_one, {'_id': ObjectId(user_id)}, touch({'$set': {
+                'embedding': encode_embedding(embedding),
+                'embedding_hash': fingerprint,
+                'embedding_model': embedding_model.model,
+            }}))
+        with telemetry.stage('indexing'):
+            await run_blocking(vendor_index.upsert, ObjectId(user_id), embedding, None, embedding_model.model)
+            vendor_document_cache.invalidate(ObjectId(user_id))
+
+        return JSONResponse({'status': 'success', 'message': 'Vendor embedding updated successfully'})
+
+    except Exception as e:
+        logger.exception("Error handling request", extra={'path': request.url.path})
+        return error(str(e), 500)
+
+
+@app.post('/full_batch_embedding')
+async def add_embeddings_to_all_inventories(request: Request):
+    try:
+        target = (await read_params(request)).get('target', 'inventories')
+
+        if target not in job_runners:
+            return error(f"target must be one of {', '.join(job_runners)}", 400)
+
+        job_id, created = await run_blocking(job_runners[target].submit)
+
+        return JSONResponse({
+            'status': 'success',
+            'message': "Embedding job queued." if created else "An embedding job is already in progress.",
+            'job_id': str(job_id)
+        }, status_code=202)
+
+    except Exception as e:
+        logger.exception("Error handling request", extra={'path': request.url.path})
+        return error(str(e), 500)
+
+
+@app.get('/full_batch_embedding/{job_id}')
+async def embedding_job_status(job_id: str):
+    try:
+        for runner in job_runners.values():
+            job = await run_blocking(runner.status, job_id)
+            if job is not None:
+                break
+
+        if job is None:
+            return error('Job not found', 404)
+
+        return JSONResponse({'status': 'success', 'job': job})
+
+    except Exception as e:
+        logger.exception("Error reading job status", extra={'job_id': job_id})
+        return error(str(e), 500)
+
+
+@app.get('/metrics')
+async def metrics():
+    body, content_type = telemetry.render()
+    return Response(body, media_type=content_type)
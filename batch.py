@@ -0,0 +1,178 @@
+import logging
+import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from pymongo import UpdateOne
+
+import telemetry
+from codec import encode_embedding
+from sync import touch
+from utils import INVENTORY_TEXT_FIELDS, build_inventory_text, embedding_is_current, inventory_fingerprint, iter_chunks
+from vector_index import FILTER_FIELDS
+
+
+logger = logging.getLogger(__name__)
+
+BATCH_CHUNK_SIZE = int(os.getenv("BATCH_CHUNK_SIZE", 100))
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", 4))
+
+
+class EmbeddingPipeline:
+    """
+    Re-embeds a collection in chunks.
+
+    Each chunk is embedded with a single `embed_documents` request and written
+    back with one `bulk_write`. Up to `concurrency` chunks are in flight at
+    once, and the cursor is only read as fast as chunks complete, so memory
+    stays bounded.
+
+    Documents are visited in `_id` order and `checkpoint` tracks the last `_id`
+    below which everything has been processed, so an interrupted run can be
+    resumed with `{'_id': {'$gt': checkpoint}}`.
+
+    Documents whose stored fingerprint matches their current text and `model`
+    are skipped without an embedding request.
+
+    Inventories are embedded by default. Other collections (vendor profiles)
+    pass their own `text_fields` and `build_text`, and `base_query` to select
+    which documents to embed.
+    """
+
+    def __init__(self, collection, embed_documents, model, index=None, chunk_size=BATCH_CHUNK_SIZE, concurrency=BATCH_CONCURRENCY,
+                 text_fields=INVENTORY_TEXT_FIELDS, build_text=build_inventory_text, base_query=None):
+        self.collection = collection
+        self.text_fields = text_fields
+        self.build_text = build_text
+        self.base_query = base_query
+        self.embed_documents = embed_documents
+        self.model = model
+        self.index = index
+        self.chunk_size = chunk_size
+        self.concurrency = concurrency
+        self.lock = threading.Lock()
+        self.updated = 0
+        self.errors = 0
+        self.skipped = 0
+        self.checkpoint = None
+        self.chunk_last_ids = []
+        self.completed_chunks = set()
+        self.next_chunk = 0
+
+    def process_chunk(self, chunk):
+        updated = 0
+        errors = 0
+        skipped = 0
+
+        try:
+            documents = []
+            texts = []
+            fingerprints = []
+            for inventory in chunk:
+                text = self.build_text(inventory)
+                fingerprint = inventory_fingerprint(text, self.model)
+                if not text.strip():
+                    errors += 1
+                elif embedding_is_current(inventory, fingerprint):
+                    skipped += 1
+                else:
+                    documents.append(inventory)
+                    texts.append(text)
+                    fingerprints.append(fingerprint)
+
+            if texts:
+                with telemetry.stage('batch_embedding'):
+                    embeddings = self.embed_documents(texts)
+
+                operations = [
+                    UpdateOne({'_id': inventory['_id']}, touch({'$set': {
+                        'embedding': encode_embedding(embedding),
+                        'embedding_hash': fingerprint,
+                        'embedding_model': self.model,
+                    }}))
+                    for inventory, embedding, fingerprint in zip(documents, embeddings, fingerprints)
+                ]
+                with telemetry.stage('batch_write'):
+                    self.collection.bulk_write(operations, ordered=False)
+
+                if self.index is not None:
+                    for inventory, embedding in zip(documents, embeddings):
+                        self.index.upsert(inventory['_id'], embedding, inventory, model=self.model)
+                updated += len(operations)
+
+        except Exception:
+            logger.exception("Error processing chunk", extra={'first_id': str(chunk[0]['_id'])})
+            errors = len(chunk)
+            updated = 0
+            skipped = 0
+
+        telemetry.count_batch('embedding', self.collection.name, updated, skipped, errors)
+
+        with self.lock:
+            self.updated += updated
+            self.errors += errors
+            self.skipped += skipped
+
+    def complete_chunk(self, position, on_progress):
+        with self.lock:
+            self.completed_chunks.add(position)
+
+            # Chunks can finish out of order; only move the checkpoint past a contiguous prefix
+            advanced = False
+            while self.next_chunk in self.completed_chunks:
+                self.completed_chunks.discard(self.next_chunk)
+                self.checkpoint = self.chunk_last_ids[self.next_chunk]
+                self.next_chunk += 1
+                advanced = True
+
+            progress = {
+                'updated': self.updated,
+                'errors': self.errors,
+                'skipped': self.skipped,
+                'checkpoint': self.checkpoint,
+            }
+
+        if advanced and on_progress is not None:
+            on_progress(progress)
+
+    def run_chunk(self, position, chunk, on_progress):
+        self.process_chunk(chunk)
+        self.complete_chunk(position, on_progress)
+
+    def run(self, query=None, on_progress=None):
+        """
+        Embed every document matching `query` and return throughput statistics.
+
+        `on_progress` is called with the running counts and checkpoint each time
+        the checkpoint advances.
+        """
+        started = time.monotonic()
+        # Only the text fields and the stored fingerprint are needed to decide what to embed,
+        # plus the filter fields the index keeps next to each vector
+        projection = {key: 1 for key in self.text_fields + FILTER_FIELDS + ['embedding_hash']}
+        if self.base_query and query:
+            query = {'$and': [self.base_query, query]}
+        cursor = self.collection.find(query or self.base_query or {}, projection).sort('_id', 1)
+
+        with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="embedding-pipeline") as executor:
+            in_flight = set()
+            for position, chunk in enumerate(iter_chunks(cursor, self.chunk_size)):
+                if len(in_flight) >= self.concurrency:
+                    _, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                with self.lock:
+                    self.chunk_last_ids.append(chunk[-1]['_id'])
+                in_flight.add(executor.submit(self.run_chunk, position, chunk, on_progress))
+            wait(in_flight)
+
+        elapsed = time.monotonic() - started
+        processed = self.updated + self.errors + self.skipped
+        return {
+            'processed': processed,
+            'updated': self.updated,
+            'errors': self.errors,
+            'skipped': self.skipped,
+            'checkpoint': self.checkpoint,
+            'seconds': round(elapsed, 3),
+            'docs_per_second': round(processed / elapsed, 2) if elapsed else 0.0,
+        }
@@ -0,0 +1,373 @@
+"""
+Benchmark search and indexing on a synthetic catalog, without network access.
+
+    python benchmark.py --items 10000 100000 --output results/$(git rev-parse --short HEAD).json
+    python benchmark.py --compare results/before.json results/after.json
+
+Each catalog size is written to mongomock (or to a local mongod with
+--mongo-url) with random embeddings. The embedding model and the chat
+models are replaced by a deterministic fake provider, so runs are
+reproducible for a given --seed and need no API keys.
+
+For every size this reports the index load time, /search latency (p50, p95,
+p99) and QPS under each --concurrency level, the latency of ranking alone
+(the in-memory indexes, without HTTP or MongoDB), batch-embedding throughput
+and memory (resident set size and the index arrays). Results are written as
+JSON; --compare prints the relative change of every metric between two
+result files.
+
+mongomock answers every query with a full collection scan, so on large
+catalogs /search latency mostly measures mongomock. Use --mongo-url for
+end-to-end numbers; the ranking figures are unaffected either way.
+"""
+import argparse
+import datetime
+import hashlib
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+# The app must not start change streams or snapshot writers against the benchmark database
+os.environ.setdefault("INDEX_SYNC_ENABLED", "false")
+os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+# Warnings and errors only, so logging stays out of the timings
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+import resources
+from codec import ENCODINGS, encode_embedding
+
+
+BENCHMARK_DATABASE = "benchmark"
+
+ADJECTIVES = ["red", "blue", "black", "white", "used", "new", "cheap", "leather", "wooden", "wireless",
+              "vintage", "large", "small", "organic", "handmade", "silver", "gold", "cotton", "smart", "portable"]
+NOUNS = ["phone", "laptop", "sneakers", "handbag", "dress", "charger", "watch", "chair", "table", "headphones",
+         "camera", "jacket", "perfume", "blender", "speaker", "bicycle", "backpack", "sofa", "lamp", "cake"]
+CURRENCIES = ["NGN", "USD", "GHS", "KES"]
+CATEGORIES = ["electronics", "fashion", "home", "food", "beauty", "sports"]
+
+
+def fake_vector(text, dim):
+    """Deterministic unit-scale vector for `text`: the same text always embeds to the same vector."""
+    seed = int.from_bytes(hashlib.sha256(text.encode('utf-8')).digest()[:8], 'little')
+    return np.random.default_rng(seed).standard_normal(dim).astype(np.float32).tolist()
+
+
+class FakeEmbeddings:
+    """Stand-in for OpenAIEmbeddings. `latency` seconds are slept per request to mimic the API."""
+
+    def __init__(self, dim, latency=0.0):
+        self.dim = dim
+        self.latency = latency
+        self.model = f"fake-embedding-{dim}"
+
+    def embed_query(self, text):
+        if self.latency:
+            time.sleep(self.latency)
+        return fake_vector(text, self.dim)
+
+    def embed_documents(self, texts):
+        if self.latency:
+            time.sleep(self.latency)
+        return [fake_vector(text, self.dim) for text in texts]
+
+
+class FakeChatResponse:
+    def __init__(self, content, tool_calls):
+        self.content = content
+        self.tool_calls = tool_calls
+
+
+class FakeChat:
+    """Stand-in for ChatOpenAI: captions every image the same way and routes every query to inventory."""
+
+    def bind_tools(self, tools, tool_choice=None):
+        return self
+
+    def invoke(self, messages):
+        return FakeChatResponse("A product photo.", [{'name': 'is_inventory', 'args': {}}])
+
+
+def install_stand_ins(mongo_url, embeddings):
+    """Register the benchmark database and fake models as this process's shared clients (see resources.py)."""
+    if mongo_url:
+        from pymongo import MongoClient
+        client = MongoClient(mongo_url)
+    else:
+        try:
+            import mongomock
+        except ImportError:
+            sys.exit("mongomock is required without --mongo-url: pip install mongomock")
+        client = mongomock.MongoClient()
+
+    resources.MONGODB_DATABASE = BENCHMARK_DATABASE
+    resources.shared('mongo', lambda: client)
+    resources.shared('embeddings', lambda: embeddings)
+    resources.shared('chat:gpt-4o-mini', FakeChat)
+    resources.shared('intent-llm', FakeChat)
+
+    # The indexes only hold vectors of the model they were created for
+    from vector_index import inventory_index, vendor_index
+    inventory_index.model = vendor_index.model = embeddings.model
+
+
+def generate_catalog(collection, items, dim, seed, encoding, model, chunk_size=10000):
+    """Replace `collection` with `items` synthetic inventories and return their titles."""
+    rng = np.random.default_rng(seed)
+    owners = [f"owner-{number}" for number in range(max(1, items // 20))]
+    titles = []
+
+    collection.drop()
+    for start in range(0, items, chunk_size):
+        count = min(chunk_size, items - start)
+        vectors = rng.standard_normal((count, dim)).astype(np.float32)
+        documents = []
+        for vector in vectors:
+            title = f"{rng.choice(ADJECTIVES)} {rng.choice(ADJECTIVES)} {rng.choice(NOUNS)}"
+            titles.append(title)
+            documents.append({
+                'title': title,
+                'description': ' '.join(rng.choice(ADJECTIVES + NOUNS, size=12)),
+                'price': float(rng.integers(100, 1000000)),
+                'currency': str(rng.choice(CURRENCIES)),
+                'owner': str(rng.choice(owners)),
+                'category': str(rng.choice(CATEGORIES)),
+                'embedding': encode_embedding(vector, encoding),
+                'embedding_model': model,
+            })
+        collection.insert_many(documents)
+    return titles
+
+
+def generate_queries(titles, count, exact_ratio, seed):
+    """Free-text queries, `exact_ratio` of which repeat a catalog title (the lexical fast path)."""
+    rng = np.random.default_rng(seed + 1)
+    queries = []
+    for number in range(count):
+        if titles and rng.random() < exact_ratio:
+            queries.append(titles[rng.integers(len(titles))])
+        else:
+            words = rng.choice(ADJECTIVES + NOUNS, size=int(rng.integers(1, 4)))
+            queries.append(f"{' '.join(words)} {number}")
+    return queries
+
+
+def rss_bytes():
+    """Current resident set size (peak RSS where /proc is unavailable)."""
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def megabytes(size):
+    return round(size / (1024 * 1024), 1)
+
+
+def latency_summary(latencies, seconds):
+    milliseconds = np.asarray(latencies) * 1000
+    return {
+        'requests': len(latencies),
+        'qps': round(len(latencies) / seconds, 1) if seconds else 0.0,
+        'mean_ms': round(float(milliseconds.mean()), 3),
+        'p50_ms': round(float(np.percentile(milliseconds, 50)), 3),
+        'p95_ms': round(float(np.percentile(milliseconds, 95)), 3),
+        'p99_ms': round(float(np.percentile(milliseconds, 99)), 3),
+    }
+
+
+def measure_search(flask_app, queries, mode, k, workers):
+    """Send every query to /search from `workers` threads and summarize the latencies."""
+    from app import inventory_document_cache, search_result_cache
+    from utils import query_embedding_cache
+
+    # Every level starts from cold caches so levels are comparable
+    query_embedding_cache.memory.clear()
+    search_result_cache.clear()
+    inventory_document_cache.clear()
+    clients = threading.local()
+    errors = []
+
+    def send(query):
+        if not hasattr(clients, 'client'):
+            clients.client = flask_app.test_client()
+        started = time.perf_counter()
+        response = clients.client.post('/search', data={'query': query, 'mode': mode, 'k': k, 'target': 'inventory'})
+        elapsed = time.perf_counter() - started
+        if response.status_code != 200:
+            errors.append(response.status_code)
+        return elapsed
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        latencies = list(executor.map(send, queries))
+    summary = latency_summary(latencies, time.perf_counter() - started)
+    summary.update({'workers': workers, 'errors': len(errors)})
+    return summary
+
+
+def measure_ranking(rank_inventories, embeddings, queries, mode, k):
+    """Time the in-memory ranking of /search (vector and keyword, fused) for each query, sequentially."""
+    vectors = embeddings.embed_documents(queries)
+    latencies = []
+    started = time.perf_counter()
+    for query, vector in zip(queries, vectors):
+        query_started = time.perf_counter()
+        rank_inventories([vector], mode, k, queries=[query])
+        latencies.append(time.perf_counter() - query_started)
+    return latency_summary(latencies, time.perf_counter() - started)
+
+
+def measure_batch_embedding(collection, embeddings, items):
+    """Re-embed the first `items` inventories with the pipeline used by /full_batch_embedding."""
+    from batch import EmbeddingPipeline
+
+    last = collection.find({}, {'_id': 1}).sort('_id', 1).skip(max(items - 1, 0)).limit(1)
+    last_ids = [document['_id'] for document in last]
+    query = {'_id': {'$lte': last_ids[0]}} if last_ids else None
+    stats = EmbeddingPipeline(collection, embeddings.embed_documents, embeddings.model).run(query=query)
+    return {key: stats[key] for key in ['processed', 'updated', 'errors', 'seconds', 'docs_per_second']}
+
+
+def run_size(args, items, embeddings):
+    import app as search_app
+    from lexical_index import inventory_lexical_index
+    from vector_index import inventory_index
+
+    collection = resources.collection('inventories')
+    print(f"[{items} items] generating catalog", file=sys.stderr)
+    started = time.perf_counter()
+    titles = generate_catalog(collection, items, args.dim, args.seed, args.encoding, embeddings.model)
+    generate_seconds = time.perf_counter() - started
+
+    rss_before = rss_bytes()
+    started = time.perf_counter()
+    inventory_index.load(collection)
+    vector_load_seconds = time.perf_counter() - started
+    started = time.perf_counter()
+    inventory_lexical_index.load(collection)
+    lexical_load_seconds = time.perf_counter() - started
+    rss_loaded = rss_bytes()
+
+    queries = generate_queries(titles, args.queries, args.exact_ratio, args.seed)
+    result = {
+        'items': items,
+        'generate_seconds': round(generate_seconds, 3),
+        'load_seconds': {'vector': round(vector_load_seconds, 3), 'lexical': round(lexical_load_seconds, 3)},
+        'search': {},
+        'ranking': {},
+    }
+
+    for mode in args.modes:
+        print(f"[{items} items] searching ({mode})", file=sys.stderr)
+        # Warm up lazy state (ANN graph, routing prototypes) outside the measurement
+        measure_search(search_app.app, queries[:min(len(queries), 10)], mode, args.k, 1)
+        result['search'][mode] = [measure_search(search_app.app, queries, mode, args.k, workers) for workers in args.concurrency]
+        result['ranking'][mode] = measure_ranking(search_app.rank_inventories, embeddings, queries, mode, args.k)
+
+    print(f"[{items} items] batch embedding", file=sys.stderr)
+    result['batch_embedding'] = measure_batch_embedding(collection, embeddings, min(items, args.embed_items))
+
+    result['memory'] = {
+        'rss_mb': megabytes(rss_bytes()),
+        'index_load_rss_mb': megabytes(rss_loaded - rss_before),
+        'vector_index_mb': megabytes(inventory_index.matrix.nbytes),
+        'peak_rss_mb': megabytes(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == 'darwin' else 1024)),
+    }
+    return result
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def flatten(value, prefix=''):
+    """Map every numeric leaf of a result to a dotted path, e.g. `10000.search.exact.4.p95_ms`."""
+    if isinstance(value, dict):
+        pairs = {}
+        for key, item in value.items():
+            pairs.update(flatten(item, f"{prefix}{key}."))
+        return pairs
+    if isinstance(value, list):
+        pairs = {}
+        for item in value:
+            key = item.get('workers', '') if isinstance(item, dict) else ''
+            pairs.update(flatten(item, f"{prefix}{key}."))
+        return pairs
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return {prefix.rstrip('.'): value}
+    return {}
+
+
+def compare(before_path, after_path):
+    with open(before_path) as before_file, open(after_path) as after_file:
+        before, after = json.load(before_file), json.load(after_file)
+
+    before_metrics = flatten({str(run['items']): run for run in before['runs']})
+    after_metrics = flatten({str(run['items']): run for run in after['runs']})
+    print(f"{before.get('commit') or before_path} -> {after.get('commit') or after_path}")
+    for name in sorted(before_metrics.keys() & after_metrics.keys()):
+        old, new = before_metrics[name], after_metrics[name]
+        change = f"{100 * (new - old) / old:+.1f}%" if old else "n/a"
+        print(f"{name:55} {old:>12} {new:>12} {change:>9}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--items', type=int, nargs='+', default=[10000], help="catalog sizes to benchmark")
+    parser.add_argument('--dim', type=int, default=1536)
+    parser.add_argument('--queries', type=int, default=500, help="/search requests per concurrency level")
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 8, 32])
+    parser.add_argument('--modes', nargs='+', default=['exact'], choices=['exact', 'ann', 'two_stage'])
+    parser.add_argument('--k', type=int, default=5)
+    parser.add_argument('--exact-ratio', type=float, default=0.1, help="share of queries that repeat a catalog title")
+    parser.add_argument('--embed-items', type=int, default=10000, help="inventories re-embedded by the batch benchmark")
+    parser.add_argument('--embed-latency-ms', type=float, default=0.0, help="simulated latency of each embedding request")
+    parser.add_argument('--encoding', choices=ENCODINGS, default='float16', help="how catalog embeddings are stored")
+    parser.add_argument('--mongo-url', help="benchmark against this mongod instead of mongomock (uses the 'benchmark' database)")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help="write the results to this JSON file")
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'), help="compare two result files and exit")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    embeddings = FakeEmbeddings(args.dim, args.embed_latency_ms / 1000)
+    install_stand_ins(args.mongo_url, embeddings)
+
+    report = {
+        'commit': git_commit(),
+        'created_at': datetime.datetime.utcnow().isoformat(),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'cpus': os.cpu_count(),
+        'args': {key: value for key, value in vars(args).items() if key not in ('output', 'compare')},
+        'runs': [run_size(args, items, embeddings) for items in args.items],
+    }
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, 'w') as output_file:
+            output_file.write(output)
+    print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,234 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+import numpy as np
+from bson import json_util
+from cachetools import TTLCache
+
+
+logger = logging.getLogger(__name__)
+
+EMBEDDING_CACHE_SIZE = int(os.getenv("EMBEDDING_CACHE_SIZE", 10000))
+EMBEDDING_CACHE_TTL = float(os.getenv("EMBEDDING_CACHE_TTL", 7 * 24 * 3600))
+# Optional sqlite file so restarted workers start with a warm cache
+EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH")
+
+
+def normalize_query(text):
+    """Case and whitespace insensitive form of a query, used as the cache key."""
+    return ' '.join(str(text).lower().split())
+
+
+class EmbeddingCache:
+    """
+    Bounded LRU cache of embeddings with a TTL, keyed by (model, normalized text).
+
+    When `path` is given, entries are also written to a sqlite database and
+    looked up there on a memory miss, so the cache survives restarts and is
+    shared by every worker on the machine.
+    """
+
+    def __init__(self, maxsize=EMBEDDING_CACHE_SIZE, ttl=EMBEDDING_CACHE_TTL, path=EMBEDDING_CACHE_PATH):
+        self.ttl = ttl
+        self.memory = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.path = path
+        self.connection = None
+        self.connection_pid = None
+
+    @property
+    def db(self):
+        """
+        This process's sqlite connection, opened on first use.
+        A connection must not be used across a fork, so a forked worker opens its own.
+        """
+        if not self.path:
+            return None
+        if self.connection_pid != os.getpid():
+            self.connection = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            self.connection_pid = os.getpid()
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings ("
+                "model TEXT, text TEXT, vector BLOB, created REAL, PRIMARY KEY (model, text))"
+            )
+            # Expired rows would never be read again, so drop them on startup
+            self.connection.execute("DELETE FROM embeddings WHERE created <= ?", (time.time() - self.ttl,))
+        return self.connection
+
+    def get(self, text, model):
+        key = (model, normalize_query(text))
+
+        with self.lock:
+            embedding = self.memory.get(key)
+            if embedding is None and self.db is not None:
+                embedding = self._read(key)
+                if embedding is not None:
+                    self.memory[key] = embedding
+
+            if embedding is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return embedding
+
+    def set(self, text, model, embedding):
+        key = (model, normalize_query(text))
+
+        with self.lock:
+            self.memory[key] = embedding
+            if self.db is not None:
+                self._write(key, embedding)
+
+    def _read(self, key):
+        row = self.db.execute(
+            "SELECT vector FROM embeddings WHERE model = ? AND text = ? AND created > ?",
+            (key[0], key[1], time.time() - self.ttl)
+        ).fetchone()
+        if row is None:
+            return None
+        return np.frombuffer(row[0], dtype=np.float32).tolist()
+
+    def _write(self, key, embedding):
+        try:
+            self.db.execute(
+                "INSERT OR REPLACE INTO embeddings (model, text, vector, created) VALUES (?, ?, ?, ?)",
+                (key[0], key[1], np.asarray(embedding, dtype=np.float32).tobytes(), time.time())
+            )
+        except sqlite3.Error:
+            # Persistence is best effort; the in-memory entry is already stored
+            logger.exception("Error persisting cached embedding")
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                'size': len(self.memory),
+                'maxsize': self.memory.maxsize,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / total if total else 0.0,
+            }
+
+
+RESULT_CACHE_SIZE = int(os.getenv("RESULT_CACHE_SIZE", 10000))
+RESULT_CACHE_TTL = float(os.getenv("RESULT_CACHE_TTL", 300))
+DOCUMENT_CACHE_SIZE = int(os.getenv("DOCUMENT_CACHE_SIZE", 20000))
+# Bounds staleness for writes no index watcher reports (INDEX_SYNC_ENABLED=false)
+DOCUMENT_CACHE_TTL = float(os.getenv("DOCUMENT_CACHE_TTL", 300))
+
+
+def freeze(value):
+    """Hashable form of request parameters (lists, dicts, None) for use in a cache key."""
+    if isinstance(value, dict):
+        return tuple(sorted((key, freeze(item)) for key, item in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(item) for item in value)
+    return value
+
+
+class ResultCache:
+    """
+    Bounded LRU cache of rankings with a TTL.
+
+    Keys include the version of the indexes a ranking was read from, so any
+    write to an index makes its older entries unreachable; they simply age out.
+    """
+
+    def __init__(self, maxsize=RESULT_CACHE_SIZE, ttl=RESULT_CACHE_TTL):
+        self.memory = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(query, version, **options):
+        return (normalize_query(query), version, freeze(options))
+
+    def get(self, key):
+        with self.lock:
+            value = self.memory.get(key)
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.memory[key] = value
+
+    def clear(self):
+        with self.lock:
+            self.memory.clear()
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                'size': len(self.memory),
+                'maxsize': self.memory.maxsize,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / total if total else 0.0,
+            }
+
+
+class DocumentCache:
+    """
+    Documents of one collection serialized to JSON bytes, keyed by id and projection.
+
+    A response is assembled by joining the cached bytes, so a repeated result
+    is neither fetched nor serialized again. Writers call `invalidate` with the
+    ids they changed; a fetch that raced an invalidation is not cached.
+    """
+
+    def __init__(self, maxsize=DOCUMENT_CACHE_SIZE, ttl=DOCUMENT_CACHE_TTL):
+        self.memory = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.lock = threading.Lock()
+        self.generation = 0
+
+    def render(self, ids, fetch, fields=None):
+        """
+        JSON array of the documents for `ids`, in that order. Uncached documents are
+        fetched with `fetch(ids, fields)`; ids it does not return are left out.
+        """
+        projection = freeze(fields)
+        with self.lock:
+            generation = self.generation
+            cached = {}
+            for document_id in ids:
+                entry = self.memory.get(document_id)
+                if entry is not None and projection in entry:
+                    cached[document_id] = entry[projection]
+
+        missing = [document_id for document_id in ids if document_id not in cached]
+        if missing:
+            fetched = {document['_id']: json_util.dumps(document).encode() for document in fetch(missing, fields)}
+            cached.update(fetched)
+            with self.lock:
+                if generation == self.generation:
+                    for document_id, body in fetched.items():
+                        entry = self.memory.get(document_id) or {}
+                        entry[projection] = body
+                        self.memory[document_id] = entry
+
+        return b'[' + b', '.join(cached[document_id] for document_id in ids if document_id in cached) + b']'
+
+    def invalidate(self, document_id):
+        with self.lock:
+            self.generation += 1
+            self.memory.pop(document_id, None)
+
+    def clear(self):
+        with self.lock:
+            self.generation += 1
+            self.memory.clear()
+
+    def __len__(self):
+        return len(self.memory)
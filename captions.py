@@ -0,0 +1,216 @@
+"""
+Bulk captioning of listing photos.
+
+    python captions.py            # caption every inventory whose photos changed
+
+Each inventory's photos are captioned by the chat model and the captions are
+stored on the inventory as `image_caption`, which is part of the embedded
+inventory text (INVENTORY_TEXT_FIELDS). A following /full_batch_embedding run
+re-embeds exactly the inventories whose captions changed.
+
+Captions are cached in the `image_captions` collection by URL, together with
+the image's ETag and content hash. A cached URL is trusted for
+CAPTION_REVALIDATE_SECONDS, then revalidated with a conditional request; an
+image that is unchanged (304, or the same bytes) keeps its caption without
+another model call.
+"""
+import base64
+import datetime
+import hashlib
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from pymongo import UpdateOne
+
+import telemetry
+from resources import lazy_collection
+from sync import touch
+from utils import IMAGE_POOL_SIZE, download_image, downscale_image, extract_text_from_image, iter_chunks
+
+
+logger = logging.getLogger(__name__)
+
+CAPTION_CHUNK_SIZE = int(os.getenv("CAPTION_CHUNK_SIZE", 50))
+# Images downloaded and captioned at once; the HTTP pool is sized to match by default
+CAPTION_CONCURRENCY = int(os.getenv("CAPTION_CONCURRENCY", IMAGE_POOL_SIZE))
+# Only the first few photos of a listing are captioned
+CAPTION_MAX_IMAGES = int(os.getenv("CAPTION_MAX_IMAGES", 3))
+# Cloudinary URLs are versioned, so cached captions are only revalidated occasionally
+CAPTION_REVALIDATE_SECONDS = float(os.getenv("CAPTION_REVALIDATE_SECONDS", 30 * 24 * 3600))
+
+
+def utcnow():
+    return datetime.datetime.utcnow()
+
+
+def caption_image(content):
+    """Caption raw image bytes, downscaled first since the model only looks at a low-detail version."""
+    return extract_text_from_image(base64.b64encode(downscale_image(content)).decode('utf-8'))
+
+
+class CaptionPipeline:
+    """
+    Captions the photos of every inventory in a collection.
+
+    Inventories are visited in `_id` order, one chunk at a time, and the
+    distinct photo URLs of a chunk are captioned by `concurrency` threads.
+    Every photo goes through the caption cache, so changed images are found
+    by revalidation; inventories whose captions come out unchanged are
+    skipped without a write. The pipeline reports progress and a resumable
+    checkpoint the same way as EmbeddingPipeline, so it runs under a JobRunner.
+    """
+
+    def __init__(self, collection, cache_collection, caption=caption_image, chunk_size=CAPTION_CHUNK_SIZE,
+                 concurrency=CAPTION_CONCURRENCY, max_images=CAPTION_MAX_IMAGES, revalidate_seconds=CAPTION_REVALIDATE_SECONDS):
+        self.collection = collection
+        self.cache = cache_collection
+        self.caption = caption
+        self.chunk_size = chunk_size
+        self.concurrency = concurrency
+        self.max_images = max_images
+        self.revalidate_seconds = revalidate_seconds
+        self.lock = threading.Lock()
+        self.updated = 0
+        self.errors = 0
+        self.skipped = 0
+        self.checkpoint = None
+        self.downloaded = 0
+        self.captioned = 0
+
+    def image_urls(self, inventory):
+        return [url for url in inventory.get('images') or [] if isinstance(url, str) and url][:self.max_images]
+
+    def caption_url(self, url):
+        """Return the caption of the image at `url`, from the cache when the image is unchanged, or None."""
+        cached = self.cache.find_one({'_id': url})
+        if cached and cached.get('checked_at') and (utcnow() - cached['checked_at']).total_seconds() < self.revalidate_seconds:
+            return cached['caption']
+
+        with telemetry.stage('image_download'):
+            result = download_image(url, etag=cached.get('etag') if cached else None)
+        if result is None:
+            # Keep serving the last good caption while the image is unreachable
+            return cached['caption'] if cached else None
+        content, etag = result
+
+        if content is None:
+            # 304 Not Modified
+            self.cache.update_one({'_id': url}, {'$set': {'checked_at': utcnow()}})
+            return cached['caption']
+
+        with self.lock:
+            self.downloaded += 1
+        content_hash = hashlib.sha256(content).hexdigest()
+        if cached and cached.get('content_hash') == content_hash:
+            self.cache.update_one({'_id': url}, {'$set': {'etag': etag, 'checked_at': utcnow()}})
+            return cached['caption']
+
+        with telemetry.stage('image_caption'):
+            caption = self.caption(content)
+        if not caption:
+            return None
+        with self.lock:
+            self.captioned += 1
+
+        self.cache.update_one({'_id': url}, {'$set': {
+            'caption': caption,
+            'etag': etag,
+            'content_hash': content_hash,
+            'checked_at': utcnow(),
+        }}, upsert=True)
+        return caption
+
+    def process_chunk(self, chunk, executor):
+        updated = 0
+        errors = 0
+        skipped = 0
+
+        try:
+            pending = []
+            for inventory in chunk:
+                urls = self.image_urls(inventory)
+                if not urls:
+                    skipped += 1
+                else:
+                    pending.append((inventory, urls))
+
+            distinct_urls = list(dict.fromkeys(url for _, urls in pending for url in urls))
+            captions = dict(zip(distinct_urls, executor.map(self.caption_url, distinct_urls)))
+
+            operations = []
+            for inventory, urls in pending:
+                if any(captions[url] is None for url in urls):
+                    # Left as is, so the next run retries it
+                    errors += 1
+                    continue
+                caption = ' '.join(captions[url] for url in urls)
+                if caption == inventory.get('image_caption') and urls == inventory.get('image_caption_urls'):
+                    # Unchanged: no write, so the inventory is not re-embedded either
+                    skipped += 1
+                    continue
+                operations.append(UpdateOne({'_id': inventory['_id']}, touch({'$set': {
+                    'image_caption': caption,
+                    'image_caption_urls': urls,
+                }})))
+
+            if operations:
+                self.collection.bulk_write(operations, ordered=False)
+            updated += len(operations)
+
+        except Exception:
+            logger.exception("Error captioning chunk", extra={'first_id': str(chunk[0]['_id'])})
+            errors = len(chunk)
+            updated = 0
+            skipped = 0
+
+        telemetry.count_batch('captions', self.collection.name, updated, skipped, errors)
+
+        with self.lock:
+            self.updated += updated
+            self.errors += errors
+            self.skipped += skipped
+
+    def run(self, query=None, on_progress=None):
+        """Caption the photos of every inventory matching `query` and return statistics."""
+        started = time.monotonic()
+        base_query = {'images.0': {'$exists': True}}
+        query = {'$and': [base_query, query]} if query else base_query
+        cursor = self.collection.find(query, {'images': 1, 'image_caption': 1, 'image_caption_urls': 1}).sort('_id', 1)
+
+        with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="caption-pipeline") as executor:
+            for chunk in iter_chunks(cursor, self.chunk_size):
+                self.process_chunk(chunk, executor)
+                self.checkpoint = chunk[-1]['_id']
+                if on_progress is not None:
+                    on_progress({
+                        'updated': self.updated,
+                        'errors': self.errors,
+                        'skipped': self.skipped,
+                        'checkpoint': self.checkpoint,
+                    })
+
+        elapsed = time.monotonic() - started
+        processed = self.updated + self.errors + self.skipped
+        return {
+            'processed': processed,
+            'updated': self.updated,
+            'errors': self.errors,
+            'skipped': self.skipped,
+            'checkpoint': self.checkpoint,
+            'images_downloaded': self.downloaded,
+            'images_captioned': self.captioned,
+            'seconds': round(elapsed, 3),
+            'docs_per_second': round(processed / elapsed, 2) if elapsed else 0.0,
+        }
+
+
+def main():
+    stats = CaptionPipeline(lazy_collection('inventories'), lazy_collection('image_captions')).run()
+    print(stats)
+
+
+if __name__ == '__main__':
+    main()
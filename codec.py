@@ -0,0 +1,67 @@
+import os
+
+import numpy as np
+from bson.binary import Binary
+
+
+# How new embeddings are written to MongoDB: list (array of doubles), float16 or int8
+EMBEDDING_ENCODING = os.getenv("EMBEDDING_ENCODING", "list")
+ENCODINGS = ['list', 'float16', 'int8']
+
+# User-defined BSON binary subtypes identify the packed layout
+FLOAT16_SUBTYPE = 128
+INT8_SUBTYPE = 129
+
+
+def encode_embedding(embedding, encoding=None):
+    """
+    Encode an embedding for storage.
+
+    float16 packs the vector as little-endian halves (2 bytes per dimension).
+    int8 stores a float32 scale followed by the vector quantized to [-127, 127]
+    (1 byte per dimension). Both are 4-8x smaller than an array of doubles.
+    """
+    encoding = encoding or EMBEDDING_ENCODING
+
+    if encoding == 'list':
+        return [float(value) for value in embedding]
+
+    vector = np.asarray(embedding, dtype=np.float32)
+
+    if encoding == 'float16':
+        return Binary(vector.astype('<f2').tobytes(), FLOAT16_SUBTYPE)
+
+    if encoding == 'int8':
+        scale = float(np.abs(vector).max()) / 127 or 1.0
+        quantized = np.clip(np.rint(vector / scale), -127, 127).astype(np.int8)
+        return Binary(np.float32(scale).astype('<f4').tobytes() + quantized.tobytes(), INT8_SUBTYPE)
+
+    raise ValueError(f"Unknown embedding encoding: {encoding}")
+
+
+def embedding_encoding(value):
+    """Name of the encoding `value` was stored with."""
+    if isinstance(value, Binary):
+        if value.subtype == FLOAT16_SUBTYPE:
+            return 'float16'
+        if value.subtype == INT8_SUBTYPE:
+            return 'int8'
+        raise ValueError(f"Unknown embedding binary subtype: {value.subtype}")
+    return 'list'
+
+
+def decode_embedding(value):
+    """
+    Decode a stored embedding into a NumPy array.
+    Packed encodings are read straight from the BSON buffer with `np.frombuffer`.
+    """
+    encoding = embedding_encoding(value)
+
+    if encoding == 'float16':
+        return np.frombuffer(value, dtype='<f2')
+
+    if encoding == 'int8':
+        scale = np.frombuffer(value, dtype='<f4', count=1)[0]
+        return np.frombuffer(value, dtype=np.int8, offset=4).astype(np.float32) * scale
+
+    return np.asarray(value, dtype=np.float32)
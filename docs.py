@@ -92,10 +92,57 @@ SWAGGER_TEMPLATE = {
                 }
             }
         },
+  "/search/batch": {
+    "post": {
+      "summary": "Search for many queries at once",
+      "description": "Embeds all queries with one request and scores them with one matrix product. Returns the top products for each query, in request order.",
+      "consumes": ["application/json"],
+      "parameters": [
+        {
+          "name": "body",
+          "in": "body",
+          "required": True,
+          "schema": {
+            "type": "object",
+            "properties": {
+              "queries": {"type": "array", "items": {"type": "string"}, "example": ["iphone", "sneakers"]},
+              "fields": {"type": "string", "description": "Comma separated list of fields to return for each product."},
+              "mode": {"type": "string", "enum": ["exact", "ann", "two_stage"]},
+              "k": {"type": "integer", "description": "Number of products per query (default 5)."},
+              "offset": {"type": "integer", "description": "Number of top products to skip, for pagination."},
+              "min_price": {"type": "number"},
+              "max_price": {"type": "number"},
+              "currency": {"type": "array", "items": {"type": "string"}, "example": ["NGN"]},
+              "owner": {"type": "array", "items": {"type": "string"}, "description": "Owner ObjectIds."},
+              "category": {"type": "array", "items": {"type": "string"}}
+            },
+            "required": ["queries"]
+          }
+        }
+      ],
+      "responses": {
+        "200": {
+          "description": "One entry per query with its ranked products",
+          "schema": {
+            "type": "array",
+            "items": {
+              "type": "object",
+              "properties": {
+                "query": {"type": "string"},
+                "results": {"type": "array", "items": {"type": "object"}}
+              }
+            }
+          }
+        },
+        "400": {"description": "Invalid input"},
+        "500": {"description": "Internal server error"}
+      }
+    }
+  },
   "/search": {
     "post": {
       "summary": "Search for products",
-      "description": "Returns a list of products matching the search query.",
+      "description": "Returns a list of products matching the search query. Semantic (embedding) and keyword (BM25) rankings are fused; queries that exactly match product titles are answered from the keyword index alone.",
       "parameters": [
         {
           "name": "query",
@@ -103,11 +150,90 @@ SWAGGER_TEMPLATE = {
           "required": True,
           "type": "string",
           "description": "The search term to look for in the inventory."
+        },
+        {
+          "name": "fields",
+          "in": "formData",
+          "required": False,
+          "type": "string",
+          "description": "Comma separated list of fields to return for each product (e.g. title,price,images). Defaults to all fields."
+        },
+        {
+          "name": "mode",
+          "in": "formData",
+          "required": False,
+          "type": "string",
+          "enum": ["exact", "ann", "two_stage"],
+          "description": "Scoring mode: exact brute force, approximate nearest neighbours (HNSW), or two_stage (a scan of truncated vectors whose shortlist is reranked exactly). Defaults to the server's SEARCH_MODE."
+        },
+        {
+          "name": "target",
+          "in": "formData",
+          "required": False,
+          "type": "string",
+          "enum": ["auto", "inventory", "vendor"],
+          "description": "What to search for. auto (the default) routes each query to products or vendor profiles by intent; the X-Search-Target response header says which was searched."
+        },
+        {
+          "name": "k",
+          "in": "formData",
+          "required": False,
+          "type": "integer",
+          "description": "Number of products to return (default 5, at most SEARCH_MAX_K)."
+        },
+        {
+          "name": "offset",
+          "in": "formData",
+          "required": False,
+          "type": "integer",
+          "description": "Number of top products to skip, for fetching the next page."
+        },
+        {
+          "name": "min_price",
+          "in": "formData",
+          "required": False,
+          "type": "number",
+          "description": "Only return products priced at or above this amount."
+        },
+        {
+          "name": "max_price",
+          "in": "formData",
+          "required": False,
+          "type": "number",
+          "description": "Only return products priced at or below this amount."
+        },
+        {
+          "name": "currency",
+          "in": "formData",
+          "required": False,
+          "type": "string",
+          "description": "Comma separated currencies to accept (e.g. NGN,USD)."
+        },
+        {
+          "name": "owner",
+          "in": "formData",
+          "required": False,
+          "type": "string",
+          "description": "Comma separated owner ObjectIds to accept."
+        },
+        {
+          "name": "category",
+          "in": "formData",
+          "required": False,
+          "type": "string",
+          "description": "Comma separated categories to accept."
+        },
+        {
+          "name": "If-None-Match",
+          "in": "header",
+          "required": False,
+          "type": "string",
+          "description": "ETag of a previous response; answered with 304 Not Modified while the results are unchanged."
         }
       ],
       "responses": {
         "200": {
-          "description": "A successful response",
+          "description": "A successful response. The ETag header identifies the results for conditional requests.",
           "schema": {
             "type": "array",
             "items": {
@@ -188,6 +314,9 @@ SWAGGER_TEMPLATE = {
             }
           ]
         },
+        "304": {
+          "description": "The results match the If-None-Match ETag; no body is sent"
+        },
         "400": {
           "description": "Invalid input",
           "schema": {
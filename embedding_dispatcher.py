@@ -0,0 +1,197 @@
+"""
+Cross-request batching of embedding calls.
+
+Concurrent requests hand their texts to one EmbeddingDispatcher per process
+instead of each calling the provider:
+
+- identical texts already queued or in flight share one result (single-flight)
+- distinct texts arriving within EMBEDDING_BATCH_WINDOW_MS are sent as one
+  `embed_documents` request of at most EMBEDDING_BATCH_MAX texts
+- at most EMBEDDING_MAX_CONCURRENCY requests run at once; a rate-limit
+  response halves that limit and pauses every request for the server's
+  Retry-After (or an exponential backoff), and the limit grows back one step
+  per round of successful requests
+
+Under load, batches fill up while requests wait for a free slot, so fewer
+and larger requests are sent exactly when the quota is tight.
+"""
+import collections
+import logging
+import os
+import random
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+
+logger = logging.getLogger(__name__)
+
+EMBEDDING_DISPATCH = os.getenv("EMBEDDING_DISPATCH", "true").lower() == "true"
+# How long the first text of a batch waits for others to join it
+EMBEDDING_BATCH_WINDOW_MS = float(os.getenv("EMBEDDING_BATCH_WINDOW_MS", 5))
+EMBEDDING_BATCH_MAX = int(os.getenv("EMBEDDING_BATCH_MAX", 64))
+EMBEDDING_MAX_CONCURRENCY = int(os.getenv("EMBEDDING_MAX_CONCURRENCY", 8))
+# Rate-limited batches are retried this many times before their callers get the error
+EMBEDDING_MAX_RETRIES = int(os.getenv("EMBEDDING_MAX_RETRIES", 5))
+EMBEDDING_BACKOFF = float(os.getenv("EMBEDDING_BACKOFF", 0.5))
+EMBEDDING_MAX_BACKOFF = float(os.getenv("EMBEDDING_MAX_BACKOFF", 30))
+# Longest a caller waits for its embedding, queueing and retries included
+EMBEDDING_DISPATCH_TIMEOUT = float(os.getenv("EMBEDDING_DISPATCH_TIMEOUT", 60))
+
+
+def is_rate_limited(error):
+    """Whether `error` is a rate-limit (HTTP 429) response, e.g. openai.RateLimitError."""
+    return getattr(error, 'status_code', None) == 429 or type(error).__name__ == 'RateLimitError'
+
+
+def retry_after(error):
+    """Seconds the server asked us to wait (the Retry-After header), or None."""
+    headers = getattr(getattr(error, 'response', None), 'headers', None) or {}
+    try:
+        return float(headers.get('retry-after'))
+    except (TypeError, ValueError):
+        return None
+
+
+class EmbeddingDispatcher:
+    """
+    Collects texts from every thread and embeds them in batches on a pool of
+    `max_concurrency` threads. `submit` returns one Future per text.
+    """
+
+    def __init__(self, embed_documents, window=EMBEDDING_BATCH_WINDOW_MS / 1000, max_batch=EMBEDDING_BATCH_MAX,
+                 max_concurrency=EMBEDDING_MAX_CONCURRENCY, max_retries=EMBEDDING_MAX_RETRIES,
+                 backoff=EMBEDDING_BACKOFF, max_backoff=EMBEDDING_MAX_BACKOFF):
+        self.embed_documents = embed_documents
+        self.window = window
+        self.max_batch = max_batch
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.condition = threading.Condition()
+        # Texts waiting for a batch, and rate-limited batches waiting to be retried
+        self.queue = collections.deque()
+        self.retries = collections.deque()
+        # One Future per distinct text, from submit until its batch finishes
+        self.futures = {}
+        self.limit = max_concurrency
+        self.active = 0
+        self.successes = 0
+        self.paused_until = 0.0
+        self.batches = 0
+        self.texts = 0
+        self.coalesced = 0
+        self.rate_limited = 0
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="embedding-dispatch")
+        self.thread = None
+
+    def submit(self, texts):
+        futures = []
+        with self.condition:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.dispatch, name="embedding-dispatcher", daemon=True)
+                self.thread.start()
+
+            for text in texts:
+                future = self.futures.get(text)
+                if future is None:
+                    future = self.futures[text] = Future()
+                    self.queue.append(text)
+                else:
+                    self.coalesced += 1
+                futures.append(future)
+            self.condition.notify_all()
+        return futures
+
+    def embed(self, text, timeout=EMBEDDING_DISPATCH_TIMEOUT):
+        return self.submit([text])[0].result(timeout)
+
+    def embed_many(self, texts, timeout=EMBEDDING_DISPATCH_TIMEOUT):
+        deadline = time.monotonic() + timeout
+        return [future.result(max(0.0, deadline - time.monotonic())) for future in self.submit(texts)]
+
+    def dispatch(self):
+        while True:
+            with self.condition:
+                while not self.queue and not self.retries:
+                    self.condition.wait()
+
+                # Give concurrent requests the window to join this batch
+                deadline = time.monotonic() + self.window
+                while not self.retries and len(self.queue) < self.max_batch:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.condition.wait(remaining)
+
+                # Wait out any rate-limit pause and for a free slot; the batch keeps filling meanwhile
+                while True:
+                    remaining = self.paused_until - time.monotonic()
+                    if remaining > 0:
+                        self.condition.wait(remaining)
+                    elif self.active >= self.limit:
+                        self.condition.wait()
+                    else:
+                        break
+
+                if self.retries:
+                    texts, attempt = self.retries.popleft()
+                else:
+                    texts, attempt = [self.queue.popleft() for _ in range(min(self.max_batch, len(self.queue)))], 0
+                self.active += 1
+
+            self.executor.submit(self.run_batch, texts, attempt)
+
+    def run_batch(self, texts, attempt):
+        error = None
+        try:
+            embeddings = self.embed_documents(texts)
+        except Exception as e:
+            error = e
+
+        with self.condition:
+            self.active -= 1
+            self.condition.notify_all()
+
+            if error is not None and is_rate_limited(error) and attempt < self.max_retries:
+                delay = retry_after(error) or min(self.max_backoff, self.backoff * 2 ** attempt) * random.uniform(0.5, 1.0)
+                self.paused_until = max(self.paused_until, time.monotonic() + delay)
+                self.limit = max(1, self.limit // 2)
+                self.successes = 0
+                self.rate_limited += 1
+                self.retries.append((texts, attempt + 1))
+                logger.warning("Embedding requests rate limited, backing off", extra={
+                    'delay': round(delay, 3), 'concurrency': self.limit, 'attempt': attempt + 1,
+                })
+                return
+
+            if error is None:
+                self.batches += 1
+                self.texts += len(texts)
+                self.successes += 1
+                # Additive increase: one more concurrent request per round of successes at the current limit
+                if self.limit < self.max_concurrency and self.successes >= self.limit:
+                    self.limit += 1
+                    self.successes = 0
+            futures = [self.futures.pop(text) for text in texts]
+
+        if error is not None:
+            logger.error("Error embedding batch", extra={'texts': len(texts), 'error': str(error)})
+            for future in futures:
+                future.set_exception(error)
+        else:
+            for future, embedding in zip(futures, embeddings):
+                future.set_result(embedding)
+
+    def stats(self):
+        with self.condition:
+            return {
+                'queued': len(self.queue) + sum(len(texts) for texts, _ in self.retries),
+                'active': self.active,
+                'limit': self.limit,
+                'batches': self.batches,
+                'texts': self.texts,
+                'coalesced': self.coalesced,
+                'rate_limited': self.rate_limited,
+            }
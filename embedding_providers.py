@@ -0,0 +1,128 @@
+"""
+Embedding backends, selected with EMBEDDING_PROVIDER.
+
+    openai   OpenAI embeddings (EMBEDDING_MODEL, text-embedding-3-small by default)
+    onnx     a sentence-embedding model run locally with onnxruntime
+
+A provider has a `model` attribute naming the model that produced its vectors
+and `embed_query(text)` / `embed_documents(texts)` methods returning lists of
+floats (the interface of langchain's embedding classes). `model` is stored
+next to every embedding and tags the in-memory indexes, so vectors of
+different models are never compared.
+
+The ONNX backend expects a directory (ONNX_MODEL_DIR) holding `model.onnx`
+and the model's `tokenizer.json`, e.g. a sentence-transformers model exported
+with `optimum-cli export onnx --model sentence-transformers/all-MiniLM-L6-v2 DIR`.
+Token embeddings are mean-pooled over the attention mask and L2-normalized.
+"""
+import os
+import threading
+
+import numpy as np
+from dotenv import load_dotenv
+
+
+load_dotenv()
+
+EMBEDDING_PROVIDER = os.getenv("EMBEDDING_PROVIDER", "openai")
+EMBEDDING_PROVIDERS = ['openai', 'onnx']
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "text-embedding-3-small")
+
+ONNX_MODEL_DIR = os.getenv("ONNX_MODEL_DIR")
+# Recorded as `onnx/<name>`; defaults to the model directory's name
+ONNX_MODEL_NAME = os.getenv("ONNX_MODEL_NAME")
+# Threads onnxruntime may use for one inference (0 lets it use every core)
+ONNX_THREADS = int(os.getenv("ONNX_THREADS", 0))
+# Texts encoded per inference call by embed_documents
+ONNX_BATCH_SIZE = int(os.getenv("ONNX_BATCH_SIZE", 32))
+ONNX_MAX_LENGTH = int(os.getenv("ONNX_MAX_LENGTH", 256))
+
+
+def configured_model(provider=None):
+    """Name of the model the configured provider embeds with, known without loading the provider."""
+    provider = provider or EMBEDDING_PROVIDER
+    if provider == 'onnx':
+        name = ONNX_MODEL_NAME or os.path.basename(os.path.normpath(ONNX_MODEL_DIR or 'onnx'))
+        return f"onnx/{name}"
+    return EMBEDDING_MODEL
+
+
+class OnnxEmbeddings:
+    """
+    Local sentence embeddings on the CPU.
+
+    embed_documents sorts the texts by length and encodes them `batch_size` at
+    a time, so each batch pads to similar lengths. The onnxruntime session is
+    shared by every thread; `threads` bounds the cores a single call uses.
+    """
+
+    def __init__(self, model_dir=ONNX_MODEL_DIR, model=None, threads=ONNX_THREADS, batch_size=ONNX_BATCH_SIZE, max_length=ONNX_MAX_LENGTH):
+        import onnxruntime
+        from tokenizers import Tokenizer
+
+        if not model_dir:
+            raise ValueError("ONNX_MODEL_DIR must point to a directory with model.onnx and tokenizer.json")
+
+        self.model = model or configured_model('onnx')
+        self.batch_size = batch_size
+
+        self.tokenizer = Tokenizer.from_file(os.path.join(model_dir, 'tokenizer.json'))
+        self.tokenizer.enable_truncation(max_length)
+        self.tokenizer.enable_padding()
+        self.tokenizer_lock = threading.Lock()
+
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = threads
+        options.inter_op_num_threads = 1
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = onnxruntime.InferenceSession(
+            os.path.join(model_dir, 'model.onnx'), options, providers=['CPUExecutionProvider']
+        )
+        self.input_names = [model_input.name for model_input in self.session.get_inputs()]
+
+    def _encode(self, texts):
+        # The tokenizer already spreads a batch over every core; concurrent calls would only contend
+        with self.tokenizer_lock:
+            encodings = self.tokenizer.encode_batch(list(texts))
+
+        attention_mask = np.asarray([encoding.attention_mask for encoding in encodings], dtype=np.int64)
+        feeds = {
+            'input_ids': np.asarray([encoding.ids for encoding in encodings], dtype=np.int64),
+            'attention_mask': attention_mask,
+            'token_type_ids': np.asarray([encoding.type_ids for encoding in encodings], dtype=np.int64),
+        }
+        output = self.session.run(None, {name: feeds[name] for name in self.input_names})[0]
+
+        if output.ndim == 3:
+            # Token embeddings: average the real (unpadded) tokens
+            mask = attention_mask[:, :, np.newaxis].astype(np.float32)
+            output = (output * mask).sum(axis=1) / np.maximum(mask.sum(axis=1), 1e-9)
+
+        norms = np.linalg.norm(output, axis=1, keepdims=True)
+        norms[norms == 0] = 1
+        return (output / norms).astype(np.float32)
+
+    def embed_documents(self, texts):
+        texts = [str(text) for text in texts]
+        order = sorted(range(len(texts)), key=lambda i: len(texts[i]))
+        vectors = [None] * len(texts)
+        for start in range(0, len(order), self.batch_size):
+            batch = order[start:start + self.batch_size]
+            for i, vector in zip(batch, self._encode([texts[i] for i in batch])):
+                vectors[i] = vector.tolist()
+        return vectors
+
+    def embed_query(self, text):
+        return self._encode([str(text)])[0].tolist()
+
+
+def create_provider(http_client=None, provider=None):
+    provider = provider or EMBEDDING_PROVIDER
+    if provider not in EMBEDDING_PROVIDERS:
+        raise ValueError(f"EMBEDDING_PROVIDER must be one of {', '.join(EMBEDDING_PROVIDERS)}")
+
+    if provider == 'onnx':
+        return OnnxEmbeddings()
+
+    from langchain_openai import OpenAIEmbeddings
+    return OpenAIEmbeddings(model=EMBEDDING_MODEL, http_client=http_client)
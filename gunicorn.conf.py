@@ -0,0 +1,15 @@
+# Loaded automatically by `gunicorn app:app` from the working directory
+
+
+def post_worker_init(worker):
+    # Background threads do not survive a fork, so each worker starts its own (also with --preload)
+    from app import ensure_background_tasks
+    ensure_background_tasks()
+
+
+def child_exit(server, worker):
+    # Drop a dead worker's live gauges from the shared Prometheus files (see telemetry.py)
+    import os
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,190 @@
+import datetime
+import logging
+import os
+import socket
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from bson.objectid import ObjectId
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+
+logger = logging.getLogger(__name__)
+
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", 1))
+# A running job whose heartbeat is older than this is assumed to belong to a dead worker
+JOB_STALE_SECONDS = float(os.getenv("JOB_STALE_SECONDS", 120))
+# How often a running job refreshes its heartbeat, whether or not its checkpoint moved
+JOB_HEARTBEAT_SECONDS = float(os.getenv("JOB_HEARTBEAT_SECONDS", JOB_STALE_SECONDS / 4))
+
+ACTIVE_STATUSES = ['queued', 'running']
+
+
+def utcnow():
+    return datetime.datetime.utcnow()
+
+
+class JobRunner:
+    """
+    Runs full-catalog embedding jobs on a background thread pool.
+
+    Jobs are stored in MongoDB with their counts and the last `_id` that was
+    fully processed. A job interrupted by a crash or restart is picked up
+    again by `resume_interrupted` and continues from that checkpoint. Claims
+    are atomic, so only one process runs a given job, and the running worker
+    refreshes `updated_at` every JOB_HEARTBEAT_SECONDS so a slow chunk is not
+    mistaken for a dead worker.
+
+    Queued and running jobs carry `active: True`, and a unique partial index on
+    it keeps every process to one active job per jobs collection.
+    """
+
+    def __init__(self, jobs_collection, target_collection, make_pipeline, workers=JOB_WORKERS):
+        self.jobs = jobs_collection
+        self.target = target_collection
+        self.make_pipeline = make_pipeline
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="embedding-job")
+        self.lock = threading.Lock()
+        self.indexed = False
+
+    @property
+    def worker_id(self):
+        # Read at claim time so workers forked from a preloaded app each report their own pid
+        return f"{socket.gethostname()}:{os.getpid()}"
+
+    def submit(self):
+        """Queue a new job, or return the one already active. Returns (job_id, created)."""
+        with self.lock:
+            if not self.indexed:
+                # Created on first use rather than at import, which must not touch the database
+                self.jobs.create_index('active', unique=True, partialFilterExpression={'active': {'$exists': True}})
+                self.indexed = True
+
+            active = self.jobs.find_one({'status': {'$in': ACTIVE_STATUSES}})
+            if active:
+                return active['_id'], False
+
+            try:
+                job_id = self.jobs.insert_one({
+                    'status': 'queued',
+                    'active': True,
+                    'total': self.target.estimated_document_count(),
+                    'updated': 0,
+                    'failed': 0,
+                    'skipped': 0,
+                    'created_at': utcnow(),
+                    'updated_at': utcnow(),
+                }).inserted_id
+            except DuplicateKeyError:
+                # Another process queued one between our check and insert
+                active = self.jobs.find_one({'active': True})
+                if active is None:
+                    raise
+                return active['_id'], False
+
+        self.executor.submit(self.run_job, job_id)
+        return job_id, True
+
+    def resume_interrupted(self):
+        """Queue every job left queued, or running with a stale heartbeat, by a previous process."""
+        stale = utcnow() - datetime.timedelta(seconds=JOB_STALE_SECONDS)
+        for job in self.jobs.find({'$or': [
+            {'status': 'queued'},
+            {'status': 'running', 'updated_at': {'$lt': stale}},
+        ]}, {'_id': 1}):
+            self.executor.submit(self.run_job, job['_id'])
+
+    def claim(self, job_id):
+        stale = utcnow() - datetime.timedelta(seconds=JOB_STALE_SECONDS)
+        return self.jobs.find_one_and_update(
+            {'_id': job_id, '$or': [
+                {'status': 'queued'},
+                {'status': 'running', 'updated_at': {'$lt': stale}},
+            ]},
+            {'$set': {'status': 'running', 'worker': self.worker_id, 'updated_at': utcnow()}},
+            return_document=ReturnDocument.AFTER
+        )
+
+    def heartbeat(self, job_id, worker_id, stopped):
+        while not stopped.wait(JOB_HEARTBEAT_SECONDS):
+            try:
+                self.jobs.update_one({'_id': job_id, 'status': 'running', 'worker': worker_id}, {'$set': {'updated_at': utcnow()}})
+            except Exception:
+                logger.exception("Error updating job heartbeat", extra={'job_id': str(job_id)})
+
+    def run_job(self, job_id):
+        job = self.claim(job_id)
+        if job is None:
+            # Another worker owns it, or it already finished
+            return
+
+        stopped = threading.Event()
+        threading.Thread(target=self.heartbeat, args=(job_id, job['worker'], stopped), name=f"job-heartbeat-{job_id}", daemon=True).start()
+
+        base_updated = job.get('updated', 0)
+        base_failed = job.get('failed', 0)
+        base_skipped = job.get('skipped', 0)
+        query = {'_id': {'$gt': job['last_id']}} if job.get('last_id') is not None else None
+
+        def on_progress(progress):
+            # $max keeps the record monotonic when chunks report out of order
+            counts = {
+                'updated': base_updated + progress['updated'],
+                'failed': base_failed + progress['errors'],
+                'skipped': base_skipped + progress['skipped'],
+            }
+            if progress['checkpoint'] is not None:
+                counts['last_id'] = progress['checkpoint']
+            self.jobs.update_one({'_id': job_id}, {'$max': counts, '$set': {'updated_at': utcnow()}})
+
+        try:
+            if not job.get('started_at'):
+                self.jobs.update_one({'_id': job_id}, {'$set': {'started_at': utcnow()}})
+            stats = self.make_pipeline().run(query=query, on_progress=on_progress)
+            on_progress(stats)
+            self.jobs.update_one({'_id': job_id}, {'$set': {
+                'status': 'completed',
+                'finished_at': utcnow(),
+                'updated_at': utcnow(),
+            }, '$unset': {'active': ''}})
+        except Exception as e:
+            logger.exception("Error running embedding job", extra={'job_id': str(job_id)})
+            self.jobs.update_one({'_id': job_id}, {'$set': {
+                'status': 'failed',
+                'error': str(e),
+                'updated_at': utcnow(),
+            }, '$unset': {'active': ''}})
+        finally:
+            stopped.set()
+
+    def status(self, job_id):
+        """Return a JSON-friendly progress report for `job_id`, or None if it does not exist."""
+        if not ObjectId.is_valid(job_id):
+            return None
+        job = self.jobs.find_one({'_id': ObjectId(job_id)})
+        if job is None:
+            return None
+
+        processed = job.get('updated', 0) + job.get('failed', 0) + job.get('skipped', 0)
+        started_at = job.get('started_at')
+        finished_at = job.get('finished_at') or utcnow()
+        elapsed = (finished_at - started_at).total_seconds() if started_at else 0
+        rate = processed / elapsed if elapsed > 0 else 0.0
+        remaining = max(job.get('total', 0) - processed, 0)
+
+        return {
+            'job_id': str(job['_id']),
+            'status': job['status'],
+            'total': job.get('total', 0),
+            'processed': processed,
+            'updated': job.get('updated', 0),
+            'failed': job.get('failed', 0),
+            'skipped': job.get('skipped', 0),
+            'docs_per_second': round(rate, 2),
+            'eta_seconds': round(remaining / rate, 1) if rate and job['status'] == 'running' else None,
+            'last_id': str(job['last_id']) if job.get('last_id') is not None else None,
+            'error': job.get('error'),
+            'created_at': job['created_at'].isoformat(),
+            'updated_at': job['updated_at'].isoformat(),
+        }
@@ -0,0 +1,257 @@
+import math
+import os
+import re
+import threading
+from collections import Counter
+
+import numpy as np
+
+from vector_index import top_k
+
+
+# Fields indexed for keyword search; title terms count `LEXICAL_TITLE_WEIGHT` times
+LEXICAL_FIELDS = ['title', 'description']
+LEXICAL_TITLE_WEIGHT = int(os.getenv("LEXICAL_TITLE_WEIGHT", 2))
+BM25_K1 = float(os.getenv("BM25_K1", 1.2))
+BM25_B = float(os.getenv("BM25_B", 0.75))
+# Damping constant of reciprocal-rank fusion; larger values flatten the gap between ranks
+RRF_K = int(os.getenv("RRF_K", 60))
+
+TOKEN_PATTERN = re.compile(r"\w+")
+
+
+def tokenize(text):
+    return TOKEN_PATTERN.findall(str(text).lower())
+
+
+def normalize_title(text):
+    """Case, punctuation and whitespace insensitive form of a title, used for exact matches."""
+    return ' '.join(tokenize(text))
+
+
+def reciprocal_rank_fusion(rankings, k=RRF_K):
+    """
+    Merge several ranked `(id, score)` lists into one, scoring each id by
+    the sum of 1 / (k + rank) over the lists it appears in.
+    """
+    scores = {}
+    for ranking in rankings:
+        for rank, (document_id, _) in enumerate(ranking, start=1):
+            scores[document_id] = scores.get(document_id, 0.0) + 1.0 / (k + rank)
+    return sorted(scores.items(), key=lambda item: item[1], reverse=True)
+
+
+class LexicalIndex:
+    """
+    In-process BM25 inverted index over inventory titles and descriptions.
+
+    Postings map each term to `{row: term frequency}`, and document lengths are
+    kept in an array indexed by row. A query only touches the postings of its
+    own terms, and the scores are accumulated with NumPy. Rows are updated in
+    place and freed rows are reused, the same way as in EmbeddingIndex.
+
+    Normalized titles are also kept in a map, so exact title matches can be
+    answered without scoring (or embedding) anything. `version` counts changes,
+    like EmbeddingIndex's.
+    """
+
+    def __init__(self, k1=BM25_K1, b=BM25_B, title_weight=LEXICAL_TITLE_WEIGHT):
+        self.k1 = k1
+        self.b = b
+        self.title_weight = title_weight
+        self.lock = threading.Lock()
+        self.load_lock = threading.Lock()
+        self._reset()
+        self.loaded = False
+        self.version = 0
+
+    def _reset(self):
+        self.postings = {}
+        self.row_terms = []
+        self.ids = np.empty(0, dtype=object)
+        self.lengths = np.zeros(0, dtype=np.float32)
+        self.positions = {}
+        self.free_rows = []
+        self.total_length = 0
+        self.titles = {}
+        self.row_titles = []
+
+    def __len__(self):
+        return len(self.positions)
+
+    def load(self, collection):
+        """(Re)build the index from every document in `collection`."""
+        with self.load_lock:
+            self._load(collection)
+
+    def ensure_loaded(self, collection):
+        if self.loaded:
+            return
+        with self.load_lock:
+            if not self.loaded:
+                self._load(collection)
+
+    def _load(self, collection):
+        projection = {field: 1 for field in LEXICAL_FIELDS}
+        # Built off to the side, so searches keep using the current postings for the whole scan
+        loaded = LexicalIndex(self.k1, self.b, self.title_weight)
+        for document in collection.find({}, projection):
+            loaded._add(document['_id'], document)
+
+        with self.lock:
+            self.postings = loaded.postings
+            self.row_terms = loaded.row_terms
+            self.ids = loaded.ids
+            self.lengths = loaded.lengths
+            self.positions = loaded.positions
+            self.free_rows = loaded.free_rows
+            self.total_length = loaded.total_length
+            self.titles = loaded.titles
+            self.row_titles = loaded.row_titles
+            self.loaded = True
+            self.version += 1
+
+    def _terms(self, document):
+        terms = Counter()
+        for field in LEXICAL_FIELDS:
+            tokens = tokenize(document.get(field) or '')
+            weight = self.title_weight if field == 'title' else 1
+            for token in tokens:
+                terms[token] += weight
+        return terms
+
+    def _add(self, document_id, document):
+        # Caller must hold self.lock
+        terms = self._terms(document)
+        if not terms:
+            return
+
+        if self.free_rows:
+            row = self.free_rows.pop()
+        else:
+            row = len(self.row_terms)
+            self.row_terms.append(None)
+            self.row_titles.append(None)
+            if row == len(self.lengths):
+                capacity = max(16, 2 * len(self.lengths))
+                ids = np.empty(capacity, dtype=object)
+                ids[:row] = self.ids[:row]
+                lengths = np.zeros(capacity, dtype=np.float32)
+                lengths[:row] = self.lengths[:row]
+                self.ids, self.lengths = ids, lengths
+
+        for term, frequency in terms.items():
+            self.postings.setdefault(term, {})[row] = frequency
+
+        title = normalize_title(document.get('title') or '')
+        if title:
+            self.titles.setdefault(title, {})[document_id] = True
+
+        length = sum(terms.values())
+        self.ids[row] = document_id
+        self.row_terms[row] = terms
+        self.row_titles[row] = title
+        self.lengths[row] = length
+        self.total_length += length
+        self.positions[document_id] = row
+
+    def _remove(self, document_id):
+        # Caller must hold self.lock
+        row = self.positions.pop(document_id, None)
+        if row is None:
+            return False
+
+        for term in self.row_terms[row]:
+            postings = self.postings[term]
+            del postings[row]
+            if not postings:
+                del self.postings[term]
+
+        title = self.row_titles[row]
+        if title:
+            del self.titles[title][document_id]
+            if not self.titles[title]:
+                del self.titles[title]
+
+        self.total_length -= int(self.lengths[row])
+        self.lengths[row] = 0
+        self.ids[row] = None
+        self.row_terms[row] = None
+        self.row_titles[row] = None
+        self.free_rows.append(row)
+        return True
+
+    def upsert(self, document_id, document):
+        """Index (or re-index) `document`, which must hold every field in LEXICAL_FIELDS it has."""
+        with self.lock:
+            self._remove(document_id)
+            self._add(document_id, document)
+            self.version += 1
+
+    def remove(self, document_id):
+        with self.lock:
+            removed = self._remove(document_id)
+            if removed:
+                self.version += 1
+            return removed
+
+    def exact_matches(self, query, allowed=None):
+        """Ids of documents whose normalized title equals the normalized query."""
+        title = normalize_title(query)
+        with self.lock:
+            matches = list(self.titles.get(title, ()))
+        if allowed is not None:
+            matches = [document_id for document_id in matches if document_id in allowed]
+        return matches
+
+    def search(self, query, k=5, offset=0, allowed=None):
+        """
+        Return up to `k` `(id, BM25 score)` pairs for `query`, best first, skipping
+        the first `offset`. `allowed` (a set of ids, or an EmbeddingIndex RowSet)
+        restricts the results.
+        """
+        terms = set(tokenize(query))
+
+        with self.lock:
+            count = len(self.positions)
+            if count == 0 or not terms:
+                return []
+            average_length = self.total_length / count
+            # Row-aligned columns, updated in place like EmbeddingIndex's
+            size = len(self.row_terms)
+            ids = self.ids
+            lengths = self.lengths[:size]
+            matched = [
+                (np.fromiter(self.postings[term].keys(), dtype=np.int64, count=len(self.postings[term])),
+                 np.fromiter(self.postings[term].values(), dtype=np.float32, count=len(self.postings[term])))
+                for term in terms if term in self.postings
+            ]
+
+        if not matched:
+            return []
+
+        scores = np.zeros(size, dtype=np.float32)
+        for rows, frequencies in matched:
+            idf = math.log(1 + (count - len(rows) + 0.5) / (len(rows) + 0.5))
+            norm = self.k1 * (1 - self.b + self.b * lengths[rows] / average_length)
+            # Each term has at most one posting per row, so plain fancy-index addition is safe
+            scores[rows] += idf * frequencies * (self.k1 + 1) / (frequencies + norm)
+
+        candidates = np.flatnonzero(scores > 0)
+        if allowed is None:
+            best = candidates[top_k(scores[candidates], offset + k)][offset:]
+            return [(ids[row], float(scores[row])) for row in best if ids[row] is not None]
+
+        # Test ids best first and stop once the page is full, instead of filtering every match
+        results = []
+        for row in candidates[np.argsort(-scores[candidates], kind='stable')]:
+            document_id = ids[row]
+            if document_id is not None and document_id in allowed:
+                results.append((document_id, float(scores[row])))
+                if len(results) == offset + k:
+                    break
+        return results[offset:]
+
+
+# Shared keyword index for the inventories collection
+inventory_lexical_index = LexicalIndex()
@@ -0,0 +1,60 @@
+"""
+Convert stored inventory embeddings to another encoding in bulk.
+
+    python migrate_embeddings.py --encoding float16
+    python migrate_embeddings.py --encoding int8 --batch-size 1000
+    python migrate_embeddings.py --encoding list      # back to arrays of doubles
+
+Documents already in the target encoding are left alone, so the command can
+be re-run safely after an interruption.
+"""
+import argparse
+
+from pymongo import UpdateOne
+
+import resources
+from codec import ENCODINGS, decode_embedding, embedding_encoding, encode_embedding
+from sync import touch
+
+
+def migrate(collection, encoding, batch_size):
+    converted = 0
+    skipped = 0
+    operations = []
+
+    for document in collection.find({'embedding': {'$exists': True}}, {'embedding': 1}).sort('_id', 1):
+        embedding = document.get('embedding')
+        if not embedding or embedding_encoding(embedding) == encoding:
+            skipped += 1
+            continue
+
+        operations.append(UpdateOne(
+            {'_id': document['_id']},
+            touch({'$set': {'embedding': encode_embedding(decode_embedding(embedding), encoding)}})
+        ))
+
+        if len(operations) == batch_size:
+            converted += collection.bulk_write(operations, ordered=False).modified_count
+            operations = []
+            print(f"Converted {converted} embeddings...")
+
+    if operations:
+        converted += collection.bulk_write(operations, ordered=False).modified_count
+
+    return converted, skipped
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--encoding', choices=ENCODINGS, required=True)
+    parser.add_argument('--batch-size', type=int, default=500)
+    args = parser.parse_args()
+
+    collection = resources.collection('inventories')
+
+    converted, skipped = migrate(collection, args.encoding, args.batch_size)
+    print(f"Converted {converted} embeddings to {args.encoding}, {skipped} already up to date.")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,141 @@
+"""
+Process-wide clients, created on first use.
+
+    python resources.py app asgi      # fail when importing a module exceeds IMPORT_TIME_BUDGET
+
+Importing this module connects nothing and imports no client library, so
+workers boot quickly and only pay for the clients they actually use. Every
+client exists once per process: MongoDB, the OpenAI chat model and the
+embedding provider (which share one pooled HTTP client when it is OpenAI).
+
+Instances are keyed by process id. A process forked after they were created
+(gunicorn --preload) builds its own on first use instead of sharing the
+parent's sockets and background threads.
+"""
+import argparse
+import os
+import subprocess
+import sys
+import threading
+
+from dotenv import load_dotenv
+
+
+load_dotenv()
+
+MONGODB_DATABASE = os.getenv("MONGODB_DATABASE", "cream-card")
+MONGO_MAX_POOL_SIZE = int(os.getenv("MONGO_MAX_POOL_SIZE", 100))
+MONGO_MIN_POOL_SIZE = int(os.getenv("MONGO_MIN_POOL_SIZE", 0))
+# Connections kept to the OpenAI API by the chat and embedding models together
+OPENAI_MAX_CONNECTIONS = int(os.getenv("OPENAI_MAX_CONNECTIONS", 50))
+OPENAI_MAX_KEEPALIVE = int(os.getenv("OPENAI_MAX_KEEPALIVE", 20))
+OPENAI_TIMEOUT = float(os.getenv("OPENAI_TIMEOUT", 30))
+# Seconds a worker may spend importing the app before `python resources.py` reports a failure
+IMPORT_TIME_BUDGET = float(os.getenv("IMPORT_TIME_BUDGET", 2.0))
+
+# Reentrant: factories may themselves ask for shared clients (the chat model needs the HTTP client)
+_lock = threading.RLock()
+_instances = {}
+_pid = os.getpid()
+
+
+def shared(name, factory):
+    """Return this process's instance of `name`, calling `factory()` to create it the first time."""
+    global _pid
+
+    instance = _instances.get(name)
+    if instance is not None and _pid == os.getpid():
+        return instance
+
+    with _lock:
+        if _pid != os.getpid():
+            # Forked: the parent's clients belong to the parent
+            _instances.clear()
+            _pid = os.getpid()
+        if name not in _instances:
+            _instances[name] = factory()
+        return _instances[name]
+
+
+class LazyResource:
+    """Stand-in for a shared object that resolves it (in the current process) on every attribute access."""
+
+    def __init__(self, resolve, name=None):
+        self._resolve = resolve
+        if name is not None:
+            self.name = name
+
+    def __getattr__(self, attribute):
+        return getattr(self._resolve(), attribute)
+
+
+def mongo_client():
+    def create():
+        from pymongo import MongoClient
+        # connect=False defers sockets and monitor threads to the first operation
+        return MongoClient(os.getenv("MONGODB_URL"), maxPoolSize=MONGO_MAX_POOL_SIZE, minPoolSize=MONGO_MIN_POOL_SIZE, connect=False)
+    return shared('mongo', create)
+
+
+def database():
+    return mongo_client()[MONGODB_DATABASE]
+
+
+def collection(name):
+    return database()[name]
+
+
+def lazy_collection(name):
+    """A collection handle that is safe to keep at module level, even across a fork."""
+    return LazyResource(lambda: collection(name), name=name)
+
+
+def http_client():
+    def create():
+        import httpx
+        return httpx.Client(
+            limits=httpx.Limits(max_connections=OPENAI_MAX_CONNECTIONS, max_keepalive_connections=OPENAI_MAX_KEEPALIVE),
+            timeout=OPENAI_TIMEOUT,
+        )
+    return shared('http', create)
+
+
+def chat_model(model):
+    def create():
+        from langchain_openai import ChatOpenAI
+        return ChatOpenAI(model=model, http_client=http_client())
+    return shared(f"chat:{model}", create)
+
+
+def embedding_model():
+    """The configured embedding provider (see embedding_providers.py)."""
+    def create():
+        from embedding_providers import EMBEDDING_PROVIDER, create_provider
+        return create_provider(http_client() if EMBEDDING_PROVIDER == 'openai' else None)
+    return shared('embeddings', create)
+
+
+def measure_import(module):
+    """Seconds taken to import `module` in a fresh interpreter."""
+    code = f"import time; started = time.perf_counter(); import {module}; print(time.perf_counter() - started)"
+    output = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True).stdout
+    return float(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('modules', nargs='*', default=['app'])
+    parser.add_argument('--budget', type=float, default=IMPORT_TIME_BUDGET, help="seconds allowed per module")
+    args = parser.parse_args()
+
+    over_budget = False
+    for module in args.modules:
+        seconds = measure_import(module)
+        over_budget = over_budget or seconds > args.budget
+        print(f"{module}: {seconds:.3f}s ({'over' if seconds > args.budget else 'within'} the {args.budget:.2f}s budget)")
+
+    sys.exit(1 if over_budget else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from cachetools import TTLCache
+
+from cache import normalize_query
+from vector_index import normalize
+
+
+logger = logging.getLogger(__name__)
+
+# Minimum gap between the two prototype similarities for a local decision
+ROUTER_MARGIN = float(os.getenv("ROUTER_MARGIN", 0.05))
+ROUTER_CACHE_SIZE = int(os.getenv("ROUTER_CACHE_SIZE", 50000))
+ROUTER_CACHE_TTL = float(os.getenv("ROUTER_CACHE_TTL", 24 * 3600))
+# Cap on background LLM lookups so a burst of ambiguous queries cannot queue up forever
+ROUTER_MAX_PENDING = int(os.getenv("ROUTER_MAX_PENDING", 100))
+
+DEFAULT_TARGET = 'is_inventory'
+
+PROTOTYPE_PHRASES = {
+    'is_inventory': [
+        "iphone 13 pro max",
+        "used laptop for sale",
+        "red sneakers size 42",
+        "fried chicken and chips",
+        "wedding dress",
+        "cheap phone charger",
+        "leather handbag",
+        "product price",
+    ],
+    'is_vendor': [
+        "vendor that sells shoes",
+        "find a seller near me",
+        "who sells phones",
+        "store owner profile",
+        "bakery shop",
+        "fashion designer business",
+        "trusted merchant",
+        "caterer for events",
+    ],
+}
+
+
+class IntentRouter:
+    """
+    Decides whether a query targets inventory or vendors without blocking search.
+
+    The query embedding (already needed for search) is compared with one
+    prototype vector per target. When the margin between the two is too small
+    the default target is used for the current request and the LLM is asked in
+    the background; its answer is cached for the next identical query.
+    """
+
+    def __init__(self, embed_documents, llm_classify, margin=ROUTER_MARGIN):
+        self.embed_documents = embed_documents
+        self.llm_classify = llm_classify
+        self.margin = margin
+        self.labels = list(PROTOTYPE_PHRASES)
+        self.prototypes = None
+        self.decisions = TTLCache(maxsize=ROUTER_CACHE_SIZE, ttl=ROUTER_CACHE_TTL)
+        self.pending = set()
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="intent-router")
+        self.prototypes_requested = False
+
+    def build_prototypes(self):
+        try:
+            prototypes = []
+            for label in self.labels:
+                vectors = np.asarray(self.embed_documents(PROTOTYPE_PHRASES[label]), dtype=np.float32)
+                vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+                prototypes.append(normalize(vectors.mean(axis=0)))
+            self.prototypes = np.vstack(prototypes)
+        except Exception:
+            logger.exception("Error building intent prototypes")
+            with self.lock:
+                self.prototypes_requested = False
+
+    def classify(self, query_embedding):
+        """Return (label, margin) from the prototype vectors, or (None, 0) if they are not ready."""
+        if self.prototypes is None:
+            with self.lock:
+                if not self.prototypes_requested:
+                    self.prototypes_requested = True
+                    self.executor.submit(self.build_prototypes)
+            return None, 0.0
+
+        scores = self.prototypes @ normalize(query_embedding)
+        order = np.argsort(-scores)
+        return self.labels[order[0]], float(scores[order[0]] - scores[order[1]])
+
+    def ask_llm(self, key, query):
+        try:
+            label = self.llm_classify(query)
+            with self.lock:
+                self.decisions[key] = label
+        except Exception:
+            logger.exception("Error routing query with the LLM")
+        finally:
+            with self.lock:
+                self.pending.discard(key)
+
+    def settled(self, query):
+        """Whether `query` has a lasting decision (rather than the default while the LLM is asked)."""
+        with self.lock:
+            return normalize_query(query) in self.decisions
+
+    def route(self, query, query_embedding):
+        key = normalize_query(query)
+
+        with self.lock:
+            cached = self.decisions.get(key)
+        if cached is not None:
+            return cached
+
+        label, margin = self.classify(query_embedding)
+        if label is not None and margin >= self.margin:
+            with self.lock:
+                self.decisions[key] = label
+            return label
+
+        # Unsure: answer now with the default and let the LLM settle it for next time
+        with self.lock:
+            if key not in self.pending and len(self.pending) < ROUTER_MAX_PENDING:
+                self.pending.add(key)
+                self.executor.submit(self.ask_llm, key, query)
+        return DEFAULT_TARGET
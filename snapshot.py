@@ -0,0 +1,181 @@
+"""
+Memory-mapped snapshots of the embedding index.
+
+    python snapshot.py                     # write SNAPSHOT_PATH from MongoDB
+    python snapshot.py --path /data/index --dtype float16
+
+A snapshot is a directory holding:
+
+- header.json: format version, snapshot time, row count, capacity, dim, dtype and embedding model
+- ids-<version>.npy: raw 12-byte ObjectIds (ids-<version>.pkl for other id types)
+- matrix-<version>.npy: normalized vectors plus spare zero rows for inserts
+- attributes-<version>.pkl: the filterable attribute columns, aligned with the ids
+
+Workers open a float32 matrix with `mmap_mode='c'`. The page cache is then
+shared by every gunicorn worker, and only rows a worker later modifies
+become private. A float16 matrix halves the file size, but it is upcast
+into private memory on load.
+"""
+import argparse
+import datetime
+import fcntl
+import glob
+import json
+import os
+import pickle
+
+import numpy as np
+from bson.objectid import ObjectId
+
+import resources
+from embedding_providers import configured_model
+from vector_index import EmbeddingIndex
+
+
+SNAPSHOT_PATH = os.getenv("SNAPSHOT_PATH")
+SNAPSHOT_DTYPE = os.getenv("SNAPSHOT_DTYPE", "float32")
+# Spare rows reserved for inserts, so new listings do not force a private copy of the matrix
+SNAPSHOT_HEADROOM = float(os.getenv("SNAPSHOT_HEADROOM", 0.1))
+# Running workers rewrite a snapshot older than this once their index has changed, so catch-up after a restart stays short
+SNAPSHOT_REFRESH_INTERVAL = float(os.getenv("SNAPSHOT_REFRESH_INTERVAL", 3600))
+
+FORMAT_VERSION = 2
+
+
+def exists(path):
+    return bool(path) and os.path.exists(os.path.join(path, 'header.json'))
+
+
+def write_snapshot(index, path, dtype=SNAPSHOT_DTYPE, headroom=SNAPSHOT_HEADROOM, older_than=None, created_at=None):
+    """
+    Write the live contents of `index` to `path` and return the header. With
+    `older_than` (seconds), a snapshot younger than that is kept and None returned.
+
+    `created_at` is where readers start catching up; an index just read from
+    MongoDB must pass the time the read started, since writes that landed
+    behind the cursor are not in it.
+    """
+    created_at = created_at or datetime.datetime.utcnow()
+    ids, matrix, attributes = index.snapshot(attributes=True)
+    if len(ids) == 0:
+        return None
+
+    os.makedirs(path, exist_ok=True)
+
+    # Several workers may snapshot at once; the lock keeps cleanup from deleting files another writer is about to publish
+    with open(os.path.join(path, '.lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        # Workers refreshing together: the first one through the lock does it for all
+        if older_than is not None and exists(path) and (created_at - read_header(path)['created_at']).total_seconds() < older_than:
+            return None
+        return _write(path, created_at, ids, matrix, attributes, dtype, headroom, index.model)
+
+
+def _write(path, created_at, ids, matrix, attributes, dtype, headroom, model):
+    version = f"{created_at.strftime('%Y%m%dT%H%M%S%f')}-{os.getpid()}"
+    capacity = len(ids) + int(len(ids) * headroom) + 1024
+
+    matrix_name = f"matrix-{version}.npy"
+    out = np.lib.format.open_memmap(os.path.join(path, matrix_name), mode='w+', dtype=dtype, shape=(capacity, matrix.shape[1]))
+    out[:len(ids)] = matrix
+    out.flush()
+    del out
+
+    if all(isinstance(document_id, ObjectId) for document_id in ids):
+        ids_name = f"ids-{version}.npy"
+        raw = b''.join(document_id.binary for document_id in ids)
+        np.save(os.path.join(path, ids_name), np.frombuffer(raw, dtype=np.uint8).reshape(-1, 12))
+    else:
+        ids_name = f"ids-{version}.pkl"
+        with open(os.path.join(path, ids_name), 'wb') as f:
+            pickle.dump(list(ids), f)
+
+    attributes_name = f"attributes-{version}.pkl"
+    with open(os.path.join(path, attributes_name), 'wb') as f:
+        pickle.dump(attributes, f)
+
+    header = {
+        'format': FORMAT_VERSION,
+        'version': version,
+        'created_at': created_at.isoformat(),
+        'count': len(ids),
+        'capacity': capacity,
+        'dim': int(matrix.shape[1]),
+        'model': model,
+        'dtype': dtype,
+        'ids': ids_name,
+        'matrix': matrix_name,
+        'attributes': attributes_name,
+    }
+
+    # Readers only ever follow header.json, so swapping it in publishes the new files atomically
+    header_tmp = os.path.join(path, f"header.json.{os.getpid()}")
+    with open(header_tmp, 'w') as f:
+        json.dump(header, f)
+    os.replace(header_tmp, os.path.join(path, 'header.json'))
+
+    # Workers that already mapped older files keep them alive until they exit
+    for stale in glob.glob(os.path.join(path, 'matrix-*')) + glob.glob(os.path.join(path, 'ids-*')) + glob.glob(os.path.join(path, 'attributes-*')):
+        if version not in os.path.basename(stale):
+            os.remove(stale)
+
+    return header
+
+
+def read_header(path):
+    with open(os.path.join(path, 'header.json')) as f:
+        header = json.load(f)
+
+    if header['format'] != FORMAT_VERSION:
+        raise ValueError(f"Unsupported snapshot format {header['format']}")
+
+    header['created_at'] = datetime.datetime.fromisoformat(header['created_at'])
+    return header
+
+
+def read_snapshot(path):
+    """
+    Return `(header, ids, matrix, attributes)` for the snapshot at `path`;
+    `matrix` includes the spare rows.
+    """
+    header = read_header(path)
+
+    ids_path = os.path.join(path, header['ids'])
+    if ids_path.endswith('.npy'):
+        raw = np.load(ids_path).tobytes()
+        ids = [ObjectId(raw[i:i + 12]) for i in range(0, len(raw), 12)]
+    else:
+        with open(ids_path, 'rb') as f:
+            ids = pickle.load(f)
+
+    if header['dtype'] == 'float32':
+        matrix = np.load(os.path.join(path, header['matrix']), mmap_mode='c')
+    else:
+        matrix = np.load(os.path.join(path, header['matrix'])).astype(np.float32)
+
+    with open(os.path.join(path, header['attributes']), 'rb') as f:
+        attributes = pickle.load(f)
+
+    return header, ids, matrix, attributes
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--path', help="snapshot directory (defaults to SNAPSHOT_PATH)")
+    parser.add_argument('--dtype', choices=['float32', 'float16'], default=SNAPSHOT_DTYPE)
+    args = parser.parse_args()
+
+    path = args.path or os.getenv("SNAPSHOT_PATH")
+    if not path:
+        parser.error("--path or SNAPSHOT_PATH is required")
+    collection = resources.collection('inventories')
+
+    index = EmbeddingIndex(model=configured_model())
+    loaded_at = datetime.datetime.utcnow()
+    index.load(collection)
+    header = write_snapshot(index, path, args.dtype, created_at=loaded_at)
+    print(json.dumps(header, indent=2) if header else "No embedded inventories found.")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,268 @@
+import datetime
+import logging
+import os
+import threading
+import time
+
+from pymongo.errors import OperationFailure, PyMongoError
+
+import snapshot
+from lexical_index import LEXICAL_FIELDS
+from telemetry import stage
+from vector_index import FILTER_FIELDS, embedding_model_of
+
+
+logger = logging.getLogger(__name__)
+
+# Field maintained by the backend on every inventory write (mongoose `timestamps`), and by ours through `touch`
+UPDATED_AT_FIELD = os.getenv("INDEX_SYNC_UPDATED_FIELD", "updatedAt")
+POLL_INTERVAL = float(os.getenv("INDEX_SYNC_POLL_INTERVAL", 5))
+# How often the polling fallback compares ids to pick up deletes
+RECONCILE_INTERVAL = float(os.getenv("INDEX_SYNC_RECONCILE_INTERVAL", 300))
+
+
+def touch(update):
+    """
+    `update` plus a server-side UPDATED_AT_FIELD stamp. Every write this service makes goes
+    through it, so polling watchers and snapshot catch-up in other workers see the change.
+    """
+    return dict(update, **{'$currentDate': {UPDATED_AT_FIELD: True}})
+
+
+# What the indexes need from a changed document: its vector, filterable attributes and text
+INDEX_PROJECTION = {field: 1 for field in ['embedding', 'embedding_model'] + FILTER_FIELDS + LEXICAL_FIELDS}
+
+
+class IndexWatcher(threading.Thread):
+    """
+    Keeps an EmbeddingIndex in sync with writes to a collection.
+
+    Uses a change stream when the deployment supports one (replica sets and
+    Atlas) and otherwise polls for documents whose `updatedAt` moved past the
+    last seen watermark. The resume point is taken before the initial load, so
+    writes racing the load are replayed instead of lost.
+
+    When `snapshot_path` holds a snapshot, the initial load maps it instead of
+    reading the collection and only catches up on documents changed since.
+    Once that snapshot is older than `snapshot_refresh_interval` and the index
+    has changed, the watcher rewrites it (0 disables the refresh).
+
+    An optional `lexical_index` (LexicalIndex) is kept in step from the same
+    stream of changes, and an optional `document_cache` (cache.DocumentCache)
+    drops every changed document, indexed fields or not.
+    """
+
+    def __init__(self, index, collection, poll_interval=POLL_INTERVAL, reconcile_interval=RECONCILE_INTERVAL, snapshot_path=snapshot.SNAPSHOT_PATH, lexical_index=None, document_cache=None, snapshot_refresh_interval=snapshot.SNAPSHOT_REFRESH_INTERVAL):
+        super().__init__(name=f"index-watcher-{collection.name}", daemon=True)
+        self.index = index
+        self.lexical_index = lexical_index
+        self.document_cache = document_cache
+        self.collection = collection
+        self.snapshot_path = snapshot_path
+        self.poll_interval = poll_interval
+        self.reconcile_interval = reconcile_interval
+        self.snapshot_refresh_interval = snapshot_refresh_interval
+        # Index version the snapshot was last read or written at, and when to look at its age again
+        self.snapshot_version = None
+        self.next_refresh = 0.0
+        self.stopped = threading.Event()
+
+    def stop(self):
+        self.stopped.set()
+
+    def run(self):
+        try:
+            self.watch_changes()
+        except OperationFailure as e:
+            # Standalone servers have no oplog to stream from
+            logger.info("Change streams unavailable, falling back to polling", extra={'reason': str(e)})
+            self.poll_changes()
+        except Exception:
+            logger.exception("Index watcher stopped")
+
+    def apply_document(self, document):
+        if self.document_cache is not None:
+            self.document_cache.invalidate(document['_id'])
+
+        embedding = document.get('embedding')
+        if embedding:
+            self.index.upsert(document['_id'], embedding, document, model=embedding_model_of(document))
+        else:
+            self.index.remove(document['_id'])
+
+        if self.lexical_index is not None:
+            self.lexical_index.upsert(document['_id'], document)
+
+    def apply_change(self, change):
+        operation = change['operationType']
+        document_id = change['documentKey']['_id']
+        if self.document_cache is not None and operation in ('delete', 'update'):
+            self.document_cache.invalidate(document_id)
+
+        if operation == 'delete':
+            self.index.remove(document_id)
+            if self.lexical_index is not None:
+                self.lexical_index.remove(document_id)
+        elif operation in ('insert', 'replace'):
+            self.apply_document(change['fullDocument'])
+        elif operation == 'update':
+            # Updates carry only the changed fields, so edits to unindexed fields never touch the index
+            description = change.get('updateDescription', {})
+            updated_fields = description.get('updatedFields', {})
+            removed_fields = description.get('removedFields', [])
+            if self.lexical_index is not None and any(field in updated_fields or field in removed_fields for field in LEXICAL_FIELDS):
+                # Re-tokenizing needs every text field, not just the ones that changed
+                document = self.collection.find_one({'_id': document_id}, {field: 1 for field in LEXICAL_FIELDS})
+                if document is not None:
+                    self.lexical_index.upsert(document_id, document)
+
+            if 'embedding' in updated_fields and document_id not in self.index:
+                # First vector for this document here (embedded by another worker or a job): the new row needs every filter field
+                document = self.collection.find_one({'_id': document_id}, INDEX_PROJECTION)
+                if document is not None:
+                    self.apply_document(document)
+                return
+            elif 'embedding' in updated_fields:
+                # The model is written with every embedding, but an unchanged value is not reported
+                model = updated_fields.get('embedding_model')
+                if model is None:
+                    document = self.collection.find_one({'_id': document_id}, {'embedding_model': 1})
+                    model = embedding_model_of(document or {})
+                self.index.upsert(document_id, updated_fields['embedding'], model=model)
+            elif 'embedding' in removed_fields:
+                self.index.remove(document_id)
+                return
+
+            changes = {field: updated_fields.get(field) for field in FILTER_FIELDS if field in updated_fields or field in removed_fields}
+            if changes:
+                self.index.update_attributes(document_id, changes)
+
+    @stage('index_load')
+    def initial_load(self):
+        self.load_vectors()
+        # Vector search is already up; a keyword index built by an earlier request is not scanned again
+        if self.lexical_index is not None:
+            self.lexical_index.ensure_loaded(self.collection)
+
+    def load_vectors(self):
+        stale = False
+        if snapshot.exists(self.snapshot_path):
+            try:
+                header, ids, matrix, attributes = snapshot.read_snapshot(self.snapshot_path)
+                if header.get('model') == self.index.model:
+                    self.index.load_arrays(ids, matrix, attributes)
+                    self.snapshot_version = self.index.version
+                    self.catch_up(header['created_at'])
+                    return
+                # Written for another embedding model; rebuilt below
+                logger.info("Ignoring index snapshot of another model", extra={'path': self.snapshot_path, 'model': header.get('model')})
+                stale = True
+            except Exception:
+                logger.exception("Error loading index snapshot, reading MongoDB instead", extra={'path': self.snapshot_path})
+                stale = True
+
+        loaded_at = datetime.datetime.utcnow()
+        self.index.load(self.collection)
+
+        # Let the next worker (or restart) boot from disk instead of a full collection read
+        if self.snapshot_path and (stale or not snapshot.exists(self.snapshot_path)):
+            try:
+                version = self.index.version
+                snapshot.write_snapshot(self.index, self.snapshot_path, created_at=loaded_at)
+                self.snapshot_version = version
+            except Exception:
+                logger.exception("Error writing index snapshot", extra={'path': self.snapshot_path})
+
+    def refresh_snapshot(self):
+        """Rewrite the snapshot if it is due; any worker may do it, and the header's age tells the others."""
+        now = time.monotonic()
+        if not self.snapshot_path or self.snapshot_refresh_interval <= 0 or now < self.next_refresh:
+            return
+        self.next_refresh = now + self.snapshot_refresh_interval
+
+        try:
+            if snapshot.exists(self.snapshot_path):
+                age = (datetime.datetime.utcnow() - snapshot.read_header(self.snapshot_path)['created_at']).total_seconds()
+                if age < self.snapshot_refresh_interval:
+                    # Possibly just written by another worker; look again when it comes due
+                    self.next_refresh = now + self.snapshot_refresh_interval - age
+                    return
+            if self.index.version == self.snapshot_version:
+                return
+
+            version = self.index.version
+            if snapshot.write_snapshot(self.index, self.snapshot_path, older_than=self.snapshot_refresh_interval):
+                logger.info("Refreshed index snapshot", extra={'path': self.snapshot_path, 'count': len(self.index)})
+            self.snapshot_version = version
+        except Exception:
+            logger.exception("Error refreshing index snapshot", extra={'path': self.snapshot_path})
+
+    def catch_up(self, since):
+        """Apply documents updated after `since`, then drop ids deleted since."""
+        since = since - datetime.timedelta(seconds=self.poll_interval)
+        for document in self.collection.find({UPDATED_AT_FIELD: {'$gte': since}}, INDEX_PROJECTION):
+            self.apply_document(document)
+        self.reconcile()
+
+    def watch_changes(self):
+        pipeline = [{'$match': {'operationType': {'$in': ['insert', 'update', 'replace', 'delete']}}}]
+
+        with self.collection.watch(pipeline, max_await_time_ms=1000) as stream:
+            self.initial_load()
+
+            while not self.stopped.is_set():
+                try:
+                    change = stream.try_next()
+                except PyMongoError:
+                    logger.exception("Error reading change stream")
+                    self.stopped.wait(self.poll_interval)
+                    continue
+
+                if change is not None:
+                    self.apply_change(change)
+                self.refresh_snapshot()
+
+    def poll_changes(self):
+        # Start slightly in the past to tolerate clock skew between us and the server
+        watermark = datetime.datetime.utcnow() - datetime.timedelta(seconds=self.poll_interval)
+        # The query includes the watermark itself; ids already applied at it are not applied again,
+        # so an idle collection leaves the index versions (and the caches keyed on them) alone
+        applied = set()
+        self.initial_load()
+        last_reconcile = datetime.datetime.utcnow()
+
+        while not self.stopped.wait(self.poll_interval):
+            try:
+                now = datetime.datetime.utcnow()
+                changed = self.collection.find(
+                    {UPDATED_AT_FIELD: {'$gte': watermark}},
+                    dict(INDEX_PROJECTION, **{UPDATED_AT_FIELD: 1})
+                )
+                for document in changed:
+                    updated_at = document.get(UPDATED_AT_FIELD) or watermark
+                    if updated_at == watermark and document['_id'] in applied:
+                        continue
+                    self.apply_document(document)
+                    if updated_at > watermark:
+                        watermark, applied = updated_at, set()
+                    if updated_at == watermark:
+                        applied.add(document['_id'])
+
+                if (now - last_reconcile).total_seconds() >= self.reconcile_interval:
+                    self.reconcile()
+                    last_reconcile = now
+            except PyMongoError:
+                logger.exception("Error polling for changes")
+            self.refresh_snapshot()
+
+    def reconcile(self):
+        """Drop indexed ids that no longer exist in the collection (polling cannot see deletes)."""
+        existing = {document['_id'] for document in self.collection.find({}, {'_id': 1})}
+        for index in [self.index, self.lexical_index]:
+            if index is None:
+                continue
+            with index.lock:
+                indexed = list(index.positions)
+            for document_id in indexed:
+                if document_id not in existing:
+                    index.remove(document_id)
@@ -0,0 +1,171 @@
+"""
+Stage timings, Prometheus metrics and structured logging.
+
+Search and indexing code wraps each stage in `stage(name)` (a context
+manager or a decorator). Its duration is recorded in the
+`safelink_stage_seconds` histogram and, during a request, in that request's
+timings, which the app returns as a `Server-Timing` header.
+
+Values that already live elsewhere (index sizes, cache hit counts) are
+registered with `register` and read when /metrics is scraped.
+
+With several gunicorn workers, set PROMETHEUS_MULTIPROC_DIR to an empty
+directory so /metrics aggregates the histograms and counters of every worker.
+"""
+import contextlib
+import contextvars
+import datetime
+import json
+import logging
+import os
+import time
+
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Histogram, generate_latest
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+# json (one object per line, for log shippers) or text (for reading in a terminal)
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")
+SERVER_TIMING = os.getenv("SERVER_TIMING", "true").lower() == "true"
+
+# Seconds; spans cache hits (sub-millisecond) to slow LLM and embedding calls
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+STAGE_SECONDS = Histogram(
+    'safelink_stage_seconds', "Time spent in each stage of search and indexing", ['stage'], buckets=LATENCY_BUCKETS
+)
+REQUEST_SECONDS = Histogram(
+    'safelink_request_seconds', "Request latency by endpoint and status code", ['endpoint', 'status'], buckets=LATENCY_BUCKETS
+)
+BATCH_DOCUMENTS = Counter(
+    'safelink_batch_documents', "Documents processed by batch pipelines, by outcome", ['pipeline', 'collection', 'result']
+)
+
+logger = logging.getLogger(__name__)
+
+_timings = contextvars.ContextVar('timings', default=None)
+
+
+def start_request():
+    """Begin collecting stage timings for the current request; returns the list they are appended to."""
+    timings = []
+    _timings.set(timings)
+    return timings
+
+
+@contextlib.contextmanager
+def stage(name):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        STAGE_SECONDS.labels(name).observe(elapsed)
+        timings = _timings.get()
+        if timings is not None:
+            timings.append((name, elapsed))
+
+
+def server_timing(timings, total=None):
+    """`Server-Timing` header value for `timings`; a stage that ran several times is reported once, summed."""
+    totals = {}
+    for name, seconds in timings:
+        totals[name] = totals.get(name, 0.0) + seconds
+    if total is not None:
+        totals['total'] = total
+    return ', '.join(f"{name};dur={1000 * seconds:.2f}" for name, seconds in totals.items())
+
+
+def observe_request(endpoint, status, seconds):
+    REQUEST_SECONDS.labels(endpoint, str(status)).observe(seconds)
+
+
+def count_batch(pipeline, collection, updated=0, skipped=0, failed=0):
+    for result, count in (('updated', updated), ('skipped', skipped), ('failed', failed)):
+        if count:
+            BATCH_DOCUMENTS.labels(pipeline, collection, result).inc(count)
+
+
+class CallbackCollector:
+    """Reads registered values when /metrics is scraped, so nothing has to be kept up to date."""
+
+    def __init__(self):
+        self.metrics = []
+
+    def add(self, name, documentation, callback, label=None, kind='gauge'):
+        self.metrics.append((name, documentation, callback, label, kind))
+
+    def collect(self):
+        for name, documentation, callback, label, kind in self.metrics:
+            family_type = CounterMetricFamily if kind == 'counter' else GaugeMetricFamily
+            family = family_type(name, documentation, labels=[label] if label else [])
+            try:
+                values = callback()
+            except Exception:
+                logger.exception("Error reading metric", extra={'metric': name})
+                continue
+            if label:
+                for label_value, value in values.items():
+                    family.add_metric([str(label_value)], value)
+            else:
+                family.add_metric([], values)
+            yield family
+
+
+callbacks = CallbackCollector()
+REGISTRY.register(callbacks)
+
+
+def register(name, documentation, callback, label=None, kind='gauge'):
+    """
+    Export `callback()` as metric `name`. With `label`, the callback returns
+    `{label value: number}`. `kind` is 'gauge' or 'counter' (monotonic totals).
+    """
+    callbacks.add(name, documentation, callback, label, kind)
+
+
+def render():
+    """The /metrics payload and its content type."""
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        from prometheus_client import multiprocess
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        registry.register(callbacks)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
+
+
+# Attributes every LogRecord has; anything else was passed in `extra` and is logged as a field
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime', 'taskName'}
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'time': datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES:
+                entry[key] = value
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+def configure_logging(level=LOG_LEVEL, log_format=LOG_FORMAT):
+    """Send this process's logs to stderr, unless the server (or a test) already set up the root logger."""
+    root = logging.getLogger()
+    if root.handlers:
+        return
+    handler = logging.StreamHandler()
+    if log_format == 'json':
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    root.addHandler(handler)
+    root.setLevel(level)
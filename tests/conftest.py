@@ -0,0 +1,14 @@
+import os
+import sys
+
+import mongomock
+import pytest
+
+
+# The service modules live at the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def collection():
+    return mongomock.MongoClient().db.inventories
@@ -0,0 +1,112 @@
+import threading
+
+import numpy as np
+import pytest
+
+from ann_index import HnswIndex
+from vector_index import EmbeddingIndex, recall_at_k
+
+
+def vectors(count, dim=16, seed=0):
+    return np.random.default_rng(seed).standard_normal((count, dim)).astype(np.float32)
+
+
+@pytest.fixture
+def index():
+    index = EmbeddingIndex()
+    for i, vector in enumerate(vectors(200)):
+        index.upsert(i, vector)
+    index.loaded = True
+    return index
+
+
+class SlowHnswIndex(HnswIndex):
+    """Holds the build open until `release` is set, so writes can land during it."""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.building = threading.Event()
+        self.release = threading.Event()
+
+    def on_load(self, ids, matrix):
+        self.building.set()
+        self.release.wait(5)
+        super().on_load(ids, matrix)
+
+
+def test_follows_the_exact_index(index):
+    ann = HnswIndex(path=None)
+    index.add_listener(ann)
+    assert len(ann) == len(index)
+
+    queries = vectors(20, seed=1)
+    expected = [[document_id for document_id, _ in index.search(query, k=5)] for query in queries]
+    found = [[document_id for document_id, _ in ann.search(query, k=5)] for query in queries]
+    assert recall_at_k(expected, found) >= 0.9
+
+    index.upsert('new', queries[0])
+    index.remove(0)
+    assert ann.search(queries[0], k=1)[0][0] == 'new'
+    assert len(ann) == len(index)
+
+
+def test_allowed_restricts_results(index):
+    ann = HnswIndex(path=None)
+    index.add_listener(ann)
+    results = ann.search(vectors(1, seed=1)[0], k=5, allowed={1, 2, 3})
+    assert {document_id for document_id, _ in results} == {1, 2, 3}
+    assert ann.search(vectors(1, seed=1)[0], k=5, allowed={'missing'}) == []
+
+
+def test_add_listener_is_idempotent(index):
+    ann = HnswIndex(path=None)
+    index.add_listener(ann)
+    index.add_listener(ann)
+    assert index.listeners == [ann]
+
+
+def test_writes_during_add_listener_build_are_replayed(index):
+    ann = SlowHnswIndex(path=None)
+    attaching = threading.Thread(target=index.add_listener, args=(ann,))
+    attaching.start()
+    ann.building.wait(5)
+
+    index.upsert('new', vectors(1, seed=2)[0])
+    index.remove(0)
+    ann.release.set()
+    attaching.join()
+
+    assert len(ann) == len(index)
+    assert ann.search(vectors(1, seed=2)[0], k=1)[0][0] == 'new'
+    assert index.listeners == [ann]
+
+
+def test_writes_during_reload_are_replayed(index):
+    ann = SlowHnswIndex(path=None)
+    ann.release.set()
+    index.add_listener(ann)
+    ann.release.clear()
+    ann.building.clear()
+
+    reloading = threading.Thread(target=index.load_arrays, args=index.snapshot())
+    reloading.start()
+    ann.building.wait(5)
+    index.upsert('new', vectors(1, seed=2)[0])
+    ann.release.set()
+    reloading.join()
+
+    assert len(ann) == len(index) == 201
+    assert ann.search(vectors(1, seed=2)[0], k=1)[0][0] == 'new'
+
+
+def test_saved_graph_is_reused_and_reconciled(index, tmp_path):
+    path = str(tmp_path / 'ann.bin')
+    first = HnswIndex(path=path)
+    index.add_listener(first)
+
+    index.remove(1)
+    index.upsert(2, vectors(1, seed=3)[0])
+    second = HnswIndex(path=path)
+    second.on_load(*index.snapshot())
+    assert len(second) == len(index)
+    assert second.search(vectors(1, seed=3)[0], k=1)[0][0] == 2
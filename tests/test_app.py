@@ -0,0 +1,115 @@
+import types
+
+import pytest
+from bson import json_util
+
+import app as service
+from cache import DocumentCache, ResultCache
+from lexical_index import LexicalIndex
+from vector_index import EmbeddingIndex
+
+
+QUERY_EMBEDDINGS = {
+    'footwear': [1.0, 0.0, 0.0],
+    'luggage': [0.0, 1.0, 0.0],
+}
+
+
+@pytest.fixture
+def search(monkeypatch, collection):
+    embedded = []
+
+    def generate_query_embedding(query):
+        embedded.append(query)
+        return QUERY_EMBEDDINGS[query]
+
+    # No index watchers or job resumption against a real database
+    monkeypatch.setattr(service, 'ensure_background_tasks', lambda: True)
+    monkeypatch.setattr(service, 'inventories_collection', collection)
+    monkeypatch.setattr(service, 'inventory_index', EmbeddingIndex())
+    monkeypatch.setattr(service, 'inventory_lexical_index', LexicalIndex())
+    monkeypatch.setattr(service, 'search_result_cache', ResultCache())
+    monkeypatch.setattr(service, 'inventory_document_cache', DocumentCache())
+    monkeypatch.setattr(service, 'generate_query_embedding', generate_query_embedding)
+
+    ids = collection.insert_many([
+        {'title': 'Red shoe', 'embedding': [1.0, 0.0, 0.0], 'price': 10, 'currency': 'USD'},
+        {'title': 'Blue shoe', 'embedding': [0.9, 0.1, 0.0], 'price': 50, 'currency': 'EUR'},
+        {'title': 'Leather bag', 'embedding': [0.0, 1.0, 0.0], 'price': 30, 'currency': 'USD'},
+    ]).inserted_ids
+    return types.SimpleNamespace(client=service.app.test_client(), ids=ids, embedded=embedded)
+
+
+def post(search, **form):
+    form.setdefault('target', 'inventory')
+    return search.client.post('/search', data=form)
+
+
+def titles(response):
+    return [document['title'] for document in json_util.loads(response.data)]
+
+
+def test_search_ranks_inventories_without_embeddings(search):
+    response = post(search, query='footwear', k='2')
+    assert response.status_code == 200
+    assert titles(response) == ['Red shoe', 'Blue shoe']
+    assert all('embedding' not in document for document in json_util.loads(response.data))
+
+
+def test_search_rejects_bad_requests(search):
+    assert post(search).status_code == 400
+    assert post(search, query='footwear', mode='bogus').status_code == 400
+    assert post(search, query='footwear', target='bogus').status_code == 400
+    assert search.embedded == []
+
+
+def test_search_returns_only_requested_fields(search):
+    response = post(search, query='luggage', k='1', fields='title, price')
+    assert json_util.loads(response.data) == [{'_id': search.ids[2], 'title': 'Leather bag', 'price': 30}]
+
+
+def test_search_filters_and_pages(search):
+    assert titles(post(search, query='footwear', currency='USD')) == ['Red shoe', 'Leather bag']
+    assert titles(post(search, query='footwear', min_price='20')) == ['Blue shoe', 'Leather bag']
+    assert titles(post(search, query='footwear', currency='USD', k='1', offset='1')) == ['Leather bag']
+
+    assert post(search, query='footwear', min_price='cheap').status_code == 400
+    assert post(search, query='footwear', owner='nope').status_code == 400
+    assert post(search, query='footwear', currency='USD', target='vendor').status_code == 400
+
+
+def test_exact_title_match_skips_the_embedding(search):
+    assert titles(post(search, query='red SHOE', k='1')) == ['Red shoe']
+    assert search.embedded == []
+
+
+def test_repeated_search_is_cached_until_the_index_changes(search):
+    # Loading the indexes bumps their versions, so warm them up first
+    post(search, query='luggage')
+    first = post(search, query='footwear', k='2')
+    assert post(search, query='Footwear ', k='2').data == first.data
+    assert search.embedded == ['luggage', 'footwear']
+
+    # The body's ETag lets a client revalidate without downloading it again
+    response = search.client.post('/search', data={'query': 'footwear', 'k': '2', 'target': 'inventory'}, headers={'If-None-Match': first.headers['ETag']})
+    assert response.status_code == 304 and response.data == b''
+
+    service.inventory_index.upsert(search.ids[2], [1.0, 0.0, 0.0])
+    assert 'Leather bag' in titles(post(search, query='footwear', k='2'))
+    assert search.embedded == ['luggage', 'footwear', 'footwear']
+
+
+def test_search_batch_accepts_json_and_form_bodies(search, monkeypatch):
+    monkeypatch.setattr(service, 'generate_query_embeddings', lambda queries: [QUERY_EMBEDDINGS[query] for query in queries])
+
+    response = search.client.post('/search/batch', json={'queries': ['footwear', 'luggage'], 'k': 1})
+    assert [(result['query'], [document['title'] for document in result['results']]) for result in json_util.loads(response.data)] == [
+        ('footwear', ['Red shoe']),
+        ('luggage', ['Leather bag']),
+    ]
+
+    response = search.client.post('/search/batch', data={'queries': ['footwear', 'luggage'], 'k': '1'})
+    assert [result['query'] for result in json_util.loads(response.data)] == ['footwear', 'luggage']
+
+    assert search.client.post('/search/batch', json={'queries': []}).status_code == 400
+    assert search.client.post('/search/batch', json={'queries': ['footwear'], 'mode': 'bogus'}).status_code == 400
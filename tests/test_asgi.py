@@ -0,0 +1,75 @@
+import types
+
+import numpy as np
+import pytest
+from fastapi.testclient import TestClient
+
+import asgi
+import utils
+from vector_index import EmbeddingIndex
+
+
+@pytest.fixture
+def client():
+    return TestClient(asgi.app)
+
+
+@pytest.fixture
+def vendors(monkeypatch, collection):
+    model = types.SimpleNamespace(model='test-model')
+    index = EmbeddingIndex()
+    embedded = []
+
+    async def generate_embedding(text):
+        embedded.append(text)
+        return np.ones(4, dtype=np.float32)
+
+    monkeypatch.setattr(utils, 'embedding_model', model)
+    monkeypatch.setattr(asgi, 'embedding_model', model)
+    monkeypatch.setattr(asgi, 'users_collection', collection)
+    monkeypatch.setattr(asgi, 'vendor_index', index)
+    monkeypatch.setattr(asgi, 'generate_embedding_async', generate_embedding)
+    return types.SimpleNamespace(collection=collection, index=index, embedded=embedded)
+
+
+def test_add_vendor_embeds_and_indexes(client, vendors):
+    user_id = vendors.collection.insert_one({'name': 'Ada', 'bio': 'Vintage cameras'}).inserted_id
+
+    response = client.post('/add_vendor_to_ai', data={'user_id': str(user_id)})
+    assert response.status_code == 200
+    assert response.json()['message'] == 'Vendor embedding updated successfully'
+    assert vendors.embedded == ['Ada Vintage cameras']
+    assert user_id in vendors.index.positions
+    assert vendors.collection.find_one({'_id': user_id})['embedding_model'] == 'test-model'
+
+    # The stored fingerprint matches, so a second call does not embed again
+    response = client.post('/add_vendor_to_ai', json={'user_id': str(user_id)})
+    assert response.json()['message'] == 'Vendor embedding is already up to date'
+    assert len(vendors.embedded) == 1
+
+
+def test_add_vendor_rejects_bad_requests(client, vendors):
+    assert client.post('/add_vendor_to_ai', data={}).status_code == 400
+    assert client.post('/add_vendor_to_ai', data={'user_id': 'nope'}).status_code == 400
+    assert client.post('/add_vendor_to_ai', data={'user_id': '0' * 24}).status_code == 404
+
+    user_id = vendors.collection.insert_one({'profilePicture': 'a.png'}).inserted_id
+    response = client.post('/add_vendor_to_ai', data={'user_id': str(user_id)})
+    assert response.status_code == 400
+    assert response.json()['message'] == 'Vendor profile has no text to embed'
+
+
+def test_search_batch_validates_form_bodies(client):
+    # Repeated form fields are read as the list of queries, as in the Flask API
+    response = client.post('/search/batch', data={'queries': ['lamp', 'desk'], 'mode': 'bogus'})
+    assert response.status_code == 400
+    assert response.json()['message'].startswith('mode must be one of')
+
+    response = client.post('/search/batch', data={'mode': 'exact'})
+    assert response.status_code == 400
+    assert response.json()['message'] == 'queries must be a non-empty list of strings'
+
+
+def test_search_batch_rejects_malformed_json(client):
+    response = client.post('/search/batch', content=b'{"queries": [', headers={'content-type': 'application/json'})
+    assert response.status_code == 400
@@ -0,0 +1,64 @@
+from batch import EmbeddingPipeline
+from vector_index import EmbeddingIndex
+
+
+def embed_documents(texts):
+    return [[float(len(text)), 1.0] for text in texts]
+
+
+def test_checkpoint_only_advances_past_contiguous_chunks(collection):
+    pipeline = EmbeddingPipeline(collection, embed_documents, 'model')
+    pipeline.chunk_last_ids = [10, 20, 30]
+    progress = []
+
+    pipeline.complete_chunk(1, progress.append)
+    assert pipeline.checkpoint is None and progress == []
+
+    pipeline.complete_chunk(0, progress.append)
+    assert pipeline.checkpoint == 20
+    assert [update['checkpoint'] for update in progress] == [20]
+
+    pipeline.complete_chunk(2, progress.append)
+    assert pipeline.checkpoint == 30
+    assert [update['checkpoint'] for update in progress] == [20, 30]
+
+
+def test_run_embeds_writes_and_indexes(collection):
+    ids = collection.insert_many([{'title': f"item {i}", 'currency': 'USD'} for i in range(7)]).inserted_ids
+    index = EmbeddingIndex(model='model')
+    progress = []
+    result = EmbeddingPipeline(collection, embed_documents, 'model', index=index, chunk_size=3, concurrency=2).run(on_progress=progress.append)
+
+    assert result['updated'] == 7 and result['errors'] == 0
+    assert result['checkpoint'] == max(ids)
+    assert progress[-1]['checkpoint'] == max(ids)
+    for document in collection.find():
+        assert document['embedding_model'] == 'model'
+        assert 'updatedAt' in document
+    assert len(index) == 7
+    assert set(index.matching({'currency': ['USD']})) == set(ids)
+
+
+def test_run_skips_current_embeddings(collection):
+    collection.insert_many([{'title': 'same'}, {'title': 'other'}])
+    EmbeddingPipeline(collection, embed_documents, 'model').run()
+
+    calls = []
+    result = EmbeddingPipeline(collection, lambda texts: calls.append(texts) or embed_documents(texts), 'model').run()
+    assert result['skipped'] == 2 and calls == []
+
+    # A new model invalidates every stored fingerprint
+    assert EmbeddingPipeline(collection, embed_documents, 'other-model').run()['updated'] == 2
+
+
+def test_failed_chunk_is_counted_and_still_checkpointed(collection):
+    collection.insert_many([{'title': f"item {i}"} for i in range(4)])
+
+    def flaky(texts):
+        if 'item 0' in texts:
+            raise RuntimeError("provider down")
+        return embed_documents(texts)
+
+    result = EmbeddingPipeline(collection, flaky, 'model', chunk_size=2, concurrency=1).run()
+    assert result['errors'] == 2 and result['updated'] == 2
+    assert collection.count_documents({'embedding': {'$exists': True}}) == 2
@@ -0,0 +1,99 @@
+import time
+
+from bson import json_util
+
+from cache import DocumentCache, EmbeddingCache, ResultCache
+
+
+def test_result_cache_key_normalizes_query_and_options():
+    assert ResultCache.key(' Red  Shoe', 1, k=5, filters={'currency': ['USD']}) == ResultCache.key('red shoe', 1, filters={'currency': ['USD']}, k=5)
+    assert ResultCache.key('red shoe', 1, k=5) != ResultCache.key('red shoe', 2, k=5)
+    assert ResultCache.key('red shoe', 1, k=5) != ResultCache.key('red shoe', 1, k=10)
+
+
+def test_result_cache_counts_hits_and_misses():
+    cache = ResultCache(maxsize=2, ttl=60)
+    key = ResultCache.key('query', 1)
+    assert cache.get(key) is None
+    cache.set(key, [('a', 0.9)])
+    assert cache.get(key) == [('a', 0.9)]
+    assert cache.stats()['hits'] == 1 and cache.stats()['misses'] == 1
+
+    cache.clear()
+    assert cache.get(key) is None
+
+
+class Fetcher:
+    def __init__(self, documents):
+        self.documents = {document['_id']: document for document in documents}
+        self.calls = []
+
+    def __call__(self, ids, fields):
+        self.calls.append(list(ids))
+        return [self.documents[document_id] for document_id in ids if document_id in self.documents]
+
+
+def test_document_cache_renders_in_order_and_fetches_once():
+    fetch = Fetcher([{'_id': 1, 'title': 'one'}, {'_id': 2, 'title': 'two'}])
+    cache = DocumentCache(maxsize=10, ttl=60)
+
+    body = cache.render([2, 1, 3], fetch)
+    assert json_util.loads(body) == [{'_id': 2, 'title': 'two'}, {'_id': 1, 'title': 'one'}]
+    assert cache.render([1, 2], fetch) == b'[' + json_util.dumps({'_id': 1, 'title': 'one'}).encode() + b', ' + json_util.dumps({'_id': 2, 'title': 'two'}).encode() + b']'
+    assert fetch.calls == [[2, 1, 3]]
+
+
+def test_document_cache_keys_by_projection():
+    fetch = Fetcher([{'_id': 1, 'title': 'one'}])
+    cache = DocumentCache(maxsize=10, ttl=60)
+    cache.render([1], fetch)
+    cache.render([1], fetch, ['title'])
+    assert fetch.calls == [[1], [1]]
+
+
+def test_document_cache_invalidate():
+    fetch = Fetcher([{'_id': 1, 'title': 'one'}])
+    cache = DocumentCache(maxsize=10, ttl=60)
+    cache.render([1], fetch)
+    fetch.documents[1] = {'_id': 1, 'title': 'changed'}
+    cache.invalidate(1)
+    assert json_util.loads(cache.render([1], fetch)) == [{'_id': 1, 'title': 'changed'}]
+
+
+def test_document_cache_drops_fetches_that_raced_an_invalidation():
+    cache = DocumentCache(maxsize=10, ttl=60)
+
+    def fetch(ids, fields):
+        # Another writer changes the document while it is being read
+        cache.invalidate(1)
+        return [{'_id': 1, 'title': 'stale'}]
+
+    cache.render([1], fetch)
+    assert len(cache) == 0
+
+
+def test_embedding_cache_normalizes_text_and_keys_by_model():
+    cache = EmbeddingCache(path=None)
+    cache.set('Red  Shoe ', 'model-a', [1.0, 0.0])
+    assert cache.get('red shoe', 'model-a') == [1.0, 0.0]
+    assert cache.get('red shoe', 'model-b') is None
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_embedding_cache_persists_to_sqlite(tmp_path):
+    path = str(tmp_path / 'embeddings.sqlite')
+    EmbeddingCache(path=path).set('red shoe', 'model', [0.5, -0.25])
+
+    # A new process starts with an empty memory cache but reads the file
+    cache = EmbeddingCache(path=path)
+    assert cache.get('Red Shoe', 'model') == [0.5, -0.25]
+    assert cache.get('blue shoe', 'model') is None
+
+
+def test_embedding_cache_ignores_expired_rows(tmp_path, monkeypatch):
+    path = str(tmp_path / 'embeddings.sqlite')
+    EmbeddingCache(ttl=60, path=path).set('red shoe', 'model', [0.5, -0.25])
+
+    now = time.time()
+    monkeypatch.setattr(time, 'time', lambda: now + 120)
+    assert EmbeddingCache(ttl=60, path=path).get('red shoe', 'model') is None
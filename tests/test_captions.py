@@ -0,0 +1,81 @@
+import hashlib
+
+import mongomock
+import pytest
+
+import captions
+from captions import CaptionPipeline
+
+
+class Images:
+    """Stands in for the image host: serves `content` by URL and honours If-None-Match."""
+
+    def __init__(self, content):
+        self.content = content
+        self.requests = []
+
+    def __call__(self, url, etag=None):
+        self.requests.append(url)
+        if url not in self.content:
+            return None
+        current = hashlib.md5(self.content[url]).hexdigest()
+        if etag == current:
+            return None, etag
+        return self.content[url], current
+
+
+@pytest.fixture
+def images(monkeypatch):
+    images = Images({'a.jpg': b'red shoe', 'b.jpg': b'blue bag'})
+    monkeypatch.setattr(captions, 'download_image', images)
+    return images
+
+
+@pytest.fixture
+def cache():
+    return mongomock.MongoClient().db.image_captions
+
+
+def pipeline(collection, cache, **options):
+    return CaptionPipeline(collection, cache, caption=lambda content: content.decode().upper(), concurrency=2, **options)
+
+
+def test_captions_and_caches(collection, cache, images):
+    collection.insert_many([{'_id': 1, 'images': ['a.jpg', 'b.jpg']}, {'_id': 2, 'images': ['a.jpg']}, {'_id': 3, 'images': []}])
+    result = pipeline(collection, cache).run()
+
+    assert result['updated'] == 2 and result['images_captioned'] == 2
+    assert collection.find_one({'_id': 1})['image_caption'] == 'RED SHOE BLUE BAG'
+    assert collection.find_one({'_id': 2})['image_caption_urls'] == ['a.jpg']
+    assert 'updatedAt' in collection.find_one({'_id': 1})
+    # Shared photos are fetched once
+    assert sorted(images.requests) == ['a.jpg', 'b.jpg']
+
+
+def test_rerun_skips_unchanged_inventories_without_requests(collection, cache, images):
+    collection.insert_one({'_id': 1, 'images': ['a.jpg']})
+    pipeline(collection, cache).run()
+    images.requests.clear()
+
+    result = pipeline(collection, cache).run()
+    assert result['updated'] == 0 and result['skipped'] == 1
+    assert images.requests == []
+
+
+def test_revalidation_recaptions_changed_images(collection, cache, images):
+    collection.insert_one({'_id': 1, 'images': ['a.jpg', 'b.jpg']})
+    pipeline(collection, cache).run()
+
+    images.content['a.jpg'] = b'green hat'
+    result = pipeline(collection, cache, revalidate_seconds=0).run()
+    assert result['updated'] == 1
+    # b.jpg answered 304 and kept its caption without a model call
+    assert result['images_captioned'] == 1
+    assert collection.find_one({'_id': 1})['image_caption'] == 'GREEN HAT BLUE BAG'
+
+
+def test_unreachable_image(collection, cache, images):
+    collection.insert_one({'_id': 1, 'images': ['missing.jpg']})
+    result = pipeline(collection, cache).run()
+    assert result['errors'] == 1
+    assert 'image_caption' not in collection.find_one({'_id': 1})
@@ -0,0 +1,43 @@
+import numpy as np
+import pytest
+from bson.binary import Binary
+
+from codec import decode_embedding, embedding_encoding, encode_embedding
+
+
+EMBEDDING = [0.5, -0.25, 0.125, 1.0, -1.0, 0.0]
+
+
+def test_list_round_trip():
+    encoded = encode_embedding(EMBEDDING, 'list')
+    assert encoded == EMBEDDING
+    assert embedding_encoding(encoded) == 'list'
+    np.testing.assert_array_equal(decode_embedding(encoded), np.asarray(EMBEDDING, dtype=np.float32))
+
+
+def test_float16_round_trip():
+    encoded = encode_embedding(EMBEDDING, 'float16')
+    assert isinstance(encoded, Binary)
+    assert len(encoded) == 2 * len(EMBEDDING)
+    assert embedding_encoding(encoded) == 'float16'
+    np.testing.assert_allclose(decode_embedding(encoded), EMBEDDING, atol=1e-3)
+
+
+def test_int8_round_trip():
+    embedding = np.random.default_rng(0).standard_normal(64)
+    encoded = encode_embedding(embedding, 'int8')
+    assert len(encoded) == 4 + len(embedding)
+    assert embedding_encoding(encoded) == 'int8'
+    # Quantization error is at most half a step of max(|x|) / 127
+    np.testing.assert_allclose(decode_embedding(encoded), embedding, atol=np.abs(embedding).max() / 254 + 1e-6)
+
+
+def test_int8_zero_vector():
+    np.testing.assert_array_equal(decode_embedding(encode_embedding([0.0, 0.0], 'int8')), [0.0, 0.0])
+
+
+def test_unknown_encoding():
+    with pytest.raises(ValueError):
+        encode_embedding(EMBEDDING, 'bfloat16')
+    with pytest.raises(ValueError):
+        embedding_encoding(Binary(b'\x00\x00', 130))
@@ -0,0 +1,106 @@
+import threading
+
+import pytest
+
+from embedding_dispatcher import EmbeddingDispatcher, is_rate_limited, retry_after
+
+
+class RateLimitError(Exception):
+    status_code = 429
+
+    def __init__(self, retry_after=None):
+        super().__init__("rate limited")
+        self.response = type('Response', (), {'headers': {'retry-after': retry_after} if retry_after else {}})()
+
+
+class Provider:
+    """Records every embed_documents call; `failures` are raised by the first calls."""
+
+    def __init__(self, failures=()):
+        self.calls = []
+        self.failures = list(failures)
+        self.release = threading.Event()
+        self.release.set()
+
+    def __call__(self, texts):
+        self.calls.append(list(texts))
+        self.release.wait(5)
+        if self.failures:
+            raise self.failures.pop(0)
+        return [[float(len(text))] for text in texts]
+
+
+def test_batches_concurrent_texts():
+    provider = Provider()
+    dispatcher = EmbeddingDispatcher(provider, window=0.2, max_batch=10)
+    results = {}
+    threads = [threading.Thread(target=lambda text=text: results.update({text: dispatcher.embed(text)})) for text in ['a', 'bb', 'ccc']]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert results == {'a': [1.0], 'bb': [2.0], 'ccc': [3.0]}
+    assert len(provider.calls) == 1 and sorted(provider.calls[0]) == ['a', 'bb', 'ccc']
+
+
+def test_max_batch():
+    provider = Provider()
+    dispatcher = EmbeddingDispatcher(provider, window=0.05, max_batch=2)
+    assert dispatcher.embed_many(['a', 'bb', 'ccc']) == [[1.0], [2.0], [3.0]]
+    assert all(len(texts) <= 2 for texts in provider.calls)
+    assert sum(len(texts) for texts in provider.calls) == 3
+
+
+def test_identical_texts_share_one_request():
+    provider = Provider()
+    provider.release.clear()
+    dispatcher = EmbeddingDispatcher(provider, window=0)
+    first = dispatcher.submit(['same'])[0]
+    second = dispatcher.submit(['same', 'same'])
+    provider.release.set()
+
+    assert first.result(5) == [4.0]
+    assert [future.result(5) for future in second] == [[4.0], [4.0]]
+    assert provider.calls == [['same']]
+    assert dispatcher.stats()['coalesced'] == 2
+
+
+def test_rate_limit_backs_off_and_retries():
+    provider = Provider(failures=[RateLimitError(retry_after='0.01')])
+    dispatcher = EmbeddingDispatcher(provider, window=0, max_concurrency=4)
+    assert dispatcher.embed('text') == [4.0]
+
+    assert provider.calls == [['text'], ['text']]
+    stats = dispatcher.stats()
+    assert stats['rate_limited'] == 1
+    # Halved on the 429; it only grows back after a full round of successes
+    assert stats['limit'] == 2
+
+
+def test_rate_limit_gives_up_after_max_retries():
+    provider = Provider(failures=[RateLimitError() for _ in range(3)])
+    dispatcher = EmbeddingDispatcher(provider, window=0, max_retries=2, backoff=0.001)
+    with pytest.raises(RateLimitError):
+        dispatcher.embed('text')
+    assert len(provider.calls) == 3
+
+
+def test_errors_reach_every_caller_of_the_batch():
+    provider = Provider(failures=[ValueError("bad input")])
+    dispatcher = EmbeddingDispatcher(provider, window=0.05)
+    futures = dispatcher.submit(['a', 'b'])
+    for future in futures:
+        with pytest.raises(ValueError):
+            future.result(5)
+
+    # Nothing is left behind: the same texts are embedded afresh
+    assert dispatcher.embed_many(['a', 'b']) == [[1.0], [1.0]]
+
+
+def test_rate_limit_helpers():
+    assert is_rate_limited(RateLimitError())
+    assert not is_rate_limited(ValueError())
+    assert retry_after(RateLimitError(retry_after='2.5')) == 2.5
+    assert retry_after(RateLimitError()) is None
+    assert retry_after(ValueError()) is None
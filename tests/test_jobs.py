@@ -0,0 +1,135 @@
+import datetime
+import threading
+import time
+
+import mongomock
+import pytest
+
+import jobs
+from jobs import JobRunner
+
+
+class Pipeline:
+    """Reports one checkpoint per id, optionally blocking until `release` is set."""
+
+    def __init__(self, ids, release=None, error=None):
+        self.ids = ids
+        self.release = release
+        self.error = error
+        self.queries = []
+
+    def run(self, query=None, on_progress=None):
+        self.queries.append(query)
+        if self.release is not None:
+            self.release.wait(5)
+        if self.error is not None:
+            raise self.error
+        start = query['_id']['$gt'] if query else 0
+        done = [document_id for document_id in self.ids if document_id > start]
+        for count, document_id in enumerate(done, start=1):
+            on_progress({'updated': count, 'errors': 0, 'skipped': 0, 'checkpoint': document_id})
+        return {'updated': len(done), 'errors': 0, 'skipped': 0, 'checkpoint': done[-1] if done else None}
+
+
+@pytest.fixture
+def jobs_collection():
+    return mongomock.MongoClient().db.jobs
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+def test_runs_a_job_to_completion(jobs_collection, collection):
+    collection.insert_many([{'_id': i} for i in range(1, 4)])
+    runner = JobRunner(jobs_collection, collection, lambda: Pipeline([1, 2, 3]))
+    job_id, created = runner.submit()
+    assert created
+    wait_for(lambda: runner.status(str(job_id))['status'] == 'completed')
+
+    status = runner.status(str(job_id))
+    assert status['total'] == 3 and status['updated'] == 3 and status['last_id'] == '3'
+    assert 'active' not in jobs_collection.find_one({'_id': job_id})
+
+
+class RacingJobs:
+    """Jobs collection where another process queues a job right after our active-job check."""
+
+    def __init__(self, jobs_collection):
+        self.jobs_collection = jobs_collection
+        self.raced = None
+
+    def __getattr__(self, name):
+        return getattr(self.jobs_collection, name)
+
+    def find_one(self, query, *args, **kwargs):
+        if self.raced is None:
+            self.raced = self.jobs_collection.insert_one({'status': 'queued', 'active': True}).inserted_id
+            return None
+        return self.jobs_collection.find_one(query, *args, **kwargs)
+
+
+def test_submit_returns_the_active_job(jobs_collection, collection):
+    release = threading.Event()
+    runner = JobRunner(jobs_collection, collection, lambda: Pipeline([1], release))
+    job_id, _ = runner.submit()
+    try:
+        assert runner.submit() == (job_id, False)
+    finally:
+        release.set()
+
+
+def test_submit_racing_another_process(jobs_collection, collection):
+    racing = RacingJobs(jobs_collection)
+    runner = JobRunner(racing, collection, lambda: Pipeline([]))
+    assert runner.submit() == (racing.raced, False)
+    assert jobs_collection.count_documents({}) == 1
+
+
+def test_failed_job(jobs_collection, collection):
+    runner = JobRunner(jobs_collection, collection, lambda: Pipeline([], error=RuntimeError("provider down")))
+    job_id, _ = runner.submit()
+    wait_for(lambda: runner.status(str(job_id))['status'] == 'failed')
+    assert runner.status(str(job_id))['error'] == 'provider down'
+    # A failed job no longer blocks a new one
+    assert runner.submit()[1]
+
+
+def test_resumes_a_stale_job_from_its_checkpoint(jobs_collection, collection):
+    stale = datetime.datetime.utcnow() - datetime.timedelta(seconds=jobs.JOB_STALE_SECONDS + 1)
+    job_id = jobs_collection.insert_one({
+        'status': 'running', 'active': True, 'worker': 'dead:1', 'total': 3, 'updated': 1, 'failed': 0, 'skipped': 0,
+        'last_id': 1, 'created_at': stale, 'updated_at': stale, 'started_at': stale,
+    }).inserted_id
+    pipeline = Pipeline([1, 2, 3])
+    runner = JobRunner(jobs_collection, collection, lambda: pipeline)
+    runner.resume_interrupted()
+    wait_for(lambda: runner.status(str(job_id))['status'] == 'completed')
+
+    assert pipeline.queries == [{'_id': {'$gt': 1}}]
+    assert runner.status(str(job_id))['updated'] == 3
+
+
+def test_heartbeat_keeps_a_slow_job_from_being_taken_over(jobs_collection, collection, monkeypatch):
+    monkeypatch.setattr(jobs, 'JOB_STALE_SECONDS', 0.2)
+    monkeypatch.setattr(jobs, 'JOB_HEARTBEAT_SECONDS', 0.05)
+    release = threading.Event()
+    runner = JobRunner(jobs_collection, collection, lambda: Pipeline([1], release))
+    job_id, _ = runner.submit()
+    try:
+        wait_for(lambda: runner.status(str(job_id))['status'] == 'running')
+        # No checkpoint for longer than the stale threshold
+        time.sleep(0.4)
+        assert runner.claim(job_id) is None
+    finally:
+        release.set()
+    wait_for(lambda: runner.status(str(job_id))['status'] == 'completed')
+
+
+def test_status_of_unknown_job(jobs_collection, collection):
+    runner = JobRunner(jobs_collection, collection, lambda: Pipeline([]))
+    assert runner.status('not-an-id') is None
+    assert runner.status('0' * 24) is None
@@ -0,0 +1,65 @@
+from lexical_index import LexicalIndex, reciprocal_rank_fusion
+from vector_index import EmbeddingIndex
+
+
+def build():
+    index = LexicalIndex()
+    index.upsert('a', {'title': 'Red running shoe', 'description': 'light'})
+    index.upsert('b', {'title': 'Blue shoe', 'description': 'red laces'})
+    index.upsert('c', {'title': 'Leather bag', 'description': 'red'})
+    return index
+
+
+def test_title_terms_outrank_description_terms():
+    results = build().search('red shoe', k=3)
+    assert [document_id for document_id, _ in results] == ['a', 'b', 'c']
+
+
+def test_exact_matches_ignore_case_and_punctuation():
+    index = build()
+    assert index.exact_matches('blue  SHOE!') == ['b']
+    assert index.exact_matches('blue') == []
+
+
+def test_filtered_search_pages_through_allowed_ids():
+    index = build()
+    assert [document_id for document_id, _ in index.search('red', k=5, allowed={'b', 'c'})] == ['c', 'b']
+    assert [document_id for document_id, _ in index.search('red', k=1, offset=1, allowed={'b', 'c'})] == ['b']
+
+
+def test_filtered_search_with_embedding_index_rows():
+    index = build()
+    vectors = EmbeddingIndex()
+    vectors.upsert('a', [1.0, 0.0], {'currency': 'USD'})
+    vectors.upsert('b', [0.0, 1.0], {'currency': 'EUR'})
+    allowed = vectors.matching({'currency': ['EUR']})
+    assert [document_id for document_id, _ in index.search('shoe', k=5, allowed=allowed)] == ['b']
+
+
+def test_upsert_and_remove_reuse_rows():
+    index = build()
+    index.upsert('a', {'title': 'Green hat'})
+    assert index.exact_matches('red running shoe') == []
+    assert [document_id for document_id, _ in index.search('hat')] == ['a']
+
+    row = index.positions['c']
+    assert index.remove('c')
+    assert index.search('leather') == []
+    index.upsert('d', {'title': 'Wallet'})
+    assert index.positions['d'] == row
+    assert len(index) == 3
+
+
+def test_load_replaces_contents(collection):
+    index = build()
+    collection.insert_many([{'title': 'Wallet'}, {'title': 'Belt', 'description': 'leather'}])
+    version = index.version
+    index.load(collection)
+    assert len(index) == 2 and index.version > version
+    assert index.search('red') == []
+    assert len(index.search('leather')) == 1
+
+
+def test_reciprocal_rank_fusion():
+    fused = reciprocal_rank_fusion([[('a', 0.9), ('b', 0.5)], [('b', 3.0), ('c', 1.0)]], k=60)
+    assert [document_id for document_id, _ in fused] == ['b', 'a', 'c']
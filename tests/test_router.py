@@ -0,0 +1,54 @@
+from router import DEFAULT_TARGET, PROTOTYPE_PHRASES, IntentRouter
+
+
+def embed_documents(texts):
+    return [[1.0, 0.0] if text in PROTOTYPE_PHRASES['is_inventory'] else [0.0, 1.0] for text in texts]
+
+
+def build(llm_classify=lambda query: 'is_vendor'):
+    calls = []
+    router = IntentRouter(embed_documents, lambda query: calls.append(query) or llm_classify(query), margin=0.1)
+    return router, calls
+
+
+def test_routes_locally_when_the_margin_is_clear():
+    router, calls = build()
+    router.build_prototypes()
+
+    assert router.route('who sells cakes', [0.1, 1.0]) == 'is_vendor'
+    assert router.route('Who sells  CAKES', [1.0, 0.0]) == 'is_vendor'
+    assert router.settled('who sells cakes')
+    assert calls == []
+
+
+def test_ambiguous_query_uses_the_default_until_the_llm_answers():
+    router, calls = build()
+    router.build_prototypes()
+
+    assert router.route('cake', [1.0, 1.0]) == DEFAULT_TARGET
+    router.executor.shutdown(wait=True)
+
+    # Asked once, in the background, and cached for the next identical query
+    assert calls == ['cake']
+    assert router.settled('cake')
+    assert router.route('cake', [1.0, 1.0]) == 'is_vendor'
+
+
+def test_prototypes_are_built_in_the_background():
+    router, calls = build()
+    assert router.classify([1.0, 0.0]) == (None, 0.0)
+    assert router.route('phone', [1.0, 0.0]) == DEFAULT_TARGET
+    router.executor.shutdown(wait=True)
+
+    assert router.prototypes is not None
+    assert router.classify([1.0, 0.0])[0] == 'is_inventory'
+
+
+def test_failed_llm_lookup_is_not_cached():
+    def fail(query):
+        raise RuntimeError("model unavailable")
+
+    router, calls = build(fail)
+    router.build_prototypes()
+    router.ask_llm('cake', 'cake')
+    assert not router.settled('cake') and not router.pending
@@ -0,0 +1,130 @@
+import datetime
+import time
+
+import numpy as np
+
+import snapshot
+from sync import IndexWatcher, touch
+from vector_index import EmbeddingIndex
+
+
+def build():
+    index = EmbeddingIndex(model='model')
+    index.upsert('a', [1.0, 0.0], {'price': 10, 'currency': 'USD'})
+    index.upsert('b', [0.0, 1.0], {'price': 20, 'currency': 'EUR'})
+    index.upsert('c', [0.6, 0.8], {'currency': 'USD'})
+    index.remove('c')
+    return index
+
+
+def test_round_trip(tmp_path):
+    path = str(tmp_path)
+    header = snapshot.write_snapshot(build(), path, headroom=0.5)
+    assert header['count'] == 2 and header['capacity'] >= 3 and header['model'] == 'model'
+
+    header, ids, matrix, attributes = snapshot.read_snapshot(path)
+    index = EmbeddingIndex(model='model')
+    index.load_arrays(ids, matrix, attributes)
+    assert len(index) == 2
+    assert index.search([0.0, 1.0], k=1, filters={'currency': ['EUR'], 'min_price': 20})[0][0] == 'b'
+
+    # Spare rows take inserts without growing the mapped matrix
+    index.upsert('d', [0.6, 0.8])
+    assert index.matrix is matrix
+
+
+def test_float16(tmp_path):
+    path = str(tmp_path)
+    snapshot.write_snapshot(build(), path, dtype='float16')
+    _, ids, matrix, _ = snapshot.read_snapshot(path)
+    assert matrix.dtype == np.float32
+    np.testing.assert_allclose(matrix[:2], [[1.0, 0.0], [0.0, 1.0]], atol=1e-3)
+
+
+def test_older_than_keeps_a_fresh_snapshot(tmp_path):
+    path = str(tmp_path)
+    written = snapshot.write_snapshot(build(), path)
+    assert snapshot.write_snapshot(build(), path, older_than=3600) is None
+    assert snapshot.read_header(path)['version'] == written['version']
+
+
+def insert(collection, **document):
+    document.setdefault('updatedAt', datetime.datetime.utcnow())
+    document['_id'] = collection.insert_one(document).inserted_id
+    return document
+
+
+def test_boot_catches_up_on_touched_writes(collection, tmp_path):
+    path = str(tmp_path)
+    old = insert(collection, embedding=[1.0, 0.0])
+    IndexWatcher(EmbeddingIndex(), collection, snapshot_path=path).initial_load()
+    assert snapshot.exists(path)
+
+    # Writes after the snapshot, made through `touch` like every write of this service
+    new_id = collection.insert_one({'embedding': [0.0, 1.0]}).inserted_id
+    collection.update_one({'_id': new_id}, touch({'$set': {'price': 5}}))
+    collection.delete_one({'_id': old['_id']})
+
+    watcher = IndexWatcher(EmbeddingIndex(), collection, snapshot_path=path)
+    watcher.initial_load()
+    assert new_id in watcher.index
+    assert old['_id'] not in watcher.index
+
+
+class SlowCursorCollection:
+    """A collection whose `find` runs `during` after yielding the first document, as if a write raced the read."""
+
+    def __init__(self, collection, during):
+        self.collection = collection
+        self.during = during
+
+    def __getattr__(self, name):
+        return getattr(self.collection, name)
+
+    def find(self, *args, **kwargs):
+        for position, document in enumerate(self.collection.find(*args, **kwargs)):
+            yield document
+            if position == 0:
+                self.during()
+
+
+def test_snapshot_is_dated_from_the_start_of_the_load(collection, tmp_path):
+    path = str(tmp_path)
+    first = insert(collection, embedding=[1.0, 0.0])
+    insert(collection, embedding=[0.0, 1.0])
+
+    def write_behind_the_cursor():
+        collection.update_one({'_id': first['_id']}, touch({'$set': {'embedding': [0.6, 0.8]}}))
+        time.sleep(0.05)
+
+    IndexWatcher(EmbeddingIndex(), SlowCursorCollection(collection, write_behind_the_cursor), poll_interval=0, snapshot_path=path).initial_load()
+
+    watcher = IndexWatcher(EmbeddingIndex(), collection, poll_interval=0, snapshot_path=path)
+    watcher.initial_load()
+    assert watcher.index.search([0.6, 0.8], k=1)[0][0] == first['_id']
+
+
+def test_refresh_only_when_stale_and_changed(collection, tmp_path):
+    path = str(tmp_path)
+    insert(collection, embedding=[1.0, 0.0])
+    watcher = IndexWatcher(EmbeddingIndex(), collection, snapshot_path=path, snapshot_refresh_interval=3600)
+    watcher.initial_load()
+    written = snapshot.read_header(path)['version']
+
+    # Fresh snapshot: kept even though the index changed
+    watcher.index.upsert('extra', [0.0, 1.0])
+    watcher.refresh_snapshot()
+    assert snapshot.read_header(path)['version'] == written
+
+    watcher.snapshot_refresh_interval = 0.001
+    watcher.next_refresh = 0
+    time.sleep(0.01)
+    watcher.refresh_snapshot()
+    header = snapshot.read_header(path)
+    assert header['version'] != written and header['count'] == 2
+
+    # Stale but unchanged since the last write
+    watcher.next_refresh = 0
+    time.sleep(0.01)
+    watcher.refresh_snapshot()
+    assert snapshot.read_header(path)['version'] == header['version']
@@ -0,0 +1,183 @@
+import datetime
+import threading
+import time
+
+import pytest
+
+from cache import DocumentCache
+from lexical_index import LexicalIndex
+from sync import IndexWatcher, touch
+from vector_index import EmbeddingIndex
+
+
+@pytest.fixture
+def watcher(collection):
+    return IndexWatcher(EmbeddingIndex(), collection, poll_interval=0.05, snapshot_path=None)
+
+
+def insert(collection, **document):
+    document.setdefault('updatedAt', datetime.datetime.utcnow())
+    document['_id'] = collection.insert_one(document).inserted_id
+    return document
+
+
+def update(document_id, updated=None, removed=None):
+    return {
+        'operationType': 'update',
+        'documentKey': {'_id': document_id},
+        'updateDescription': {'updatedFields': updated or {}, 'removedFields': removed or []},
+    }
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+def test_insert_indexes_the_vector(watcher, collection):
+    document = insert(collection, embedding=[1.0, 0.0])
+    watcher.apply_change({'operationType': 'insert', 'documentKey': {'_id': document['_id']}, 'fullDocument': document})
+    assert watcher.index.search([1.0, 0.0], k=1)[0][0] == document['_id']
+
+
+def test_embedding_update_replaces_the_vector(watcher, collection):
+    document = insert(collection, embedding=[1.0, 0.0])
+    other = insert(collection, embedding=[0.0, 1.0])
+    watcher.apply_document(document)
+    watcher.apply_document(other)
+
+    watcher.apply_change(update(document['_id'], {'embedding': [0.6, 0.8]}))
+    assert watcher.index.search([0.6, 0.8], k=1)[0][0] == document['_id']
+
+
+def test_unindexed_field_update_leaves_the_index_alone(watcher, collection):
+    document = insert(collection, embedding=[1.0, 0.0])
+    watcher.apply_document(document)
+    version = watcher.index.version
+
+    watcher.apply_change(update(document['_id'], {'views': 3}))
+    assert watcher.index.version == version
+
+
+def test_removed_embedding_and_delete(watcher, collection):
+    first = insert(collection, embedding=[1.0, 0.0])
+    second = insert(collection, embedding=[0.0, 1.0])
+    watcher.apply_document(first)
+    watcher.apply_document(second)
+
+    watcher.apply_change(update(first['_id'], removed=['embedding']))
+    assert first['_id'] not in watcher.index
+
+    watcher.apply_change({'operationType': 'delete', 'documentKey': {'_id': second['_id']}})
+    assert second['_id'] not in watcher.index
+
+
+def test_polling_applies_touched_writes_and_deletes(watcher, collection):
+    kept = insert(collection, embedding=[1.0, 0.0])
+    deleted = insert(collection, embedding=[0.0, 1.0])
+    watcher.reconcile_interval = 0
+    polling = threading.Thread(target=watcher.poll_changes, daemon=True)
+    polling.start()
+    try:
+        wait_for(lambda: deleted['_id'] in watcher.index)
+
+        # Written the way this service writes: the stamp is what the poll looks for
+        collection.update_one({'_id': kept['_id']}, touch({'$set': {'embedding': [0.0, 1.0]}}))
+        collection.delete_one({'_id': deleted['_id']})
+        wait_for(lambda: deleted['_id'] not in watcher.index)
+        wait_for(lambda: watcher.index.search([0.0, 1.0], k=1)[0][0] == kept['_id'])
+    finally:
+        watcher.stop()
+        polling.join(5)
+
+
+def test_changes_invalidate_cached_documents(collection):
+    watcher = IndexWatcher(EmbeddingIndex(), collection, snapshot_path=None, document_cache=DocumentCache())
+    document = insert(collection, title='Cached', embedding=[1.0, 0.0])
+    watcher.document_cache.render([document['_id']], lambda ids, fields: collection.find({'_id': {'$in': ids}}))
+    assert len(watcher.document_cache) == 1
+
+    # Unindexed fields still change the rendered document
+    watcher.apply_change(update(document['_id'], {'views': 3}))
+    assert len(watcher.document_cache) == 0
+
+
+def test_idle_polling_leaves_versions_and_caches_alone(collection):
+    watcher = IndexWatcher(EmbeddingIndex(), collection, poll_interval=0.02, snapshot_path=None, document_cache=DocumentCache())
+    first = insert(collection, embedding=[1.0, 0.0])
+    insert(collection, embedding=[0.0, 1.0], updatedAt=first['updatedAt'])
+    polling = threading.Thread(target=watcher.poll_changes, daemon=True)
+    polling.start()
+    try:
+        wait_for(lambda: len(watcher.index) == 2)
+        time.sleep(0.1)
+        version, generation = watcher.index.version, watcher.document_cache.generation
+        time.sleep(0.2)
+        assert (watcher.index.version, watcher.document_cache.generation) == (version, generation)
+
+        # A write sharing the watermark's timestamp is still picked up
+        third = insert(collection, embedding=[0.6, 0.8], updatedAt=first['updatedAt'])
+        collection.update_one({'_id': third['_id']}, {'$set': {'updatedAt': first['updatedAt']}})
+        wait_for(lambda: third['_id'] in watcher.index)
+    finally:
+        watcher.stop()
+        polling.join(5)
+
+
+def test_first_embedding_update_indexes_filter_fields(watcher, collection):
+    # Embedded by another worker: the change only carries the new vector
+    document = insert(collection, embedding=[0.0, 1.0], price=30, currency='EUR', category='bags')
+    watcher.apply_change(update(document['_id'], {'embedding': [0.0, 1.0], 'embedding_model': 'm'}))
+
+    assert document['_id'] in watcher.index
+    assert watcher.index.search([0.0, 1.0], k=1, filters={'currency': ['EUR'], 'category': ['bags'], 'min_price': 30})
+
+
+def test_filter_field_update(watcher, collection):
+    document = insert(collection, embedding=[1.0, 0.0], currency='USD', price=10)
+    watcher.apply_document(document)
+
+    watcher.apply_change(update(document['_id'], {'currency': 'EUR'}, ['price']))
+    assert watcher.index.search([1.0, 0.0], k=1, filters={'currency': ['EUR']})
+    assert watcher.index.search([1.0, 0.0], k=1, filters={'min_price': 0}) == []
+
+
+def test_title_update_retokenizes(collection):
+    watcher = IndexWatcher(EmbeddingIndex(), collection, snapshot_path=None, lexical_index=LexicalIndex())
+    document = insert(collection, title='Old title', description='leather', embedding=[1.0, 0.0])
+    watcher.apply_document(document)
+
+    collection.update_one({'_id': document['_id']}, {'$set': {'title': 'New title'}})
+    watcher.apply_change(update(document['_id'], {'title': 'New title'}))
+    assert watcher.lexical_index.exact_matches('old title') == []
+    assert watcher.lexical_index.exact_matches('new title') == [document['_id']]
+    # The description was not in the change but is still indexed
+    assert watcher.lexical_index.search('leather')[0][0] == document['_id']
+
+
+def test_model_mismatch_drops_document(collection):
+    watcher = IndexWatcher(EmbeddingIndex(model='model-a'), collection, snapshot_path=None)
+    document = insert(collection, embedding=[1.0, 0.0], embedding_model='model-a')
+    watcher.apply_document(document)
+
+    watcher.apply_change(update(document['_id'], {'embedding': [0.0, 1.0], 'embedding_model': 'model-b'}))
+    assert document['_id'] not in watcher.index
+
+
+def test_embedding_update_keeps_attributes(watcher, collection):
+    document = insert(collection, embedding=[1.0, 0.0], currency='USD')
+    watcher.apply_document(document)
+    watcher.apply_change(update(document['_id'], {'embedding': [0.0, 1.0]}))
+
+    assert watcher.index.search([0.0, 1.0], k=1, filters={'currency': ['USD']})[0][0] == document['_id']
+
+
+def test_insert_indexes_attributes_and_text(collection):
+    watcher = IndexWatcher(EmbeddingIndex(), collection, snapshot_path=None, lexical_index=LexicalIndex())
+    document = insert(collection, title='Red shoe', embedding=[1.0, 0.0], price=10, currency='USD')
+    watcher.apply_change({'operationType': 'insert', 'documentKey': {'_id': document['_id']}, 'fullDocument': document})
+
+    assert document['_id'] in watcher.index.matching({'currency': ['USD'], 'max_price': 10})
+    assert watcher.lexical_index.exact_matches('red shoe') == [document['_id']]
@@ -0,0 +1,40 @@
+import pytest
+from bson.objectid import ObjectId
+
+from utils import SEARCH_MAX_K, fetch_ranked_inventories, parse_search_options
+
+
+def test_defaults():
+    k, offset, filters = parse_search_options({})
+    assert k >= 1 and offset == 0 and filters is None
+
+
+def test_filters():
+    owner = ObjectId()
+    k, offset, filters = parse_search_options({
+        'k': '3', 'offset': '6', 'min_price': '10', 'max_price': 20,
+        'currency': 'USD,EUR', 'owner': str(owner).upper(), 'category': ['shoes'],
+    })
+    assert (k, offset) == (3, 6)
+    assert filters == {'min_price': 10.0, 'max_price': 20.0, 'currency': ['USD', 'EUR'], 'owner': [str(owner)], 'category': ['shoes']}
+
+
+@pytest.mark.parametrize('data, message', [
+    ({'k': 'many'}, 'k and offset must be integers'),
+    ({'k': SEARCH_MAX_K + 1}, 'k must be between'),
+    ({'offset': -1}, 'offset must be at least 0'),
+    ({'min_price': 'cheap'}, 'min_price must be a number'),
+    ({'owner': 'not-an-id'}, 'Invalid owner ID'),
+])
+def test_invalid_options(data, message):
+    with pytest.raises(ValueError, match=message):
+        parse_search_options(data)
+
+
+def test_fetch_ranked_inventories_hides_internal_fields(collection):
+    collection.insert_many([
+        {'_id': 1, 'title': 'one', 'embedding': [1.0], 'embedding_hash': 'h', 'image_caption': 'c', 'image_caption_urls': ['u']},
+        {'_id': 2, 'title': 'two'},
+    ])
+    assert fetch_ranked_inventories(collection, [2, 1, 3]) == [{'_id': 2, 'title': 'two'}, {'_id': 1, 'title': 'one'}]
+    assert fetch_ranked_inventories(collection, [1], ['title', 'image_caption']) == [{'_id': 1, 'title': 'one'}]
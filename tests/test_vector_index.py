@@ -0,0 +1,175 @@
+import numpy as np
+from bson.objectid import ObjectId
+
+from vector_index import EmbeddingIndex, top_k
+
+
+def build():
+    index = EmbeddingIndex()
+    index.upsert('a', [1, 0, 0])
+    index.upsert('b', [0.9, 0.1, 0])
+    index.upsert('c', [0, 1, 0])
+    return index
+
+
+def ids(results):
+    return [document_id for document_id, _ in results]
+
+
+def test_search_ranks_by_cosine_similarity():
+    index = build()
+    results = index.search([1, 0, 0], k=3)
+    assert ids(results) == ['a', 'b', 'c']
+    assert results[0][1] == np.float32(1.0)
+
+
+def test_search_offset():
+    index = build()
+    assert ids(index.search([1, 0, 0], k=1, offset=1)) == ['b']
+
+
+def test_upsert_replaces_vector():
+    index = build()
+    index.upsert('a', [0, 0, 1])
+    assert len(index) == 3
+    assert ids(index.search([0, 0, 1], k=1)) == ['a']
+
+
+def test_remove_frees_the_row_for_reuse():
+    index = build()
+    row = index.positions['b']
+    assert index.remove('b')
+    assert not index.remove('b')
+    assert 'b' not in ids(index.search([1, 0, 0], k=3))
+
+    index.upsert('d', [0, 0, 1])
+    assert index.positions['d'] == row
+    assert ids(index.search([0, 0, 1], k=1)) == ['d']
+
+
+def test_search_never_returns_freed_rows():
+    index = build()
+    index.remove('a')
+    index.remove('c')
+    assert ids(index.search([1, 0, 0], k=5)) == ['b']
+
+
+def test_load(collection):
+    collection.insert_many([{'_id': 1, 'embedding': [1.0, 0.0]}, {'_id': 2, 'embedding': [0.0, 2.0]}, {'_id': 3}])
+    index = EmbeddingIndex()
+    index.load(collection)
+    assert len(index) == 2
+    assert ids(index.search([0, 1], k=2)) == [2, 1]
+
+
+def test_top_k():
+    scores = np.asarray([0.1, 0.9, 0.5, 0.7])
+    assert top_k(scores, 2).tolist() == [1, 3]
+    assert top_k(scores, 10).tolist() == [1, 3, 2, 0]
+    assert top_k(scores, 0).tolist() == []
+
+
+def build_with_attributes():
+    index = EmbeddingIndex()
+    index.upsert('a', [1, 0, 0], {'price': 10, 'currency': 'USD', 'category': 'shoes'})
+    index.upsert('b', [0.9, 0.1, 0], {'price': 50, 'currency': 'EUR', 'category': 'shoes'})
+    index.upsert('c', [0, 1, 0], {'price': 30, 'currency': 'USD', 'category': 'bags'})
+    return index
+
+
+def test_search_filters():
+    index = build_with_attributes()
+    assert ids(index.search([1, 0, 0], k=3, filters={'currency': ['USD']})) == ['a', 'c']
+    assert ids(index.search([1, 0, 0], k=3, filters={'min_price': 20, 'max_price': 60})) == ['b', 'c']
+    assert ids(index.search([1, 0, 0], k=3, filters={'category': ['shoes'], 'max_price': 20})) == ['a']
+    # Values never seen by the index match nothing
+    assert index.search([1, 0, 0], k=3, filters={'currency': ['GBP']}) == []
+
+
+def test_owner_filter_matches_both_storage_forms():
+    owner = ObjectId()
+    index = EmbeddingIndex()
+    index.upsert('object-id', [1, 0], {'owner': owner})
+    index.upsert('string', [0, 1], {'owner': str(owner)})
+    index.upsert('other', [1, 1], {'owner': ObjectId()})
+
+    for value in [owner, str(owner)]:
+        assert sorted(ids(index.search([1, 0], k=3, filters={'owner': [value]}))) == ['object-id', 'string']
+
+
+def test_upsert_without_attributes_keeps_them():
+    index = build_with_attributes()
+    index.upsert('a', [0, 0, 1])
+    assert ids(index.search([0, 0, 1], k=1, filters={'currency': ['USD'], 'max_price': 10})) == ['a']
+
+
+def test_update_attributes():
+    index = build_with_attributes()
+    index.update_attributes('c', {'currency': 'EUR'})
+    assert ids(index.search([0, 1, 0], k=3, filters={'currency': ['EUR']})) == ['c', 'b']
+    index.update_attributes('c', {'price': None})
+    assert ids(index.search([0, 1, 0], k=3, filters={'min_price': 0})) == ['b', 'a']
+
+
+def test_reused_row_starts_from_the_new_attributes():
+    index = build_with_attributes()
+    index.remove('b')
+    assert index.search([1, 0, 0], k=3, filters={'currency': ['EUR']}) == []
+
+    index.upsert('d', [0, 0, 1], {'price': 5, 'currency': 'EUR'})
+    assert ids(index.search([0, 0, 1], k=3, filters={'currency': ['EUR']})) == ['d']
+    assert index.search([0, 0, 1], k=3, filters={'category': ['shoes'], 'currency': ['EUR']}) == []
+
+
+def test_snapshot_attributes_round_trip():
+    index = build_with_attributes()
+    index.remove('b')
+    loaded = EmbeddingIndex()
+    loaded.load_arrays(*index.snapshot(attributes=True))
+    assert ids(loaded.search([1, 0, 0], k=3, filters={'currency': ['USD'], 'min_price': 20})) == ['c']
+
+
+def test_matching():
+    index = build_with_attributes()
+    matching = index.matching({'currency': ['USD']})
+    assert 'a' in matching and 'c' in matching
+    assert 'b' not in matching and 'missing' not in matching
+    assert sorted(matching) == ['a', 'c']
+    assert len(matching) == 2
+
+
+def test_search_many_matches_search():
+    index = build()
+    queries = [[1, 0, 0], [0, 1, 0]]
+    assert index.search_many(queries, k=2) == [index.search(query, k=2) for query in queries]
+
+
+def test_model_tag():
+    index = EmbeddingIndex(model='model-a')
+    assert index.upsert('a', [1, 0], model='model-a')
+    assert not index.upsert('a', [0, 1], model='model-b')
+    # A vector from another model drops the document rather than mixing spaces
+    assert 'a' not in index
+
+
+def test_two_stage_reranks_exactly():
+    rng = np.random.default_rng(0)
+    index = EmbeddingIndex()
+    vectors = rng.standard_normal((200, 32))
+    for i, vector in enumerate(vectors):
+        index.upsert(i, vector.tolist(), {'currency': 'USD' if i % 2 else 'EUR'})
+    index.enable_two_stage(8)
+
+    # With every row shortlisted, the rerank must reproduce exact search
+    query = rng.standard_normal(32)
+    exact = index.search(query, k=5)
+    two_stage = index.search_two_stage([query], k=5, candidates=200)[0]
+    assert ids(two_stage) == ids(exact)
+    np.testing.assert_allclose([score for _, score in two_stage], [score for _, score in exact], rtol=1e-5)
+
+    filtered = index.search_two_stage([query], k=5, candidates=50, filters={'currency': ['USD']})[0]
+    assert filtered and all(document_id % 2 for document_id in ids(filtered))
+
+    # The truncated matrix follows later writes
+    index.upsert(1000, query.tolist())
+    assert ids(index.search_two_stage([query], k=1)[0]) == [1000]
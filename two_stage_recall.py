@@ -0,0 +1,87 @@
+"""
+Measure recall@k of two-stage search against exact search on the inventory catalog.
+
+    python two_stage_recall.py --k 5 --queries 500 --dims 128 256 512 --candidates 100 300 1000
+
+Each query is a catalog embedding; its own id is left out of both result
+lists, as in ann_recall.py. Truncation only preserves meaning for
+Matryoshka-trained models (OpenAI's text-embedding-3 family), so check the
+recall before switching SEARCH_MODE to two_stage for another model.
+"""
+import argparse
+import json
+import time
+
+import numpy as np
+
+import resources
+from ann_recall import neighbours
+from embedding_providers import configured_model
+from vector_index import TWO_STAGE_CANDIDATES, TWO_STAGE_DIM, EmbeddingIndex, recall_at_k
+
+
+def measure(index, query_ids, queries, k, dim, candidates):
+    index.enable_two_stage(dim)
+    expected = []
+    found = []
+    exact_seconds = 0.0
+    two_stage_seconds = 0.0
+
+    for query_id, query in zip(query_ids, queries):
+        started = time.perf_counter()
+        exact = index.search(query, k + 1)
+        exact_seconds += time.perf_counter() - started
+
+        started = time.perf_counter()
+        shortlisted = index.search_two_stage([query], k + 1, candidates=candidates)[0]
+        two_stage_seconds += time.perf_counter() - started
+
+        expected.append(neighbours(exact, query_id, k))
+        found.append(neighbours(shortlisted, query_id, k))
+
+    return {
+        'dim': dim,
+        'candidates': candidates,
+        'recall_at_k': round(recall_at_k(expected, found), 4),
+        'exact_ms': round(1000 * exact_seconds / len(queries), 3),
+        'two_stage_ms': round(1000 * two_stage_seconds / len(queries), 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--k', type=int, default=5)
+    parser.add_argument('--queries', type=int, default=200, help="number of catalog items used as queries")
+    parser.add_argument('--dims', type=int, nargs='+', default=[TWO_STAGE_DIM])
+    parser.add_argument('--candidates', type=int, nargs='+', default=[TWO_STAGE_CANDIDATES])
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    collection = resources.collection('inventories')
+
+    index = EmbeddingIndex(model=configured_model())
+    index.load(collection)
+    ids, matrix = index.snapshot()
+    if len(ids) == 0:
+        print("No embedded inventories found.")
+        return
+
+    rng = np.random.default_rng(args.seed)
+    sample = rng.choice(len(ids), size=min(args.queries, len(ids)), replace=False)
+
+    report = {
+        'catalog_size': len(ids),
+        'full_dim': int(matrix.shape[1]),
+        'k': args.k,
+        'queries': len(sample),
+        'results': [
+            measure(index, ids[sample], matrix[sample], args.k, dim, candidates)
+            for dim in args.dims
+            for candidates in args.candidates
+        ],
+    }
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
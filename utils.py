@@ -1,59 +1,305 @@
 import base64
+import hashlib
+import io
+import logging
 import os
+import threading
 
 import requests
-from dotenv import load_dotenv
-from langchain.schema import AIMessage, HumanMessage
-from langchain_openai import ChatOpenAI, OpenAIEmbeddings
-from pymongo import MongoClient
+from cachetools import TTLCache
+from pymongo import UpdateMany, UpdateOne
 from bson.objectid import ObjectId
+import resources
+from resources import LazyResource, lazy_collection
+from vector_index import CATEGORICAL_FIELDS, inventory_index
+from cache import EmbeddingCache
+from codec import encode_embedding
+from sync import touch
+from embedding_dispatcher import EMBEDDING_DISPATCH, EmbeddingDispatcher
+from telemetry import stage
 
 
+logger = logging.getLogger(__name__)
 
-load_dotenv()
 
+# Clients are shared with app.py and created on first use
+chat = LazyResource(lambda: resources.chat_model("gpt-4o-mini"))
+inventories_collection = lazy_collection('inventories')
+users_collection = lazy_collection('users')
 
-client = MongoClient(os.getenv("MONGODB_URL"))
+OWNER_CHUNK_SIZE = int(os.getenv("OWNER_CHUNK_SIZE", 500))
 
-# Connect to the cream-card database
-db = client['cream-card']
+# Owners' profile pictures, shared by every batch so popular owners are looked up once
+owner_picture_cache = TTLCache(maxsize=int(os.getenv("OWNER_CACHE_SIZE", 10000)), ttl=float(os.getenv("OWNER_CACHE_TTL", 300)))
+owner_picture_lock = threading.Lock()
 
-chat = ChatOpenAI(model="gpt-4o-mini")
-# Fetch everything from the inventories collection
-inventories_collection = db['inventories']
-users_collection = db['users']
 
 
-# Retrieve all documents in the inventories collection
-all_inventories = inventories_collection.find()
 
+def iter_chunks(cursor, size):
+    chunk = []
+    for document in cursor:
+        chunk.append(document)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
 
 
+def resolve_owner_profile_pictures(owner_ids):
+    """
+    Map every valid owner id to its profilePicture ("" when unknown).
+    Cache misses are fetched with a single `$in` query.
+    """
+    owner_ids = {ObjectId(owner_id) for owner_id in owner_ids if owner_id and ObjectId.is_valid(owner_id)}
+    pictures = {}
+    missing = []
+
+    with owner_picture_lock:
+        for owner_id in owner_ids:
+            picture = owner_picture_cache.get(owner_id)
+            if picture is None:
+                missing.append(owner_id)
+            else:
+                pictures[owner_id] = picture
+
+    if missing:
+        found = {
+            user['_id']: user.get('profilePicture', "")
+            for user in users_collection.find({'_id': {'$in': missing}}, {'profilePicture': 1})
+        }
+        with owner_picture_lock:
+            for owner_id in missing:
+                pictures[owner_id] = found.get(owner_id, "")
+                owner_picture_cache[owner_id] = pictures[owner_id]
+
+    return pictures
+
+
+def owner_profile_picture(owner_id, pictures):
+    if owner_id and ObjectId.is_valid(owner_id):
+        return pictures.get(ObjectId(owner_id), "")
+    return ""
+
+
+def propagate_owner_profile_pictures(user_ids=None):
+    """
+    Copy users' current profilePicture onto all of their inventories with one
+    `update_many` per owner (all users when `user_ids` is None).
+    Returns the number of inventories modified.
+    """
+    query = {}
+    if user_ids is not None:
+        query = {'_id': {'$in': [ObjectId(user_id) for user_id in user_ids if ObjectId.is_valid(user_id)]}}
 
-def fetch_and_convert_image_to_base64(cloudinary_url):
+    modified = 0
+    for users in iter_chunks(users_collection.find(query, {'profilePicture': 1}), OWNER_CHUNK_SIZE):
+        operations = []
+        for user in users:
+            picture = user.get('profilePicture', "")
+            with owner_picture_lock:
+                owner_picture_cache[user['_id']] = picture
+
+            # Owners may be stored as ObjectIds or as their string form
+            operations.append(UpdateMany(
+                {'owner': {'$in': [user['_id'], str(user['_id'])]}, 'owner_profilePicture': {'$ne': picture}},
+                touch({'$set': {'owner_profilePicture': picture}})
+            ))
+
+        if operations:
+            modified += inventories_collection.bulk_write(operations, ordered=False).modified_count
+
+    return modified
+
+
+# Internal fields that are never returned to clients
+HIDDEN_INVENTORY_FIELDS = ['embedding', 'embedding_hash', 'embedding_model', 'image_caption', 'image_caption_urls']
+
+
+def parse_fields(fields):
+    """Turn a comma separated `fields` request parameter into a list of field names (None when absent)."""
+    if not fields:
+        return None
+    return [field.strip() for field in fields.split(',') if field.strip()]
+
+
+SEARCH_DEFAULT_K = 5
+# Largest page (`k`) and deepest position (`offset + k`) a search may ask for
+SEARCH_MAX_K = int(os.getenv("SEARCH_MAX_K", 100))
+SEARCH_MAX_DEPTH = int(os.getenv("SEARCH_MAX_DEPTH", 1000))
+
+
+def parse_list(value):
+    """A list parameter sent either as a JSON array or as a comma separated string."""
+    if value is None:
+        return None
+    if isinstance(value, str):
+        value = value.split(',')
+    values = [str(item).strip() for item in value if str(item).strip()]
+    return values or None
+
+
+def parse_search_options(data):
+    """
+    Read `k`, `offset` and the attribute filters (`min_price`, `max_price`, `currency`,
+    `owner`, `category`) from request parameters. Returns `(k, offset, filters)`;
+    raises ValueError with a client-facing message for invalid values.
+    """
     try:
-        # Fetch the image from Cloudinary
-        response = requests.get(cloudinary_url)
-        
-        # Check if the request was successful
-        if response.status_code == 200:
-            # Get the image content (binary data)
-            image_content = response.content
-            
-            # Convert binary data to base64
-            image_base64 = base64.b64encode(image_content).decode('utf-8')
-            
-            return image_base64
-        else:
-            print(f"Failed to fetch the image. Status code: {response.status_code}")
-            return None
-    except Exception as e:
-        print(f"Error fetching or converting the image: {str(e)}")
+        k = int(data.get('k') or SEARCH_DEFAULT_K)
+        offset = int(data.get('offset') or 0)
+    except (TypeError, ValueError):
+        raise ValueError('k and offset must be integers')
+
+    if not 1 <= k <= SEARCH_MAX_K:
+        raise ValueError(f"k must be between 1 and {SEARCH_MAX_K}")
+    if offset < 0 or offset + k > SEARCH_MAX_DEPTH:
+        raise ValueError(f"offset must be at least 0 and offset + k at most {SEARCH_MAX_DEPTH}")
+
+    filters = {}
+    for bound in ['min_price', 'max_price']:
+        value = data.get(bound)
+        if value not in (None, ''):
+            try:
+                filters[bound] = float(value)
+            except (TypeError, ValueError):
+                raise ValueError(f"{bound} must be a number")
+
+    for field in CATEGORICAL_FIELDS:
+        values = parse_list(data.get(field))
+        if values and field == 'owner':
+            if not all(ObjectId.is_valid(value) for value in values):
+                raise ValueError('Invalid owner ID')
+            # The index keeps owners in string form, whichever way a document stores them
+            values = [str(ObjectId(value)) for value in values]
+        if values:
+            filters[field] = values
+
+    return k, offset, filters or None
+
+
+@stage('hydration')
+def fetch_ranked_inventories(collection, ids, fields=None):
+    """
+    Fetch the documents for `ids` with one `$in` query and return them in the order of `ids`.
+    Embeddings are never loaded; `fields` optionally restricts the payload further.
+    """
+    if fields:
+        projection = {field: 1 for field in fields if field not in HIDDEN_INVENTORY_FIELDS}
+        projection['_id'] = 1
+    else:
+        projection = {field: 0 for field in HIDDEN_INVENTORY_FIELDS}
+
+    documents = {document['_id']: document for document in collection.find({'_id': {'$in': list(ids)}}, projection)}
+    return [documents[document_id] for document_id in ids if document_id in documents]
+
+
+@stage('hydration')
+def fetch_ranked_vendors(collection, ids, fields=None):
+    """Fetch the public profile fields of the vendors in `ids`, in the order of `ids`."""
+    public = [field for field in fields if field in VENDOR_PUBLIC_FIELDS] if fields else VENDOR_PUBLIC_FIELDS
+    projection = {field: 1 for field in public}
+    projection['_id'] = 1
+
+    documents = {document['_id']: document for document in collection.find({'_id': {'$in': list(ids)}}, projection)}
+    return [documents[document_id] for document_id in ids if document_id in documents]
+
+
+def hydrate_ranked_results(collection, ranked_lists, fields=None):
+    """Fetch the documents for several ranked id lists with one query and return them per list, in order."""
+    all_ids = list(dict.fromkeys(document_id for ranked in ranked_lists for document_id, _ in ranked))
+    documents = {document['_id']: document for document in fetch_ranked_inventories(collection, all_ids, fields)}
+    return [[documents[document_id] for document_id, _ in ranked if document_id in documents] for ranked in ranked_lists]
+
+
+# Listing photos are streamed through one pooled session and never read past IMAGE_MAX_BYTES
+IMAGE_MAX_BYTES = int(os.getenv("IMAGE_MAX_BYTES", 10 * 1024 * 1024))
+IMAGE_TIMEOUT = float(os.getenv("IMAGE_TIMEOUT", 10))
+IMAGE_POOL_SIZE = int(os.getenv("IMAGE_POOL_SIZE", 16))
+# `detail: low` has the model look at a 512x512 version, so larger images are shrunk before upload
+IMAGE_MAX_SIDE = int(os.getenv("IMAGE_MAX_SIDE", 512))
+IMAGE_CHUNK_BYTES = 64 * 1024
+
+
+def image_session():
+    def create():
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=IMAGE_POOL_SIZE, pool_maxsize=IMAGE_POOL_SIZE, max_retries=2)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+    return resources.shared('image-session', create)
+
+
+def download_image(url, etag=None):
+    """
+    Stream the image at `url`, stopping at IMAGE_MAX_BYTES.
+
+    With `etag`, the request is conditional. Returns `(content, etag)`, where
+    `content` is None when the server answered 304 Not Modified, or None if
+    the image could not be fetched.
+    """
+    headers = {'If-None-Match': etag} if etag else {}
+    try:
+        with image_session().get(url, headers=headers, stream=True, timeout=IMAGE_TIMEOUT) as response:
+            if response.status_code == 304:
+                return None, etag
+            if response.status_code != 200:
+                logger.warning("Failed to fetch the image", extra={'url': url, 'status_code': response.status_code})
+                return None
+
+            if int(response.headers.get('Content-Length') or 0) > IMAGE_MAX_BYTES:
+                logger.warning("Image too large", extra={'url': url})
+                return None
+
+            content = bytearray()
+            for block in response.iter_content(IMAGE_CHUNK_BYTES):
+                content.extend(block)
+                if len(content) > IMAGE_MAX_BYTES:
+                    logger.warning("Image too large", extra={'url': url})
+                    return None
+
+            return bytes(content), response.headers.get('ETag')
+    except Exception:
+        logger.exception("Error fetching the image", extra={'url': url})
+        return None
+
+
+def downscale_image(content, max_side=IMAGE_MAX_SIDE):
+    """
+    Shrink an image to fit in `max_side` x `max_side` and re-encode it as JPEG.
+    Returns `content` unchanged when it is already small enough, or when Pillow
+    cannot read it.
+    """
+    from PIL import Image
+
+    try:
+        with Image.open(io.BytesIO(content)) as image:
+            if max(image.size) <= max_side and image.format == 'JPEG':
+                return content
+            # Lets the JPEG decoder skip most of the pixels of a large photo
+            image.draft('RGB', (max_side, max_side))
+            image = image.convert('RGB')
+            image.thumbnail((max_side, max_side))
+            output = io.BytesIO()
+            image.save(output, format='JPEG', quality=85)
+            return output.getvalue()
+    except Exception:
+        logger.exception("Error downscaling the image")
+        return content
+
+
+def fetch_and_convert_image_to_base64(cloudinary_url):
+    result = download_image(cloudinary_url)
+    if result is None:
         return None
+    return base64.b64encode(downscale_image(result[0])).decode('utf-8')
 
 
 def extract_text_from_image(base64_img):
     """Function to extract the content of the uploaded image"""
+    from langchain_core.messages import AIMessage, HumanMessage
 
     try:
         msg = chat.invoke([
@@ -71,68 +317,153 @@ def extract_text_from_image(base64_img):
         ])
 
         return msg.content
-    except Exception as e:
-        print(f"Error extracting text from image: {str(e)}")
+    except Exception:
+        logger.exception("Error extracting text from image")
         return ""
 
 
 # Add your existing endpoints below:
-embedding_model = OpenAIEmbeddings(model='text-embedding-3-small')
+embedding_model = LazyResource(resources.embedding_model)
+# Concurrent requests share the dispatcher's batched, rate-limit aware embedding calls
+embedding_dispatcher = LazyResource(lambda: resources.shared(
+    'embedding-dispatcher', lambda: EmbeddingDispatcher(lambda texts: embedding_model.embed_documents(texts))
+))
 
 
 def generate_embedding(text):
     try:
-        return embedding_model.embed_query(text)
-    except Exception as e:
-        print(f"Error generating embedding: {str(e)}")
+        with stage('embedding'):
+            if EMBEDDING_DISPATCH:
+                return embedding_dispatcher.embed(text)
+            return embedding_model.embed_query(text)
+    except Exception:
+        logger.exception("Error generating embedding")
         return None
+
+
+# Fields that describe an inventory item for search, in the order they are embedded.
+# `image_caption` is written by the captioning pipeline (captions.py)
+INVENTORY_TEXT_FIELDS = ['title', 'description', 'price', 'currency', 'image_caption']
+
+
+def build_inventory_text(inventory):
+    """Canonical text representation of an inventory item used for its embedding."""
+    return ' '.join(str(inventory[key]) for key in INVENTORY_TEXT_FIELDS if inventory.get(key) is not None)
+
+
+# Fields that describe a vendor profile (a user document) for search, in the order they are embedded
+VENDOR_TEXT_FIELDS = ['name', 'bio', 'storeDescription']
+# Users are only embedded once they describe themselves or their store
+VENDOR_QUERY = {'$or': [{field: {'$nin': [None, '']}} for field in ['bio', 'storeDescription']]}
+# User documents also hold private account data, so vendor results only ever carry these fields
+VENDOR_PUBLIC_FIELDS = ['name', 'bio', 'storeDescription', 'profilePicture']
+
+
+def build_vendor_text(user):
+    """Canonical text representation of a vendor profile used for its embedding."""
+    return ' '.join(str(user[key]) for key in VENDOR_TEXT_FIELDS if user.get(key))
+
+
+def inventory_fingerprint(inventory_text, model=None):
+    """Hash of the embedded text and model; an unchanged fingerprint means the embedding is still valid."""
+    model = model or embedding_model.model
+    return hashlib.sha256(f"{model}\n{inventory_text}".encode('utf-8')).hexdigest()
+
+
+def embedding_is_current(inventory, fingerprint):
+    # The hash is only ever written together with the embedding it describes
+    return inventory.get('embedding_hash') == fingerprint
+
+
+# Popular search queries repeat constantly, so their embeddings are cached
+query_embedding_cache = EmbeddingCache()
+
+
+def generate_query_embedding(query):
+    """Embed a search query, reusing a cached embedding for the same normalized text."""
+    embedding = query_embedding_cache.get(query, embedding_model.model)
+    if embedding is not None:
+        return embedding
+
+    embedding = generate_embedding(query)
+    if embedding is not None:
+        query_embedding_cache.set(query, embedding_model.model, embedding)
+    return embedding
     
 
+def generate_query_embeddings(queries):
+    """
+    Embed many search queries with a single request for the ones not already cached.
+    Returns embeddings in the order of `queries` (None for any that failed).
+    """
+    embeddings = [query_embedding_cache.get(query, embedding_model.model) for query in queries]
+    missing = list(dict.fromkeys(query for query, embedding in zip(queries, embeddings) if embedding is None))
+
+    if missing:
+        try:
+            with stage('embedding'):
+                if EMBEDDING_DISPATCH:
+                    generated = dict(zip(missing, embedding_dispatcher.embed_many(missing)))
+                else:
+                    generated = dict(zip(missing, embedding_model.embed_documents(missing)))
+        except Exception:
+            logger.exception("Error generating embeddings", extra={'queries': len(missing)})
+            generated = {}
+
+        for query, embedding in generated.items():
+            query_embedding_cache.set(query, embedding_model.model, embedding)
+        embeddings = [embedding if embedding is not None else generated.get(query) for query, embedding in zip(queries, embeddings)]
+
+    return embeddings
+
+
 def update_all_inventories():
     """
     Update all inventories with embeddings and owner profile pictures.
     """
     try:
         # Retrieve all documents in the inventories collection
-        all_inventories = inventories_collection.find()
+        all_inventories = inventories_collection.find({}, {'embedding': 0})
 
-        for inventory in all_inventories:
-            # Combine relevant fields to create a text representation for embedding
-            inventory_text = ' '.join(
-                str(value) for key, value in inventory.items() if key in ['title', 'description', 'price', 'currency']
-            )
+        for inventories in iter_chunks(all_inventories, OWNER_CHUNK_SIZE):
+            # Resolve every owner in the chunk with one query
+            pictures = resolve_owner_profile_pictures(inventory.get('owner') for inventory in inventories)
+            operations = []
+            embedded = []
 
-            # Generate the embedding
-            embedding_vector = generate_embedding(inventory_text)
+            for inventory in inventories:
+                inventory_text = build_inventory_text(inventory)
+                fingerprint = inventory_fingerprint(inventory_text)
 
-            if embedding_vector is None:
-                print(f"Error generating embedding for inventory ID: {inventory['_id']}")
-                continue
+                update_data = {'owner_profilePicture': owner_profile_picture(inventory.get('owner'), pictures)}
 
-            # Retrieve the owner's profile picture
-            owner_id = inventory.get('owner')
-            owner_profile_picture = ""
+                # Only re-embed when the text (or model) changed since the last embedding
+                if not embedding_is_current(inventory, fingerprint):
+                    embedding_vector = generate_embedding(inventory_text)
 
-            if owner_id and ObjectId.is_valid(owner_id):
-                owner = users_collection.find_one({'_id': ObjectId(owner_id)})
-                if owner:
-                    owner_profile_picture = owner.get('profilePicture', "")
+                    if embedding_vector is None:
+                        logger.error("Error generating embedding for inventory", extra={'inventory_id': str(inventory['_id'])})
+                        continue
 
-            # Update MongoDB document with embedding and owner_profilePicture
-            inventories_collection.update_one(
-                {'_id': inventory['_id']},  # Match the document by _id
-                {
-                    '$set': {
-                        'embedding': embedding_vector,
-                        'owner_profilePicture': owner_profile_picture
-                    }
-                }
-            )
+                    update_data.update({
+                        'embedding': encode_embedding(embedding_vector),
+                        'embedding_hash': fingerprint,
+                        'embedding_model': embedding_model.model,
+                    })
+                    embedded.append((inventory, embedding_vector))
+
+                operations.append(UpdateOne({'_id': inventory['_id']}, touch({'$set': update_data})))
+
+            # Update MongoDB documents with embedding and owner_profilePicture
+            if operations:
+                inventories_collection.bulk_write(operations, ordered=False)
+            for inventory, embedding_vector in embedded:
+                inventory_index.upsert(inventory['_id'], embedding_vector, inventory, model=embedding_model.model)
 
         return {'status': 'success', 'message': 'Embeddings and owner profile pictures added to all inventories!'}
 
     except Exception as e:
-        print(f"Error: {str(e)}")
+        logger.exception("Error updating all inventories")
         return {'status': 'error', 'message': str(e)}
 
 
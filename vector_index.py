@@ -0,0 +1,631 @@
+import os
+import threading
+
+import numpy as np
+from bson.objectid import ObjectId
+
+from codec import decode_embedding
+from embedding_providers import configured_model
+
+
+# Inventory attributes kept in columns next to the matrix so searches can filter before ranking
+PRICE_FIELD = 'price'
+CATEGORICAL_FIELDS = ['currency', 'owner', 'category']
+FILTER_FIELDS = [PRICE_FIELD] + CATEGORICAL_FIELDS
+
+# Embeddings written before `embedding_model` was stored alongside them came from this model
+UNTAGGED_EMBEDDING_MODEL = os.getenv("UNTAGGED_EMBEDDING_MODEL", "text-embedding-3-small")
+
+# Two-stage search: dimensions kept for the coarse scan, and how many rows it shortlists for the exact rerank
+TWO_STAGE_DIM = int(os.getenv("TWO_STAGE_DIM", 256))
+TWO_STAGE_CANDIDATES = int(os.getenv("TWO_STAGE_CANDIDATES", 300))
+
+
+def normalize(vector):
+    """Return `vector` as a unit-length float32 array (zero vectors are left as zeros)."""
+    vector = np.asarray(vector, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    if norm == 0:
+        return vector
+    return vector / norm
+
+
+def truncate(vectors, dim):
+    """
+    The first `dim` dimensions of `vectors` (one vector or rows of a matrix), renormalized.
+    Matryoshka-trained embeddings (OpenAI's text-embedding-3 models) stay meaningful when cut.
+    """
+    truncated = np.array(vectors[..., :dim], dtype=np.float32)
+    norms = np.linalg.norm(truncated, axis=-1, keepdims=True)
+    norms[norms == 0] = 1
+    truncated /= norms
+    return truncated
+
+
+def top_k(scores, k):
+    """Indices of the `k` highest scores, best first."""
+    if k <= 0 or len(scores) == 0:
+        return np.empty(0, dtype=np.int64)
+    if k >= len(scores):
+        return np.argsort(-scores)
+    candidates = np.argpartition(-scores, k - 1)[:k]
+    return candidates[np.argsort(-scores[candidates])]
+
+
+def top_k_rows(scores, k):
+    """Per-row indices of the `k` highest scores in a 2-d array, best first."""
+    k = min(k, scores.shape[1])
+    if k <= 0:
+        return np.empty((len(scores), 0), dtype=np.int64)
+    if k == scores.shape[1]:
+        return np.argsort(-scores, axis=1)
+    candidates = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    order = np.argsort(-np.take_along_axis(scores, candidates, axis=1), axis=1)
+    return np.take_along_axis(candidates, order, axis=1)
+
+
+def price_value(value):
+    """Price as a float, NaN when missing or not a number (NaN never matches a price range)."""
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+def categorical_value(value):
+    """
+    The form a categorical value is indexed and filtered under. Owners may be stored as
+    ObjectIds or as their string form, so ObjectIds are kept as strings to match both.
+    """
+    if isinstance(value, ObjectId):
+        return str(value)
+    return value
+
+
+def embedding_model_of(document):
+    """The model that produced `document`'s stored embedding."""
+    return document.get('embedding_model') or UNTAGGED_EMBEDDING_MODEL
+
+
+def model_query(model):
+    """Query for the documents whose stored embedding was produced by `model`."""
+    if model == UNTAGGED_EMBEDDING_MODEL:
+        # null also matches documents without the field
+        return {'embedding_model': {'$in': [model, None]}}
+    return {'embedding_model': model}
+
+
+def recall_at_k(expected, found):
+    """Fraction of the ids in `expected` that also appear in `found`, averaged over queries."""
+    recalls = [len(set(e) & set(f)) / len(e) for e, f in zip(expected, found) if len(e)]
+    return float(np.mean(recalls)) if recalls else 0.0
+
+
+class RowSet:
+    """
+    Ids of the EmbeddingIndex rows selected by a filter mask, for indexes that
+    filter by id instead of by row (the ANN and keyword indexes). A membership
+    test is a dict lookup plus an array read, so no set of ids is built.
+    """
+
+    def __init__(self, ids, positions, mask, count):
+        self.ids = ids
+        self.positions = positions
+        self.mask = mask
+        self.count = count
+
+    def __contains__(self, document_id):
+        row = self.positions.get(document_id)
+        return row is not None and row < len(self.mask) and bool(self.mask[row])
+
+    def __iter__(self):
+        return iter(self.ids[:len(self.mask)][self.mask])
+
+    def __len__(self):
+        return self.count
+
+
+class WriteBuffer:
+    """
+    Takes a listener's place while it builds from a copy of the index, recording
+    the upserts and removes it would have missed so they can be replayed in order.
+    """
+
+    def __init__(self):
+        self.writes = []
+
+    def upsert(self, inventory_id, vector):
+        self.writes.append(('upsert', inventory_id, vector))
+
+    def remove(self, inventory_id):
+        self.writes.append(('remove', inventory_id, None))
+
+    def replay(self, listener):
+        for operation, inventory_id, vector in self.writes:
+            if operation == 'upsert':
+                listener.upsert(inventory_id, vector)
+            else:
+                listener.remove(inventory_id)
+
+
+class EmbeddingIndex:
+    """
+    Process-resident cosine similarity index over inventory embeddings.
+
+    Rows of `matrix` are L2-normalized float32 vectors and `ids[i]` is the
+    `_id` of the document that produced row i, so a search is a single
+    matrix-vector product followed by a partial sort.
+
+    Rows are updated in place. Deleted rows are marked invalid and reused by
+    later inserts, and the arrays grow geometrically, so a single upsert
+    never rebuilds the matrix.
+
+    Listeners (e.g. an ANN index) receive every load, upsert and remove, so
+    secondary indexes stay in step with this one. Writes made while a listener
+    builds from a load are buffered and replayed once it is done.
+
+    Filterable attributes live in columns aligned with the matrix rows: prices
+    as floats and categorical fields as integer codes. A filter is a boolean
+    mask over those columns, applied to the scores before top-k selection.
+
+    An index tagged with `model` only holds vectors produced by that model, so
+    query embeddings are never compared with another model's vectors while a
+    collection is being re-embedded. Untagged indexes accept any vector.
+
+    `version` counts the changes to the index, so results computed from it can
+    be cached until it moves.
+
+    After `enable_two_stage`, a copy of the matrix truncated to `coarse_dim`
+    dimensions is kept row for row, and `search_two_stage` scans it instead of
+    the full vectors, reranking only a shortlist exactly.
+    """
+
+    def __init__(self, model=None):
+        self.model = model
+        self.lock = threading.Lock()
+        self.load_lock = threading.Lock()
+        self.ids = np.empty(0, dtype=object)
+        self.matrix = np.empty((0, 0), dtype=np.float32)
+        self.valid = np.zeros(0, dtype=bool)
+        self.prices = np.empty(0, dtype=np.float64)
+        self.codes = {field: np.empty(0, dtype=np.int32) for field in CATEGORICAL_FIELDS}
+        self.vocabularies = {field: {} for field in CATEGORICAL_FIELDS}
+        self.size = 0
+        self.positions = {}
+        self.free_rows = []
+        self.listeners = []
+        self.loaded = False
+        self.version = 0
+        self.coarse_dim = None
+        self.coarse = None
+
+    def __len__(self):
+        return len(self.positions)
+
+    def __contains__(self, inventory_id):
+        return inventory_id in self.positions
+
+    def load(self, collection):
+        """(Re)build the index from every document in `collection` that has an embedding."""
+        with self.load_lock:
+            self._load(collection)
+
+    def add_listener(self, listener):
+        """Attach `listener`, seeding it with the current contents if the index is already loaded."""
+        # Called per request by the ANN search mode; attaching is rare, so only that takes the load lock
+        if listener in self.listeners:
+            return
+        with self.load_lock:
+            if listener in self.listeners:
+                return
+            if not self.loaded:
+                with self.lock:
+                    self.listeners.append(listener)
+                return
+
+            with self.lock:
+                ids, matrix = self._live()
+                buffer = WriteBuffer()
+                self.listeners.append(buffer)
+            self._seed([listener], [buffer], ids, matrix)
+
+    def _seed(self, listeners, buffers, ids, matrix):
+        """
+        Build `listeners` from `(ids, matrix)` while `buffers` stand in for them, then
+        replay the writes the buffers caught and put the listeners back in their place.
+        """
+        try:
+            for listener in listeners:
+                listener.on_load(ids, matrix)
+        finally:
+            with self.lock:
+                for listener, buffer in zip(listeners, buffers):
+                    buffer.replay(listener)
+                    self.listeners[self.listeners.index(buffer)] = listener
+
+    def _live(self):
+        # Caller must hold self.lock
+        valid = self.valid[:self.size]
+        return self.ids[:self.size][valid], self.matrix[:self.size][valid]
+
+    def snapshot(self, attributes=False):
+        """
+        Copy of the live `(ids, matrix)` with freed rows dropped. With `attributes`,
+        a third item maps each filter field to its values for those rows.
+        """
+        with self.lock:
+            valid = self.valid[:self.size]
+            ids, matrix = self._live()
+            if not attributes:
+                return ids, matrix
+
+            columns = {PRICE_FIELD: self.prices[:self.size][valid]}
+            for field in CATEGORICAL_FIELDS:
+                values = np.empty(len(self.vocabularies[field]) + 1, dtype=object)
+                for value, code in self.vocabularies[field].items():
+                    values[code] = value
+                # Code -1 (missing) picks the trailing None
+                columns[field] = values[self.codes[field][:self.size][valid]]
+            return ids, matrix, columns
+
+    def ensure_loaded(self, collection):
+        if self.loaded:
+            return
+        with self.load_lock:
+            if not self.loaded:
+                self._load(collection)
+
+    def _load(self, collection):
+        ids = []
+        vectors = []
+        attributes = {field: [] for field in FILTER_FIELDS}
+
+        # Only pull the ids, vectors and filter fields over the wire; packed vectors decode without copying
+        projection = {field: 1 for field in ['embedding'] + FILTER_FIELDS}
+        query = {'embedding': {'$exists': True}}
+        if self.model:
+            query.update(model_query(self.model))
+        for document in collection.find(query, projection):
+            embedding = document.get('embedding')
+            if embedding:
+                ids.append(document['_id'])
+                vectors.append(decode_embedding(embedding))
+                for field in FILTER_FIELDS:
+                    attributes[field].append(document.get(field))
+
+        if vectors:
+            matrix = np.vstack(vectors).astype(np.float32, copy=False)
+            norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+            norms[norms == 0] = 1
+            matrix /= norms
+        else:
+            matrix = np.empty((0, 0), dtype=np.float32)
+
+        self._install(ids, matrix, attributes)
+
+    def load_arrays(self, ids, matrix, attributes=None):
+        """
+        Install prebuilt, already normalized arrays, e.g. a memory-mapped snapshot.
+        `matrix` may have more rows than `ids`; the extra rows are spare capacity for inserts.
+        `attributes` maps filter fields to values aligned with `ids` (missing fields are empty).
+        """
+        with self.load_lock:
+            self._install(ids, matrix, attributes)
+
+    def _install(self, ids, matrix, attributes=None):
+        count = len(ids)
+        capacity = len(matrix)
+        attributes = attributes or {}
+        id_array = np.empty(capacity, dtype=object)
+        id_array[:count] = ids
+        valid = np.zeros(capacity, dtype=bool)
+        valid[:count] = True
+        positions = {inventory_id: row for row, inventory_id in enumerate(ids)}
+
+        prices = np.full(capacity, np.nan)
+        if attributes.get(PRICE_FIELD) is not None:
+            prices[:count] = [price_value(value) for value in attributes[PRICE_FIELD]]
+
+        codes = {}
+        vocabularies = {}
+        for field in CATEGORICAL_FIELDS:
+            codes[field] = np.full(capacity, -1, dtype=np.int32)
+            vocabularies[field] = {}
+            if attributes.get(field) is not None:
+                codes[field][:count] = [self._encode(vocabularies[field], value) for value in attributes[field]]
+
+        coarse_dim = self.coarse_dim
+        coarse = truncate(matrix, coarse_dim) if coarse_dim else None
+
+        # Swap everything in at once so concurrent searches never see a mismatched pair
+        with self.lock:
+            self.ids = id_array
+            self.matrix = matrix
+            self.coarse = coarse
+            self.valid = valid
+            self.prices = prices
+            self.codes = codes
+            self.vocabularies = vocabularies
+            self.size = count
+            self.positions = positions
+            self.free_rows = []
+            self.loaded = True
+            self.version += 1
+            # Writes landing while the listeners rebuild are held back and replayed afterwards
+            listeners = self.listeners
+            buffers = [WriteBuffer() for _ in listeners]
+            self.listeners = list(buffers)
+            live_ids, live_matrix = id_array[:count].copy(), matrix[:count]
+
+        self._seed(listeners, buffers, live_ids, live_matrix)
+
+    @staticmethod
+    def _encode(vocabulary, value):
+        """Integer code for a categorical value, adding it to `vocabulary` if new (-1 for missing)."""
+        if value is None or isinstance(value, (list, dict)):
+            return -1
+        return vocabulary.setdefault(categorical_value(value), len(vocabulary))
+
+    def _set_attributes(self, row, attributes, fields):
+        # Caller must hold self.lock
+        for field in fields:
+            value = attributes.get(field)
+            if field == PRICE_FIELD:
+                self.prices[row] = price_value(value)
+            else:
+                self.codes[field][row] = self._encode(self.vocabularies[field], value)
+
+    def _allocate_row(self, dim):
+        # Caller must hold self.lock
+        if self.free_rows:
+            return self.free_rows.pop()
+
+        if self.matrix.shape[1] != dim:
+            if self.positions:
+                raise ValueError(f"Embedding has {dim} dimensions, index has {self.matrix.shape[1]}")
+            self.matrix = np.empty((0, dim), dtype=np.float32)
+            if self.coarse_dim:
+                self.coarse = np.empty((0, min(dim, self.coarse_dim)), dtype=np.float32)
+            self.ids = np.empty(0, dtype=object)
+            self.valid = np.zeros(0, dtype=bool)
+            self.prices = np.empty(0, dtype=np.float64)
+            self.codes = {field: np.empty(0, dtype=np.int32) for field in CATEGORICAL_FIELDS}
+            self.size = 0
+
+        if self.size == len(self.matrix):
+            # Grow into fresh arrays; searches holding the old ones are unaffected
+            capacity = max(16, 2 * len(self.matrix))
+            matrix = np.zeros((capacity, dim), dtype=np.float32)
+            matrix[:self.size] = self.matrix[:self.size]
+            ids = np.empty(capacity, dtype=object)
+            ids[:self.size] = self.ids[:self.size]
+            valid = np.zeros(capacity, dtype=bool)
+            valid[:self.size] = self.valid[:self.size]
+            prices = np.full(capacity, np.nan)
+            prices[:self.size] = self.prices[:self.size]
+            codes = {}
+            for field, column in self.codes.items():
+                codes[field] = np.full(capacity, -1, dtype=np.int32)
+                codes[field][:self.size] = column[:self.size]
+            self.matrix, self.ids, self.valid, self.prices, self.codes = matrix, ids, valid, prices, codes
+            if self.coarse is not None:
+                coarse = np.zeros((capacity, self.coarse.shape[1]), dtype=np.float32)
+                coarse[:self.size] = self.coarse[:self.size]
+                self.coarse = coarse
+
+        row = self.size
+        self.size += 1
+        return row
+
+    def accepts(self, model):
+        return not self.model or model is None or model == self.model
+
+    def upsert(self, inventory_id, embedding, attributes=None, model=None):
+        """
+        Insert or replace the vector for `inventory_id` (a list or a packed stored embedding).
+        `attributes` is the document (or any dict holding its filter fields); when omitted,
+        an existing row keeps its attributes.
+
+        `model` names the model that produced the vector. A vector from another model than
+        the index's replaces nothing: the document is dropped until it is re-embedded.
+        Returns whether the vector was indexed.
+        """
+        if not self.accepts(model):
+            self.remove(inventory_id)
+            return False
+
+        vector = normalize(decode_embedding(embedding))
+
+        with self.lock:
+            row = self.positions.get(inventory_id)
+            if row is None:
+                row = self._allocate_row(len(vector))
+                self.positions[inventory_id] = row
+                self._set_attributes(row, attributes or {}, FILTER_FIELDS)
+            elif attributes is not None:
+                self._set_attributes(row, attributes, FILTER_FIELDS)
+            self.matrix[row] = vector
+            if self.coarse is not None:
+                self.coarse[row] = truncate(vector, self.coarse_dim)
+            self.ids[row] = inventory_id
+            self.valid[row] = True
+            self.version += 1
+
+            for listener in self.listeners:
+                listener.upsert(inventory_id, vector)
+        return True
+
+    def update_attributes(self, inventory_id, changes):
+        """Apply changed filter fields (None clears one) without touching the vector."""
+        fields = [field for field in FILTER_FIELDS if field in changes]
+        with self.lock:
+            row = self.positions.get(inventory_id)
+            if row is None or not fields:
+                return False
+            self._set_attributes(row, changes, fields)
+            self.version += 1
+            return True
+
+    def remove(self, inventory_id):
+        """Drop `inventory_id` from the index. Returns False if it was not indexed."""
+        with self.lock:
+            row = self.positions.pop(inventory_id, None)
+            if row is None:
+                return False
+            self.valid[row] = False
+            self.ids[row] = None
+            self.matrix[row] = 0
+            if self.coarse is not None:
+                self.coarse[row] = 0
+            self._set_attributes(row, {}, FILTER_FIELDS)
+            self.free_rows.append(row)
+            self.version += 1
+
+            for listener in self.listeners:
+                listener.remove(inventory_id)
+            return True
+
+    def _filter_mask(self, filters, valid, prices, codes, vocabularies):
+        """
+        Boolean mask of the rows matching `filters`, a dict with optional `min_price`,
+        `max_price` and lists of accepted values for each categorical field.
+        """
+        mask = valid.copy()
+        size = len(mask)
+
+        if filters.get('min_price') is not None:
+            mask &= prices[:size] >= filters['min_price']
+        if filters.get('max_price') is not None:
+            mask &= prices[:size] <= filters['max_price']
+
+        for field in CATEGORICAL_FIELDS:
+            values = filters.get(field)
+            if values:
+                accepted = [vocabularies[field].get(categorical_value(value)) for value in values]
+                accepted = [code for code in accepted if code is not None]
+                mask &= np.isin(codes[field][:size], accepted)
+
+        return mask
+
+    def _candidates(self, filters):
+        """
+        Arrays for a search plus the mask of rows it may return (None when every row may).
+        The last item is the truncated matrix, None until two-stage search is enabled.
+        """
+        with self.lock:
+            ids = self.ids
+            matrix = self.matrix[:self.size]
+            coarse = self.coarse[:self.size] if self.coarse is not None else None
+            valid = self.valid[:self.size]
+            live = len(self.positions)
+            prices, codes, vocabularies = self.prices, self.codes, self.vocabularies
+
+        if filters:
+            mask = self._filter_mask(filters, valid, prices, codes, vocabularies)
+            return ids, matrix, mask, int(mask.sum()), coarse
+
+        # Rows freed by deletes must never outrank real documents
+        return ids, matrix, (valid if live < len(matrix) else None), live, coarse
+
+    def matching(self, filters):
+        """RowSet of the indexed documents matching `filters`."""
+        ids, matrix, mask, count, _ = self._candidates(filters)
+        if mask is None:
+            mask = np.ones(len(matrix), dtype=bool)
+        return RowSet(ids, self.positions, mask, count)
+
+    def search(self, query_embedding, k=5, offset=0, filters=None):
+        """
+        Return up to `k` `(id, score)` pairs ordered by descending cosine similarity,
+        skipping the first `offset` and considering only rows matching `filters`.
+        """
+        ids, matrix, mask, candidates, _ = self._candidates(filters)
+
+        if candidates == 0:
+            return []
+
+        scores = matrix @ normalize(query_embedding)
+        if mask is not None:
+            scores[~mask] = -np.inf
+
+        best = top_k(scores, min(offset + k, candidates))[offset:]
+        return [(ids[i], float(scores[i])) for i in best if ids[i] is not None]
+
+    def search_many(self, query_embeddings, k=5, offset=0, filters=None, block_size=64):
+        """
+        Score many queries with one matrix-matrix product per block of queries.
+        Returns one list of `(id, score)` pairs per query.
+        """
+        ids, matrix, mask, candidates, _ = self._candidates(filters)
+
+        if candidates == 0:
+            return [[] for _ in query_embeddings]
+
+        queries = np.asarray([normalize(query) for query in query_embeddings], dtype=np.float32)
+        results = []
+
+        # Blocks bound the (queries x catalog) score matrix held in memory at once
+        for start in range(0, len(queries), block_size):
+            scores = queries[start:start + block_size] @ matrix.T
+            if mask is not None:
+                scores[:, ~mask] = -np.inf
+
+            best = top_k_rows(scores, min(offset + k, candidates))[:, offset:]
+            for row, columns in enumerate(best):
+                results.append([(ids[i], float(scores[row, i])) for i in columns if ids[i] is not None])
+
+        return results
+
+    def enable_two_stage(self, dim=TWO_STAGE_DIM):
+        """Build (or rebuild for a new `dim`) the truncated matrix; it is then kept up to date with every write."""
+        if self.coarse_dim == dim:
+            return
+        with self.load_lock:
+            while self.coarse_dim != dim:
+                with self.lock:
+                    matrix, version = self.matrix, self.version
+                # Truncate without blocking searches; a write in the meantime means starting over
+                coarse = truncate(matrix, dim)
+                with self.lock:
+                    if self.version == version:
+                        self.coarse_dim = dim
+                        self.coarse = coarse
+
+    def search_two_stage(self, query_embeddings, k=5, offset=0, filters=None, candidates=TWO_STAGE_CANDIDATES, block_size=64):
+        """
+        Like search_many, in two stages: the truncated matrix is scanned to shortlist
+        `candidates` rows per query (at least `offset + k`), then the shortlist is
+        reranked with the full vectors. Scores are exact cosine similarities; rows the
+        coarse scan misses are lost, which two_stage_recall.py measures.
+        Searches every row exactly until enable_two_stage is called.
+        """
+        ids, matrix, mask, count, coarse = self._candidates(filters)
+
+        if coarse is None:
+            return self.search_many(query_embeddings, k, offset, filters, block_size)
+        if count == 0:
+            return [[] for _ in query_embeddings]
+
+        queries = np.asarray([normalize(query) for query in query_embeddings], dtype=np.float32)
+        shortlist_size = min(max(candidates, offset + k), count)
+        results = []
+
+        for start in range(0, len(queries), block_size):
+            block = queries[start:start + block_size]
+            scores = truncate(block, coarse.shape[1]) @ coarse.T
+            if mask is not None:
+                scores[:, ~mask] = -np.inf
+
+            for query, rows in zip(block, top_k_rows(scores, shortlist_size)):
+                # Only the shortlisted rows of the full matrix are read
+                exact = matrix[rows] @ query
+                best = top_k(exact, min(offset + k, len(rows)))[offset:]
+                results.append([(ids[rows[i]], float(exact[i])) for i in best if ids[rows[i]] is not None])
+
+        return results
+
+
+# Shared index for the inventories collection, used by the API and the batch jobs
+inventory_index = EmbeddingIndex(model=configured_model())
+# Vendor profiles (embedded user documents); the inventory filter columns are simply left empty
+vendor_index = EmbeddingIndex(model=configured_model())